@@ -1,3 +1,16 @@
+import asyncio
+import threading
+from functools import partial
+
+from libs.aio import iterate_in_threadpool
+from libs.completion import FkUSTChat_CompletionCollector
+from libs.http import create_session, create_async_client, close_async_client
+from libs.retry import FkUSTChat_RetryPolicy
+from libs.tokens import FkUSTChat_TokenCounter
+
+# 影响连接池的配置项，只有这些变化时才需要重建 HTTP 客户端
+HTTP_CONFIG_KEYS = ('http_pool_connections', 'http_pool_maxsize', 'http_pool_block', 'http_keep_alive')
+
 class FkUSTChat_BaseAdapter:
     def __init__(self, context, adapter_info):
         """
@@ -13,15 +26,112 @@ class FkUSTChat_BaseAdapter:
         self.author = adapter_info.get('author', 'yemaster')
         self.models = {}
         self.config = {}
+
+        self.session_headers = {}
+        self.session_cookies = {}
+        self._session = None
+        self._async_client = None
+        self._async_client_loop = None
+        self._session_lock = threading.Lock()
     
     def load_config(self, config):
         """
         Loads the config into the adapter.
         
+        The HTTP clients are rebuilt only when their ``http_*`` settings changed, so reloading the
+        config keeps the open connections.
+
         :param config: The config data to be loaded.
         """
+        old_config = self.config
         self.config = config
+        if any(old_config.get(key) != config.get(key) for key in HTTP_CONFIG_KEYS):
+            self.reset_http_clients()
+
+    def reset_http_clients(self):
+        """
+        Closes the HTTP session and async client; the next call creates new ones from the current config.
+        """
+        with self._session_lock:
+            session, self._session = self._session, None
+            client, self._async_client = self._async_client, None
+            loop, self._async_client_loop = self._async_client_loop, None
+        if session is not None:
+            session.close()
+        if client is not None:
+            close_async_client(client, loop)
+
+    def get_session(self):
+        """
+        Returns the HTTP session shared by all upstream calls of this adapter, creating it on first use.
+
+        The pool is sized by the ``http_pool_connections``, ``http_pool_maxsize``, ``http_pool_block``
+        and ``http_keep_alive`` config keys.
+
+        :return: A thread-safe, keep-alive ``requests.Session``.
+        """
+        session = self._session
+        if session is not None:
+            return session
+        with self._session_lock:
+            if self._session is None:
+                self._session = create_session(
+                    pool_connections=self.config.get('http_pool_connections', 10),
+                    pool_maxsize=self.config.get('http_pool_maxsize', 32),
+                    pool_block=self.config.get('http_pool_block', False),
+                    keep_alive=self.config.get('http_keep_alive', True),
+                    headers=self.session_headers,
+                    cookies=self.session_cookies
+                )
+            return self._session
+
+    def get_retry_policy(self):
+        """
+        Returns the retry policy for upstream calls, configured by the ``retry_*`` config keys.
+
+        :return: A :class:`FkUSTChat_RetryPolicy`.
+        """
+        return FkUSTChat_RetryPolicy.from_config(self.config, name=self.name)
+
+    def get_async_client(self):
+        """
+        Returns the async HTTP client shared by all upstream calls of this adapter in ASGI mode.
+
+        It is sized by the same ``http_*`` config keys as :meth:`get_session`.
+
+        :return: An ``httpx.AsyncClient``, or None if httpx is not installed.
+        """
+        if self._async_client is None:
+            self._async_client_loop = asyncio.get_running_loop()
+            self._async_client = create_async_client(
+                max_connections=self.config.get('http_pool_maxsize', 32),
+                max_keepalive_connections=self.config.get('http_pool_connections', 10),
+                keep_alive=self.config.get('http_keep_alive', True),
+                headers=self.session_headers,
+                cookies=self.session_cookies
+            )
+        return self._async_client
     
+    def collect_metrics(self):
+        """
+        Returns the adapter's own metrics for ``/metrics``, as ``(name, type, documentation, samples)``
+        tuples where samples is a list of ``(labels dict, value)``.
+        """
+        return []
+
+    def get_shared_state(self):
+        """
+        Returns the :class:`FkUSTChat_SharedState` of a multi-worker deployment, or None when running in a single process.
+        """
+        return getattr(self.context, 'shared_state', None)
+
+    def close(self):
+        """
+        Stops the adapter's background work once it has been replaced or removed.
+        Requests still running on it are allowed to finish.
+        """
+        pass
+
     def set_config(self, key, config):
         """
         Sets the config for the adapter.
@@ -45,6 +155,7 @@ class FkUSTChat_BaseModel:
         self.name = model_info.get('name', 'FkUSTChat_BaseModel')
         self.description = model_info.get('description', 'Base Model for FkUSTChat')
         self.author = model_info.get('author', 'yemaster')
+        self.tokenizer = model_info.get('tokenizer')
         self.allow_tool = False
     
     def get_response(self, prompt):
@@ -54,4 +165,34 @@ class FkUSTChat_BaseModel:
         :param prompt: The input prompt for which to generate a response.
         :return: The generated response.
         """
-        raise NotImplementedError("This method should be overridden by subclasses.")
\ No newline at end of file
+        raise NotImplementedError("This method should be overridden by subclasses.")
+
+    def create_collector(self, max_tokens=None, stop=None):
+        """
+        Returns a :class:`FkUSTChat_CompletionCollector` that builds a non-streamed answer from the
+        upstream stream and tells when to stop reading it, counting tokens with the model's tokenizer.
+
+        :param max_tokens: The ``max_tokens`` of the request, or None.
+        :param stop: The ``stop`` sequences of the request, or None.
+        """
+        tokenizers = getattr(self.context, 'tokenizers', None)
+        counter = FkUSTChat_TokenCounter(tokenizers.get(self.tokenizer)) if tokenizers is not None and max_tokens is not None else None
+        return FkUSTChat_CompletionCollector(self.name, max_tokens, stop, counter)
+
+    async def aget_response(self, prompt, stream=False, **kwargs):
+        """
+        Async version of :meth:`get_response`, used by the ASGI serving mode.
+
+        The default implementation runs the sync :meth:`get_response` in the thread pool, so adapters
+        that only implement the sync interface keep working. Adapters with a native async client
+        should override it.
+
+        :param prompt: The input prompt for which to generate a response.
+        :param stream: Whether to return an async iterator of SSE chunks instead of a full response.
+        :return: The generated response, or an async iterator over its chunks when streaming.
+        """
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(None, partial(self.get_response, prompt, stream=stream, **kwargs))
+        if stream:
+            return iterate_in_threadpool(response)
+        return response
@@ -1,17 +1,76 @@
+import asyncio
+import contextvars
 import requests
 import time
 import random
 import json
-from os import path
-import sys
-
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from webdriver_manager.microsoft import EdgeChromiumDriverManager
+from functools import partial
 
 from adapters.base import FkUSTChat_BaseAdapter, FkUSTChat_BaseModel
+from libs.accounts import FkUSTChat_Account, FkUSTChat_AccountPool
+from libs.credentials import FkUSTChat_CredentialManager
+from libs.http import iter_response_bytes
+from libs.login import FkUSTChat_LoginBackend, create_webdriver, load_login_backend
+from libs.scheduler import FkUSTChat_SlotIterator, FkUSTChat_AsyncSlotIterator
+from libs.warmpool import FkUSTChat_WarmPool
+from libs.metrics import LOGIN_DURATION, ENTER_QUEUE_DURATION
+from libs.tracing import start_span
+from libs.sse import iter_sse_frames, aiter_sse_frames
+from libs.tool_calls import FkUSTChat_ToolCallAccumulator
+
+# 适配器清单：启动时直接读取，无需导入本文件即可得到模型列表
+ADAPTER_MANIFEST = {
+    "name": "USTC_Adapter",
+    "description": "USTC Adapter for FkUSTChat",
+    "author": "yemaster",
+    "models": {
+        "deepseek-r1": {
+            "name": "USTC_DeepSeek_r1_Model",
+            "show": "USTC Deepseek r1",
+            "description": "USTC DeepSeek-r1 Model for FkUSTChat",
+            "author": "yemaster",
+            "tokenizer": "deepseek"
+        },
+        "deepseek-v3": {
+            "name": "USTC_DeepSeek_v3_Model",
+            "show": "USTC Deepseek v3",
+            "description": "USTC DeepSeek-r1 Model for FkUSTChat",
+            "author": "yemaster",
+            "tokenizer": "deepseek"
+        },
+        "fool": {
+            "name": "USTC_Fool_Model",
+            "show": "科大模型 (Qwen)",
+            "description": "USTC DeepSeek-r1 Model for FkUSTChat",
+            "author": "yemaster",
+            "tokenizer": "qwen"
+        }
+    }
+}
+
+USTC_COOKIES = {
+    '_ga_Q8WSZQS8E1': 'GS2.1.s1757597943$o7$g0$t1757597943$j60$l0$h1338098571',
+    '_ga': 'GA1.1.1970297231.1750309927',
+    '_ga_PG4WGSYP0Y': 'GS2.1.s1758189290$o2$g1$t1758192312$j60$l0$h0',
+    '_ga_HYDB8XD6M6': 'GS2.1.s1758189297$o13$g1$t1758192312$j60$l0$h0',
+}
+
+USTC_HEADERS = {
+    'accept-language': 'zh-CN,zh-TW;q=0.9,zh;q=0.8,en;q=0.7,en-GB;q=0.6,en-US;q=0.5',
+    'dnt': '1',
+    'origin': 'https://chat.ustc.edu.cn',
+    'priority': 'u=1, i',
+    'referer': 'https://chat.ustc.edu.cn/ustchat/',
+    'sec-ch-ua': '"Chromium";v="140", "Not=A?Brand";v="24", "Microsoft Edge";v="140"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-platform': '"Windows"',
+    'sec-fetch-dest': 'empty',
+    'sec-fetch-mode': 'cors',
+    'sec-fetch-site': 'same-origin',
+    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/140.0.0.0 Safari/537.36 Edg/140.0.0.0',
+}
+
+USTC_LOGIN_URL = "https://id.ustc.edu.cn/cas/login?service=https:%2F%2Fchat.ustc.edu.cn%2Fustchat%2F"
 
 def get_random_queue_code():
     # return a random 32-character string
@@ -30,33 +89,19 @@ class USTC_Base_Model(FkUSTChat_BaseModel):
 
         self.model = model
 
-    def get_response(self, prompt, stream=False, with_search=False, tools=[]):
-        credentials = self.adapter.get_credentials()
-        queue_code = self.adapter.enter_queue()
-
-        cookies = {
-            '_ga_Q8WSZQS8E1': 'GS2.1.s1757597943$o7$g0$t1757597943$j60$l0$h1338098571',
-            '_ga': 'GA1.1.1970297231.1750309927',
-            '_ga_PG4WGSYP0Y': 'GS2.1.s1758189290$o2$g1$t1758192312$j60$l0$h0',
-            '_ga_HYDB8XD6M6': 'GS2.1.s1758189297$o13$g1$t1758192312$j60$l0$h0',
-        }
+    def build_request(self, prompt, credentials, queue_code, with_search=False, tools=[], sampling=None):
+        """
+        Builds the headers and body of a chat request.
 
+        :param prompt: The messages to send.
+        :param credentials: The bearer token to authorize with.
+        :param queue_code: A queue code that already entered the upstream queue.
+        :param sampling: The sampling parameters of the request; those listed in ``sampling_params`` are forwarded.
+        :return: A ``(headers, json_data)`` tuple.
+        """
         headers = {
             'accept': 'text/event-stream, */*',
-            'accept-language': 'zh-CN,zh-TW;q=0.9,zh;q=0.8,en;q=0.7,en-GB;q=0.6,en-US;q=0.5',
             'authorization': f'Bearer {credentials}',
-            'content-type': 'application/json',
-            'dnt': '1',
-            'origin': 'https://chat.ustc.edu.cn',
-            'priority': 'u=1, i',
-            'referer': 'https://chat.ustc.edu.cn/ustchat/',
-            'sec-ch-ua': '"Chromium";v="140", "Not=A?Brand";v="24", "Microsoft Edge";v="140"',
-            'sec-ch-ua-mobile': '?0',
-            'sec-ch-ua-platform': '"Windows"',
-            'sec-fetch-dest': 'empty',
-            'sec-fetch-mode': 'cors',
-            'sec-fetch-site': 'same-origin',
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/140.0.0.0 Safari/537.36 Edg/140.0.0.0',
         }
 
         json_data = {
@@ -68,144 +113,293 @@ class USTC_Base_Model(FkUSTChat_BaseModel):
         }
         if self.allow_tool and len(tools):
             json_data["tools"] = tools
+        if sampling:
+            for name in self.adapter.config.get('sampling_params', ["temperature", "top_p"]):
+                if name in sampling:
+                    json_data[name] = sampling[name]
+        return headers, json_data
+
+    def collect_response(self, lines, max_tokens=None, stop=None):
+        """
+        Collects the upstream SSE lines of a chat into a single chat.completion result.
+
+        Reading stops as soon as the answer is complete, ``max_tokens`` is reached or a stop sequence appears.
+
+        :param lines: An iterable of decoded SSE lines.
+        :return: The chat.completion dict.
+        """
+        collector = self.create_collector(max_tokens, stop)
+        for line in lines:
+            if collector.feed_line(line):
+                break
+        return collector.result()
+
+    async def acollect_response(self, lines, max_tokens=None, stop=None):
+        """
+        Async version of :meth:`collect_response`.
+        """
+        collector = self.create_collector(max_tokens, stop)
+        async for line in lines:
+            if collector.feed_line(line):
+                break
+        return collector.result()
+
+    def open_stream(self, headers, json_data, lease):
+        """
+        Posts the chat request, retrying with the adapter's retry policy until upstream answers 200.
+
+        A 401 or 429 ejects the account from the pool and moves the request to another one.
+
+        :param headers: The request headers.
+        :param json_data: The request body.
+        :param lease: The :class:`FkUSTChat_AccountLease` the request runs on; it is released if this raises.
+        :return: A ``(response, lease)`` tuple with the open streaming response and the account it ran on.
+        :raises FkUSTChat_UpstreamError: If the retries are exhausted or the failure is not retryable.
+        """
+        session = self.adapter.get_session()
+        chat_url = f"{self.adapter.BACKEND_URL}/ms-api/chat-messages"
+        retry = self.adapter.get_retry_policy().start()
+        refreshed = False
+        span = start_span('upstream.request')
+        try:
+            while True:
+                try:
+                    response = session.post(chat_url, headers=headers, json=json_data, stream=True)
+                except requests.RequestException as e:
+                    delay = retry.backoff(None, message=f"Upstream request failed: {e}")
+                else:
+                    if response.status_code == 200:
+                        lease.status = 200
+                        span.set_attribute('account', lease.account.name)
+                        span.set_attribute('attempts', retry.attempt + 1)
+                        span.end()
+                        return response, lease
+                    with response:
+                        if response.status_code == 401 and not refreshed:
+                            refreshed = True
+                            lease = self.switch_account(lease, headers, json_data, 401)
+                            continue
+                        delay = retry.backoff(response.status_code, response.headers.get('Retry-After'), f"Upstream returned {response.status_code}: {response.text[:200]}")
+                        if response.status_code == 429:
+                            lease = self.switch_account(lease, headers, json_data, 429)
+                print(f"Request failed (attempt {retry.attempt}), retrying in {delay:.1f} seconds...")
+                time.sleep(delay)
+        except BaseException as e:
+            span.set_attribute('attempts', retry.attempt + 1)
+            span.end(e)
+            lease.release()
+            raise
+
+    async def aopen_stream(self, client, headers, json_data, lease):
+        """
+        Async version of :meth:`open_stream`.
+        """
+        loop = asyncio.get_running_loop()
+        chat_url = f"{self.adapter.BACKEND_URL}/ms-api/chat-messages"
+        retry = self.adapter.get_retry_policy().start()
+        refreshed = False
+        span = start_span('upstream.request')
+        try:
+            while True:
+                try:
+                    response = await client.send(client.build_request('POST', chat_url, headers=headers, json=json_data), stream=True)
+                except Exception as e:
+                    delay = retry.backoff(None, message=f"Upstream request failed: {e}")
+                else:
+                    if response.status_code == 200:
+                        lease.status = 200
+                        span.set_attribute('account', lease.account.name)
+                        span.set_attribute('attempts', retry.attempt + 1)
+                        span.end()
+                        return response, lease
+                    try:
+                        await response.aread()
+                        if response.status_code == 401 and not refreshed:
+                            refreshed = True
+                            lease = await loop.run_in_executor(None, self.switch_account, lease, headers, json_data, 401)
+                            continue
+                        delay = retry.backoff(response.status_code, response.headers.get('Retry-After'), f"Upstream returned {response.status_code}: {response.text[:200]}")
+                        if response.status_code == 429:
+                            lease = await loop.run_in_executor(None, self.switch_account, lease, headers, json_data, 429)
+                    finally:
+                        await response.aclose()
+                print(f"Request failed (attempt {retry.attempt}), retrying in {delay:.1f} seconds...")
+                await asyncio.sleep(delay)
+        except BaseException as e:
+            span.set_attribute('attempts', retry.attempt + 1)
+            span.end(e)
+            lease.release()
+            raise
+
+    def prepare_request(self, prompt, with_search=False, tools=[], sampling=None):
+        """
+        Leases an account, enters the queue with its token and builds the chat request.
+
+        :return: A ``(headers, json_data, lease)`` tuple.
+        """
+        lease = self.adapter.account_pool.lease()
+        try:
+            with start_span('credentials.get_token', account=lease.account.name):
+                credentials = lease.get_token()
+            with start_span('upstream.enter_queue', account=lease.account.name):
+                queue_code = self.adapter.take_queue_code(lease.account, credentials)
+        except BaseException:
+            lease.release()
+            raise
+        headers, json_data = self.build_request(prompt, credentials, queue_code, with_search, tools, sampling)
+        return headers, json_data, lease
+
+    def get_response(self, prompt, stream=False, with_search=False, tools=[], max_tokens=None, stop=None, sampling=None):
+        headers, json_data, lease = self.prepare_request(prompt, with_search, tools, sampling)
 
         # print(f'[+] Deal with Chat: {prompt}')
 
+        response, lease = self.open_stream(headers, json_data, lease)
         if stream:
             def generate():
-                while True:
-                    with requests.post('https://chat.ustc.edu.cn/ms-api/chat-messages', cookies=cookies, headers=headers, json=json_data, stream=True) as response:
-                        if response.status_code == 200:
-                            for line in response.iter_lines(decode_unicode=True):
-                                # print(line)
-                                if line:
-                                    if line.startswith("data: "):
-                                        line = line[6:]
-                                        yield f"data: {line}\n\n"
-                                    if line == "[DONE]":
-                                        return
-                        else:
-                            print(f"Request failed with status code {response.status_code}, text {response.text}, retrying in 3 seconds...")
-                            time.sleep(3)
-            return generate()
+                with response:
+                    yield from iter_sse_frames(iter_response_bytes(response, self.adapter.config.get('stream_chunk_size', 8192)))
+            return FkUSTChat_SlotIterator(generate(), lease)
         else:
-            while True:
-                with requests.post('https://chat.ustc.edu.cn/ms-api/chat-messages', cookies=cookies, headers=headers, json=json_data, stream=True) as response:
-                    if response.status_code == 200:
-                        answer_id = ""
-                        answer = ""
-                        tool_calls = {}  # 用字典暂存，key=index
-                        final_tool_calls = []  # 最终合并后的结果
-
-                        for line in response.iter_lines(decode_unicode=True):
-                            if not line:
-                                continue
-                            if line.startswith("data: "):
-                                line = line[6:]
-                                if line.strip() == "[DONE]":
-                                    break
-
-                                try:
-                                    data = json.loads(line)
-                                except Exception:
-                                    continue
-
-                                if "id" in data:
-                                    answer_id = data.get("id", "")
-
-                                if data.get("object") != "chat.completion.chunk":
-                                    continue
-
-                                choice = data.get("choices", [{}])[0]
-                                delta = choice.get("delta", {})
-                                finish_reason = choice.get("finish_reason")
-
-                                if "content" in delta:
-                                    answer += delta["content"]
-
-                                if "tool_calls" in delta:
-                                    for tc in delta["tool_calls"]:
-                                        index = tc.get("index", 0)
-                                        # 初始化对应 index 的 tool_call
-                                        if index not in tool_calls:
-                                            tool_calls[index] = {
-                                                "id": tc.get("id"),
-                                                "type": tc.get("type"),
-                                                "function": {
-                                                    "name": tc.get("function", {}).get("name", ""),
-                                                    "arguments": "",
-                                                },
-                                            }
-
-                                        # 累积 arguments
-                                        func = tc.get("function", {})
-                                        if "arguments" in func:
-                                            tool_calls[index]["function"]["arguments"] += func["arguments"]
-
-                                if finish_reason in ("stop", "tool_calls"):
-                                    # 将字典转为按 index 排序的列表
-                                    final_tool_calls = [tool_calls[i] for i in sorted(tool_calls.keys())]
-                                    break
-
-                            elif line.strip() == "[DONE]":
-                                break
-                            
-                        message = {
-                            "role": "assistant",
-                            "content": answer
-                        }
-                        
-                        if final_tool_calls:
-                            message["tool_calls"] = final_tool_calls
-
-                        result = {
-                            "id": answer_id,
-                            "object": "chat.completion",
-                            "created": int(time.time()),
-                            "model": self.name,
-                            "choices": [
-                                {
-                                    "index": 0,
-                                    "message": message,
-                                    "finish_reason": "stop" if not final_tool_calls else "tool_calls"
-                                }
-                            ]
-                        }
-                        # print(result)
-                        return result
-
-                    else:
-                        print(f"Request failed with status code {response.status_code}, text {response.text}, retrying in 3 seconds...")
-                        time.sleep(3)
+            try:
+                # 提前结束时关闭连接，上游不再继续生成，排队额度也更早释放
+                with response:
+                    return self.collect_response(response.iter_lines(), max_tokens, stop)
+            finally:
+                lease.release()
+
+    async def aget_response(self, prompt, stream=False, with_search=False, tools=[], max_tokens=None, stop=None, sampling=None):
+        client = self.adapter.get_async_client()
+        if client is None:
+            return await super().aget_response(prompt, stream=stream, with_search=with_search, tools=tools, max_tokens=max_tokens, stop=stop, sampling=sampling)
+
+        loop = asyncio.get_running_loop()
+        # 在线程池中沿用当前请求的追踪上下文
+        headers, json_data, lease = await loop.run_in_executor(None, contextvars.copy_context().run, self.prepare_request, prompt, with_search, tools, sampling)
+
+        response, lease = await self.aopen_stream(client, headers, json_data, lease)
+        if stream:
+            async def generate():
+                try:
+                    # httpx 的 aiter_bytes(chunk_size) 会攒满 chunk_size 才返回，不指定时收到多少返回多少
+                    async for frame in aiter_sse_frames(response.aiter_bytes()):
+                        yield frame
+                finally:
+                    await response.aclose()
+            return FkUSTChat_AsyncSlotIterator(generate(), lease)
+        else:
+            try:
+                return await self.acollect_response(response.aiter_lines(), max_tokens, stop)
+            finally:
+                lease.release()
+                await response.aclose()
+
+    def switch_account(self, lease, headers, json_data, status):
+        """
+        Reports a 401 or 429 on the request's account and moves the request to another account,
+        updating its token and queue code in place.
+
+        :param lease: The :class:`FkUSTChat_AccountLease` that failed; it is released.
+        :param headers: The request headers, whose authorization is replaced in place.
+        :param json_data: The request body, whose queue_code is replaced in place.
+        :param status: The upstream status.
+        :return: The lease of the account the request continues on.
+        """
+        if status == 401:
+            # 账号暂停期间在后台重新登录
+            lease.account.credential_manager.invalidate(headers['authorization'][len('Bearer '):])
+            lease.account.credential_manager.refresh()
+        lease.release(status)
+        lease = self.adapter.account_pool.lease(exclude=(lease.account,))
+        try:
+            credentials = lease.get_token()
+            headers['authorization'] = f'Bearer {credentials}'
+            json_data['queue_code'] = self.adapter.take_queue_code(lease.account, credentials)
+        except BaseException:
+            lease.release()
+            raise
+        return lease
 
         
 class USTC_DeepSeek_R1_Model(USTC_Base_Model):
     def __init__(self, adapter):
-        super().__init__(adapter, "deepseek", {
-            "name": "USTC_DeepSeek_r1_Model",
-            "show": "USTC Deepseek r1",
-            "description": "USTC DeepSeek-r1 Model for FkUSTChat",
-            "author": "yemaster"
-        })
+        super().__init__(adapter, "deepseek", ADAPTER_MANIFEST["models"]["deepseek-r1"])
 
 class USTC_DeepSeek_V3_Model(USTC_Base_Model):
     def __init__(self, adapter):
-        super().__init__(adapter, "deepseek-v3", {
-            "name": "USTC_DeepSeek_v3_Model",
-            "show": "USTC Deepseek v3",
-            "description": "USTC DeepSeek-r1 Model for FkUSTChat",
-            "author": "yemaster"
-        })
+        super().__init__(adapter, "deepseek-v3", ADAPTER_MANIFEST["models"]["deepseek-v3"])
         self.allow_tool = True
 
 class USTC_FOOL_Model(USTC_Base_Model):
     def __init__(self, adapter):
-        super().__init__(adapter, "whale-23", {
-            "name": "USTC_Fool_Model",
-            "show": "科大模型 (Qwen)",
-            "description": "USTC DeepSeek-r1 Model for FkUSTChat",
-            "author": "yemaster"
-        })
+        super().__init__(adapter, "whale-23", ADAPTER_MANIFEST["models"]["fool"])
+
+
+class USTC_BrowserLogin(FkUSTChat_LoginBackend):
+    def login(self, username, password):
+        """
+        Logs in through the USTC CAS page in a browser and reads the token from the chat page's localStorage.
+
+        Options: ``browser`` and ``headless`` (see :func:`create_webdriver`), ``driver_path``, and
+        ``timeout``, the seconds to wait for the chat page after submitting the form.
+        """
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+
+        headless = self.options.get('headless', False)
+        driver = create_webdriver(self.options.get('browser', 'auto'), headless, self.options.get('driver_path'))
+        try:
+            if not headless:
+                driver.maximize_window()
+
+            driver.get(USTC_LOGIN_URL)
+
+            try:
+                user_input = WebDriverWait(driver, 10).until(
+                    EC.presence_of_element_located((By.XPATH, "//input[@placeholder='请输入学工号/GID']"))
+                )
+                pass_input = driver.find_element(By.XPATH, "//input[@placeholder='请输入密码']")
+
+                if username and password:
+                    user_input.send_keys(username)
+                    pass_input.send_keys(password)
+
+                    login_btn = driver.find_element(By.ID, "submitBtn")
+                    login_btn.click()
+            except Exception as e:
+                return False
+
+            deadline = time.time() + self.options.get('timeout', 30)
+            while time.time() < deadline:
+                time.sleep(1)
+                url = driver.current_url
+                if url.startswith("https://chat.ustc.edu.cn/ustchat"):
+                    # 从 localStorage 获取 token
+                    try:
+                        user_store = driver.execute_script("return JSON.parse(window.localStorage.getItem(\"ustchat-user-store\"));")
+                        state = user_store.get('state', {})
+                        if state.get('isLogin', False):
+                            return state.get('token', '')
+                    except Exception as e:
+                        pass
+            return False
+        finally:
+            driver.quit()
+
+
+class USTC_HeadlessLogin(USTC_BrowserLogin):
+    def __init__(self, adapter, options=None):
+        """
+        The browser login without a window, for servers without a display.
+        """
+        super().__init__(adapter, dict(options or {}, headless=True))
+
+
+USTC_LOGIN_BACKENDS = {
+    "browser": USTC_BrowserLogin,
+    "headless": USTC_HeadlessLogin,
+}
 
 
 class USTC_Adapter(FkUSTChat_BaseAdapter):
@@ -216,13 +410,11 @@ class USTC_Adapter(FkUSTChat_BaseAdapter):
         :param context: The context in which the adapter operates.
         :param adapter_info: Information about the adapter, such as its name and configuration.
         """
-        super().__init__(context, {
-            "name": "USTC_Adapter",
-            "description": "USTC Adapter for FkUSTChat",
-            "author": "yemaster"
-        })
+        super().__init__(context, ADAPTER_MANIFEST)
 
         self.BACKEND_URL = "https://chat.ustc.edu.cn"
+        self.session_headers = USTC_HEADERS
+        self.session_cookies = USTC_COOKIES
 
         self.models = {
             "deepseek-r1": USTC_DeepSeek_R1_Model(self),
@@ -230,6 +422,104 @@ class USTC_Adapter(FkUSTChat_BaseAdapter):
             "fool": USTC_FOOL_Model(self)
         }
 
+        self.account_pool = FkUSTChat_AccountPool()
+        self.queue_pools = {}
+        # (用户名, 密码) -> 账号，重新加载配置时据此复用未变化的账号
+        self.accounts_by_login = {}
+        self.load_accounts()
+
+    def load_config(self, config):
+        super().load_config(config)
+        self.BACKEND_URL = config.get('backend_url', "https://chat.ustc.edu.cn").rstrip('/')
+        self.account_pool.base_ejection = config.get('account_ejection', 30)
+        self.account_pool.max_ejection = config.get('account_max_ejection', 600)
+        self.account_pool.ramp_up = config.get('account_ramp_up', 60)
+        self.load_accounts()
+
+    def get_account_configs(self):
+        """
+        Returns the configs of the accounts: the entries of ``accounts``, or the adapter config itself
+        when only the top-level ``username``/``password``/``credentials`` are set.
+        """
+        return self.config.get('accounts') or [self.config]
+
+    def close(self):
+        for account in self.account_pool.accounts:
+            account.credential_manager.close()
+        for queue_pool in self.queue_pools.values():
+            queue_pool.close()
+
+    def load_accounts(self):
+        """
+        Builds one account with its own credential manager per account config and hands them to the pool.
+
+        Accounts whose username and password did not change are kept with their token, queue codes
+        and health state; only their settings are updated. A changed ``credentials`` value needs
+        nothing here, the credential manager picks it up on the next request.
+        """
+        accounts = []
+        queue_pools = {}
+        accounts_by_login = {}
+        for index, account_config in enumerate(self.get_account_configs()):
+            name = account_config.get('username') or f'account-{index}'
+            login = (name, account_config.get('password'))
+            account = self.accounts_by_login.pop(login, None)
+            if account is None:
+                account = FkUSTChat_Account(name, FkUSTChat_CredentialManager(None, self.is_login, None))
+                # 每个账号预先进入队列的排队码，按 Credential 区分
+                queue_pool = FkUSTChat_WarmPool(
+                    self.enter_queue,
+                    shared=self.get_shared_state(),
+                    name=f'queue:{self.name}:{account.name}'
+                )
+            else:
+                queue_pool = self.queue_pools[account]
+            # 账号在列表中的位置可能变化，按新的位置读取 Credential 和登录
+            credential_manager = account.credential_manager
+            credential_manager.load_token = partial(self.load_credentials, index)
+            credential_manager.login = partial(self.login, index)
+            credential_manager.ttl = self.config.get('credentials_ttl', 300)
+            credential_manager.expiry_margin = self.config.get('credentials_expiry_margin', 60)
+            credential_manager.refresh_ahead = self.config.get('credentials_refresh_ahead', 300)
+            credential_manager.login_timeout = self.config.get('login_timeout', 60)
+            credential_manager.login_retry_delay = self.config.get('login_retry_delay', 30)
+            queue_pool.size = self.config.get('queue_pool_size', 2)
+            queue_pool.max_age = self.config.get('queue_code_ttl', 60)
+            accounts.append(account)
+            queue_pools[account] = queue_pool
+            accounts_by_login[login] = account
+
+        # 删除或改了用户名、密码的账号
+        for account in self.accounts_by_login.values():
+            account.credential_manager.close()
+            self.queue_pools[account].close()
+        self.accounts_by_login = accounts_by_login
+        self.queue_pools = queue_pools
+        self.account_pool.set_accounts(accounts)
+
+    def get_shared_credentials_key(self, index):
+        account_configs = self.get_account_configs()
+        username = account_configs[index].get('username') if index < len(account_configs) else None
+        return f'credentials:{self.name}:{username or index}'
+
+    def load_credentials(self, index):
+        shared = self.get_shared_state()
+        if shared is not None:
+            # 多进程部署时，其他 worker 刚登录得到的 Credential 优先
+            token = shared.get(self.get_shared_credentials_key(index))
+            if token:
+                return token
+        account_configs = self.get_account_configs()
+        return account_configs[index].get('credentials') if index < len(account_configs) else None
+
+    def save_credentials(self, index, token):
+        accounts = self.config.get('accounts')
+        if accounts:
+            accounts[index]['credentials'] = token
+            self.set_config('accounts', accounts)
+        else:
+            self.set_config('credentials', token)
+
     def configure_format(self):
         return {
             "username": {
@@ -246,142 +536,224 @@ class USTC_Adapter(FkUSTChat_BaseAdapter):
                 "type": "string",
                 "description": "自动获取的 Credential，无需手动填写",
                 "required": False
+            },
+            "accounts": {
+                "type": "array",
+                "description": "多个账号，每项包含 username、password（以及自动获取的 credentials）；设置后代替上面的单个账号，请求在账号间负载均衡",
+                "required": False
+            },
+            "sampling_params": {
+                "type": "array",
+                "description": "转发给上游的采样参数，默认 [\"temperature\", \"top_p\"]；上游不接受的参数不要列出",
+                "required": False
+            },
+            "account_ejection": {
+                "type": "integer",
+                "description": "账号返回 401/429 后暂停使用的时间（秒），连续失败时加倍",
+                "required": False
+            },
+            "account_max_ejection": {
+                "type": "integer",
+                "description": "账号暂停使用的最长时间（秒）",
+                "required": False
+            },
+            "account_ramp_up": {
+                "type": "integer",
+                "description": "账号恢复后逐步恢复到完整负载所需的时间（秒）",
+                "required": False
+            },
+            "queue_pool_size": {
+                "type": "integer",
+                "description": "每个账号预先进入队列的排队码数量，0 表示不预取",
+                "required": False
+            },
+            "queue_code_ttl": {
+                "type": "integer",
+                "description": "预取的排队码的有效时间（秒），过期后丢弃",
+                "required": False
+            },
+            "credentials_ttl": {
+                "type": "integer",
+                "description": "Credential 校验结果的缓存时间（秒），过期后在后台重新校验",
+                "required": False
+            },
+            "credentials_expiry_margin": {
+                "type": "integer",
+                "description": "Credential 到期前多少秒停止使用，改为等待重新登录",
+                "required": False
+            },
+            "credentials_refresh_ahead": {
+                "type": "integer",
+                "description": "Credential 到期前多少秒在后台主动重新登录，期间请求继续使用旧的 Credential",
+                "required": False
+            },
+            "login_backend": {
+                "type": "string",
+                "description": "登录方式：browser（浏览器窗口）、headless（无界面浏览器，适用于 Linux 服务器），或 module:Class 形式的自定义登录类",
+                "required": False
+            },
+            "login_browser": {
+                "type": "string",
+                "description": "登录使用的浏览器：auto、edge、chrome、firefox 或 safari",
+                "required": False
+            },
+            "login_driver_path": {
+                "type": "string",
+                "description": "浏览器驱动程序路径，留空则自动查找",
+                "required": False
+            },
+            "login_timeout": {
+                "type": "integer",
+                "description": "请求等待登录完成的最长时间（秒）",
+                "required": False
+            },
+            "login_retry_delay": {
+                "type": "integer",
+                "description": "登录失败后多少秒内不再重试",
+                "required": False
+            },
+            "backend_url": {
+                "type": "string",
+                "description": "USTC Chat 的地址，默认为 https://chat.ustc.edu.cn，压测时可指向 benchmarks/mock_upstream.py",
+                "required": False
+            },
+            "http_pool_maxsize": {
+                "type": "integer",
+                "description": "到 chat.ustc.edu.cn 的最大连接数（连接池大小）",
+                "required": False
+            },
+            "http_pool_block": {
+                "type": "boolean",
+                "description": "连接池满时是否等待空闲连接，而不是新建连接",
+                "required": False
+            },
+            "http_keep_alive": {
+                "type": "boolean",
+                "description": "是否复用 HTTP 连接",
+                "required": False
+            },
+            "retry_max_attempts": {
+                "type": "integer",
+                "description": "上游请求失败时的最大尝试次数",
+                "required": False
+            },
+            "retry_deadline": {
+                "type": "number",
+                "description": "上游请求重试的总时限（秒）",
+                "required": False
+            },
+            "stream_chunk_size": {
+                "type": "integer",
+                "description": "流式转发时每次从上游读取的最大字节数（WSGI 模式）",
+                "required": False
+            },
+            "max_concurrency": {
+                "type": "integer",
+                "description": "同时发往 USTC Chat 的最大请求数，超出的请求排队等待",
+                "required": False
+            },
+            "model_concurrency": {
+                "type": "object",
+                "description": "每个模型的最大并发数，例如 {\"deepseek-r1\": 4}",
+                "required": False
             }
         }
 
 
-    def is_login(self):
-        credentials = self.config.get('credentials', 'none')
+    def is_login(self, credentials=None):
+        if credentials is None:
+            credentials = self.config.get('credentials', 'none')
         check_url = f"{self.BACKEND_URL}/ms-api/search-app"
-        cookies = {
-            '_ga_Q8WSZQS8E1': 'GS2.1.s1757597943$o7$g0$t1757597943$j60$l0$h1338098571',
-            '_ga': 'GA1.1.1970297231.1750309927',
-            '_ga_PG4WGSYP0Y': 'GS2.1.s1758189290$o2$g1$t1758192312$j60$l0$h0',
-            '_ga_HYDB8XD6M6': 'GS2.1.s1758189297$o13$g1$t1758192312$j60$l0$h0',
-        }
                 
         headers = {
             'accept': 'application/json, text/plain, */*',
-            'accept-language': 'zh-CN,zh-TW;q=0.9,zh;q=0.8,en;q=0.7,en-GB;q=0.6,en-US;q=0.5',
             'authorization': f'Bearer {credentials}',
-            'content-type': 'application/json',
-            'dnt': '1',
-            'origin': 'https://chat.ustc.edu.cn',
-            'priority': 'u=1, i',
-            'referer': 'https://chat.ustc.edu.cn/ustchat/',
-            'sec-ch-ua': '"Chromium";v="140", "Not=A?Brand";v="24", "Microsoft Edge";v="140"',
-            'sec-ch-ua-mobile': '?0',
-            'sec-ch-ua-platform': '"Windows"',
-            'sec-fetch-dest': 'empty',
-            'sec-fetch-mode': 'cors',
-            'sec-fetch-site': 'same-origin',
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/140.0.0.0 Safari/537.36 Edg/140.0.0.0',
         }
 
         json_data = {
             'input': '帮我用 Python 解决这道题',
         }
-        response = requests.post(check_url, cookies=cookies, headers=headers, json=json_data)
+        response = self.get_session().post(check_url, headers=headers, json=json_data)
         if response.status_code != 401:
             return True
         return False
 
     def do_login(self, username, password):
-        if sys.platform.startswith('win32'):
+        backend = load_login_backend(self.config.get('login_backend', 'browser'), USTC_LOGIN_BACKENDS, self, {
+            "browser": self.config.get('login_browser', 'auto'),
+            "driver_path": self.config.get('login_driver_path')
+        })
+        return backend.login(username, password)
+
+    def login(self, index=0):
+        account_config = self.get_account_configs()[index]
+        username = account_config.get('username')
+        password = account_config.get('password')
+        if not username or not password or username == 'PB********' or password == 'PASSWORD HERE':
+            if not self.config.get('accounts'):
+                self.set_config('username', 'PB********')
+                self.set_config('password', 'PASSWORD HERE')
+            raise ValueError("USTC Chat 适配器需要你的科大账号和密码才能登录，请在 ./config 文件中编辑")
+        def login_and_save():
+            started_at = time.perf_counter()
             try:
-                edge_driver_path = EdgeChromiumDriverManager().install()
-            except:
-                edge_driver_path = path.join(path.dirname(__file__), "../dependencies/msedgedriver.exe")
-            options = webdriver.EdgeOptions()
-            service = webdriver.EdgeService(executable_path=edge_driver_path)
-            driver = webdriver.Edge(service=service, options=options)
-        elif sys.platform.startswith('darwin'):
-            driver = webdriver.Safari()
-        else:
-            raise SystemError("Unsupported OS.")
-        
-        driver.maximize_window()
-
-        driver.get("https://id.ustc.edu.cn/cas/login?service=https:%2F%2Fchat.ustc.edu.cn%2Fustchat%2F")
+                token = self.do_login(username, password)
+            except BaseException:
+                LOGIN_DURATION.labels(self.name, 'failure').observe(time.perf_counter() - started_at)
+                raise
+            LOGIN_DURATION.labels(self.name, 'success' if token else 'failure').observe(time.perf_counter() - started_at)
+            if token:
+                self.save_credentials(index, token)
+            return token
+
+        shared = self.get_shared_state()
+        if shared is None:
+            return login_and_save()
+        # 同一时间只有一个 worker 登录，其他 worker 等待它的结果
+        return shared.run_once(self.get_shared_credentials_key(index), login_and_save, self.config.get('login_timeout', 60))
+
+    def collect_metrics(self):
+        accounts = self.account_pool.stats()
+        queue_pools = [(account.name, queue_pool.stats()) for account, queue_pool in self.queue_pools.items()]
+        labels = lambda name: {'adapter': self.name, 'account': name}
+        return [
+            ('fkustchat_account_outstanding_requests', 'gauge', 'Requests running on an upstream account.', [(labels(a['name']), a['outstanding']) for a in accounts]),
+            ('fkustchat_account_ejections_total', 'counter', 'Times an upstream account was ejected after 401/429.', [(labels(a['name']), a['ejections']) for a in accounts]),
+            ('fkustchat_account_ejected', 'gauge', '1 while an upstream account is ejected.', [(labels(a['name']), 1 if a['ejected_for'] > 0 else 0) for a in accounts]),
+            ('fkustchat_queue_pool_ready', 'gauge', 'Queue codes ready in the warm pool.', [(labels(name), stats['ready']) for name, stats in queue_pools]),
+            ('fkustchat_queue_pool_hits_total', 'counter', 'Requests served with a pre-entered queue code.', [(labels(name), stats['hits']) for name, stats in queue_pools]),
+            ('fkustchat_queue_pool_misses_total', 'counter', 'Requests that had to enter the queue themselves.', [(labels(name), stats['misses']) for name, stats in queue_pools]),
+        ]
 
+    def get_credentials(self):
+        lease = self.account_pool.lease()
         try:
-            user_input = WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.XPATH, "//input[@placeholder='请输入学工号/GID']"))
-            )
-            pass_input = driver.find_element(By.XPATH, "//input[@placeholder='请输入密码']")
-
-            if username and password:
-                user_input.send_keys(username)
-                pass_input.send_keys(password)
-
-                login_btn = driver.find_element(By.ID, "submitBtn")
-                login_btn.click()
-        except Exception as e:
-            driver.quit()
-            return False
-        
-        tries = 0
-        while True:
-            time.sleep(1)
-            tries += 1
-            if tries > 30:
-                return False
-            url = driver.current_url
-            if url.startswith("https://chat.ustc.edu.cn/ustchat"):
-                # 从 localStorage 获取 token
-                try:
-                    user_store = driver.execute_script("return JSON.parse(window.localStorage.getItem(\"ustchat-user-store\"));")
-                    state = user_store.get('state', {})
-                    is_login = state.get('isLogin', False)
-                    if is_login:
-                        token = state.get('token', '')
-                        self.set_config('credentials', token)
-                        driver.quit()
-                        return token
-                except Exception as e:
-                    pass
+            return lease.get_token()
+        finally:
+            lease.release()
 
-    def get_credentials(self):
-        if not self.is_login():
-            print(self.config)
-            username = self.config.get('username')
-            password = self.config.get('password')
-            print(username, password)
-            if not username or not password or username == 'PB********' or password == 'PASSWORD HERE':
-                self.set_config('username', 'PB********')
-                self.set_config('password', 'PASSWORD HERE')
-                raise ValueError("USTC Chat 适配器需要你的科大账号和密码才能登录，请在 ./config 文件中编辑")
-            credentials = self.do_login(username, password)
-        else:
-            credentials = self.config.get('credentials', 'none')
-        return credentials
+    def invalidate_credentials(self, credentials=None):
+        for account in self.account_pool.accounts:
+            account.credential_manager.invalidate(credentials)
     
-    def enter_queue(self):
-        credentials = self.get_credentials()
+    def take_queue_code(self, account, credentials):
+        """
+        Returns a queue code that already entered the queue with ``credentials``, from the account's warm pool if one is ready.
+        """
+        queue_pool = self.queue_pools.get(account)
+        if queue_pool is None:
+            return self.enter_queue(credentials)
+        return queue_pool.take(credentials)
+
+    def enter_queue(self, credentials=None):
+        if credentials is None:
+            credentials = self.get_credentials()
         
         queue_code = get_random_queue_code()
 
-        cookies = {
-            '_ga_Q8WSZQS8E1': 'GS2.1.s1757597943$o7$g0$t1757597943$j60$l0$h1338098571',
-            '_ga': 'GA1.1.1970297231.1750309927',
-            '_ga_PG4WGSYP0Y': 'GS2.1.s1758189290$o2$g1$t1758192312$j60$l0$h0',
-            '_ga_HYDB8XD6M6': 'GS2.1.s1758189297$o13$g1$t1758192312$j60$l0$h0',
-        }
-
         headers = {
             'accept': 'application/json, text/plain, */*',
-            'accept-language': 'zh-CN,zh-TW;q=0.9,zh;q=0.8,en;q=0.7,en-GB;q=0.6,en-US;q=0.5',
             'authorization': f'Bearer {credentials}',
-            'dnt': '1',
-            'priority': 'u=1, i',
-            'referer': 'https://chat.ustc.edu.cn/ustchat/',
-            'sec-ch-ua': '"Chromium";v="140", "Not=A?Brand";v="24", "Microsoft Edge";v="140"',
-            'sec-ch-ua-mobile': '?0',
-            'sec-ch-ua-platform': '"Windows"',
-            'sec-fetch-dest': 'empty',
-            'sec-fetch-mode': 'cors',
-            'sec-fetch-site': 'same-origin',
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/140.0.0.0 Safari/537.36 Edg/140.0.0.0',
         }
 
         params = {
@@ -389,7 +761,8 @@ class USTC_Adapter(FkUSTChat_BaseAdapter):
         }
 
         queue_url = f"{self.BACKEND_URL}/ms-api/mei-wei-bu-yong-deng"
-        response = requests.get(queue_url, params=params, cookies=cookies, headers=headers)
+        with ENTER_QUEUE_DURATION.labels(self.name).time():
+            response = self.get_session().get(queue_url, params=params, headers=headers)
         # print(f"Enter queue response: {response.status_code}, text: {response.text}")
 
         return queue_code
\ No newline at end of file
@@ -1,12 +1,55 @@
-from flask import Flask, request, jsonify, render_template, Response
+from flask import Flask, request, jsonify, render_template, Response, g
 import sys
-import json
+import time
 
 from libs.core import FkUSTChat_Core
-from libs.adapter_loader import load_adapter 
+from libs.adapter_loader import load_adapters
+from libs.reload import FkUSTChat_Reloader
+from libs.retry import FkUSTChat_UpstreamError
+from libs.chat import FkUSTChat_ChatRequest, FkUSTChat_MessagesRequest, FkUSTChat_RequestError, error_body, anthropic_error_body
+from libs.batch import FkUSTChat_BatchRunner, BATCH_ID
+from libs.metrics import REGISTRY, REQUESTS, REQUEST_DURATION
+from libs.tracing import TRACER, NOOP_SPAN, new_request_id, set_current_span
 
 app = Flask(__name__)
 core = FkUSTChat_Core()
+batch_runner = FkUSTChat_BatchRunner.from_config(core, core.get_core_config().get('batch'))
+
+@app.before_request
+def start_request():
+    g.started_at = time.perf_counter()
+    g.request_id = request.headers.get('X-Request-ID') or new_request_id()
+    g.span = NOOP_SPAN
+    if request.path.startswith('/v1/'):
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        g.span = TRACER.start_trace(f'{request.method} {route}', g.request_id, request.headers.get('traceparent'))
+    set_current_span(g.span)
+
+@app.after_request
+def record_request(response):
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    # 只有校验过的模型名才作为标签，避免任意输入撑大指标
+    model = g.get('model', '')
+    REQUESTS.labels(route, model, str(response.status_code)).inc()
+    REQUEST_DURATION.labels(route, model).observe(time.perf_counter() - g.get('started_at', time.perf_counter()))
+
+    response.headers['X-Request-ID'] = g.get('request_id', '')
+    span = g.get('span', NOOP_SPAN)
+    span.set_attribute('model', model)
+    span.set_attribute('status', response.status_code)
+    if response.is_streamed:
+        # 流式响应在输出结束时才结束整个请求的 span
+        response.call_on_close(span.end)
+    else:
+        span.end()
+    set_current_span(None)
+    return response
+
+@app.teardown_request
+def end_failed_request(error):
+    if error is not None:
+        g.get('span', NOOP_SPAN).end(error)
+        set_current_span(None)
 
 @app.route('/')
 def home():
@@ -49,270 +92,129 @@ def list_models():
         ]
     })
 
+@app.route('/v1/scheduler', methods=['GET'])
+def scheduler_stats():
+    return jsonify(core.scheduler.stats())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/v1/cache', methods=['GET'])
+def cache_stats():
+    if core.response_cache is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(core.response_cache.stats(), enabled=True))
+
+def get_client_id():
+    """
+    Returns the id used to queue the current request fairly: its API key, or the remote address.
+    """
+    auth = request.headers.get('Authorization', '')
+    if auth.startswith('Bearer '):
+        return auth[7:]
+    return request.headers.get('x-api-key') or request.remote_addr
+
 @app.route("/v1/chat/completions", methods=['POST'])
 def chat_completions():
-    data = request.json
-    stream = data.get("stream", False)
-    with_search = data.get("with_search", False)
-    model = data.get("model", "__USTC_Adapter__deepseek-r1")
-    messages = data.get("messages", [])
-    tools = data.get("tools", [])
+    try:
+        chat = FkUSTChat_ChatRequest(core, request.json, request.headers)
+    except FkUSTChat_RequestError as e:
+        return jsonify(e.to_dict()), e.status_code
+    g.model = chat.model
 
-    if model not in core.models:
-        return jsonify({
-            "error": {
-                "message": f"Model '{model}' not found",
-                "type": "invalid_request_error",
-                "param": None,
-                "code": None
-            }
-        }), 400
-    
     try:
-        response = core.models[model].get_response(messages, stream=stream, with_search=with_search, tools=tools)
-        if stream:
-            return Response(response, content_type='text/event-stream')
+        cached = chat.start(get_client_id())
+    except FkUSTChat_RequestError as e:
+        return jsonify(e.to_dict()), e.status_code
+    if cached is not None:
+        if chat.stream:
+            resp = Response(chat.replay(cached), content_type='text/event-stream')
         else:
-            return jsonify(response)
-    except Exception as e:
-        return jsonify({
-            "error": {
-                "message": str(e),
-                "type": "server_error",
-                "param": None,
-                "code": None
-            }
-        }), 500
-
-def claude_to_openai_messages(claude_messages, system=None):
-    openai_msgs = []
-    if system:
-        openai_msgs.append({"role": "system", "content": system})
-    
-    for msg in claude_messages:
-        role = msg["role"]
-        content = msg["content"]
-        
-        if isinstance(content, str):
-            openai_msgs.append({"role": role, "content": content})
-        elif isinstance(content, list):
-            if role == "user":
-                for block in content:
-                    if block["type"] == "text":
-                        openai_msgs.append({"role": "user", "content": block["text"]})
-                    elif block["type"] == "tool_result":
-                        tool_content = block["content"]
-                        if not isinstance(tool_content, str):
-                            tool_content = json.dumps(tool_content)
-                        openai_msgs.append({
-                            "role": "tool",
-                            "content": tool_content,
-                            "tool_call_id": block["tool_use_id"]
-                        })
-            elif role == "assistant":
-                asst_content = ""
-                tool_calls = []
-                for block in content:
-                    if block["type"] == "text":
-                        asst_content += block["text"]
-                    elif block["type"] == "tool_use":
-                        tool_calls.append({
-                            "id": block["id"],
-                            "type": "function",
-                            "function": {
-                                "name": block["name"],
-                                "arguments": json.dumps(block["input"])
-                            }
-                        })
-                openai_msg = {"role": "assistant"}
-                if asst_content:
-                    openai_msg["content"] = asst_content
-                if tool_calls:
-                    openai_msg["tool_calls"] = tool_calls
-                openai_msgs.append(openai_msg)
-    
-    return openai_msgs
+            resp = jsonify(chat.finish(cached))
+        resp.headers.extend(chat.response_headers())
+        return resp
 
-def claude_to_openai_tools(claude_tools):
-    openai_tools = []
-    for tool in claude_tools:
-        openai_tools.append({
-            "type": "function",
-            "function": {
-                "name": tool["name"],
-                "description": tool.get("description", ""),
-                "parameters": tool.get("input_schema", {})
-            }
-        })
-    return openai_tools
+    try:
+        response = chat.get_responses(get_client_id())
+        if chat.stream:
+            resp = Response(chat.wrap_stream(response), content_type='text/event-stream')
+        else:
+            resp = jsonify(chat.finish(response))
+        resp.headers.extend(chat.response_headers())
+        return resp
+    except FkUSTChat_UpstreamError as e:
+        return jsonify(e.to_dict()), e.status_code
+    except Exception as e:
+        return jsonify(error_body(str(e), "server_error")), 500
+
+@app.route("/v1/conversations/<conversation_id>", methods=['GET', 'DELETE'])
+def conversation(conversation_id):
+    # 只能访问用同一个客户端 ID 创建的对话
+    if core.conversations is None:
+        messages = None
+    else:
+        key = core.conversations.scoped_id(get_client_id(), conversation_id)
+        if request.method == 'DELETE':
+            messages = [] if core.conversations.delete(key) else None
+        else:
+            messages = core.conversations.get(key)
+    if messages is None:
+        return jsonify(error_body(f"Conversation '{conversation_id}' not found", param="conversation_id", code="conversation_not_found")), 404
+    if request.method == 'DELETE':
+        return jsonify({"id": conversation_id, "object": "conversation.deleted", "deleted": True})
+    return jsonify({"id": conversation_id, "object": "conversation", "messages": messages})
+
+@app.route("/v1/batch/chat/completions", methods=['POST'])
+def batch_chat_completions():
+    batch_id = request.args.get('batch_id') or request.headers.get('X-FkUSTChat-Batch-Id') or batch_runner.new_batch_id()
+    if not BATCH_ID.match(batch_id):
+        return jsonify(error_body("batch_id may only contain letters, digits, '_' and '-', at most 64 characters", param="batch_id")), 400
+    try:
+        items = batch_runner.parse(request.get_data())
+    except UnicodeDecodeError:
+        items = None
+    if not items or len(items) > batch_runner.max_requests:
+        return jsonify(error_body(f"The batch must be UTF-8 JSONL with 1 to {batch_runner.max_requests} requests")), 400
+    try:
+        results = batch_runner.run(batch_id, items)
+    except ValueError as e:
+        return jsonify(error_body(str(e), param="batch_id")), 409
+    resp = Response(results, content_type='application/x-ndjson')
+    resp.headers['X-FkUSTChat-Batch-Id'] = batch_id
+    return resp
 
 @app.route("/v1/messages", methods=['POST'])
 def messages():
-    data = request.json
-    model = data.get("model")
-    if not model:
-        return jsonify({
-            "type": "error",
-            "error": {
-                "type": "invalid_request_error",
-                "message": "model is required"
-            }
-        }), 400
-    if model not in core.models:
-        for model_txt in core.models:
-            if model_txt.lower() == model.lower():
-                model = model_txt
-                break
-        else:
-            return jsonify({
-                "type": "error",
-                "error": {
-                    "type": "invalid_request_error",
-                    "message": f"Model '{model}' not found"
-                }
-            }), 400
-
-    claude_messages = data.get("messages")
-    if not claude_messages:
-        return jsonify({
-            "type": "error",
-            "error": {
-                "type": "invalid_request_error",
-                "message": "messages is required"
-            }
-        }), 400
-
-    max_tokens = data.get("max_tokens")
-    if max_tokens is None:
-        return jsonify({
-            "type": "error",
-            "error": {
-                "type": "invalid_request_error",
-                "message": "max_tokens is required"
-            }
-        }), 400
-
-    stream = data.get("stream", False)
-    with_search = data.get("with_search", False)
-    claude_tools = data.get("tools", [])
-    system = data.get("system", None)
-
-    openai_messages = claude_to_openai_messages(claude_messages, system)
-    openai_tools = claude_to_openai_tools(claude_tools)
-
     try:
-        openai_response = core.models[model].get_response(openai_messages, stream=stream, with_search=with_search, tools=openai_tools)
-
-        if stream:
-            def transform_stream(openai_stream):
-                yield 'event: message_start\n'
-                yield f'data: {{"type":"message_start", "message":{{"id":"msg_1", "type":"message", "role":"assistant", "content":[], "model":"{model}", "stop_reason":null, "stop_sequence":null, "usage":{{"input_tokens":0, "output_tokens":0}}}}}}\n\n'
-
-                content_index = 0
-                tool_indices = {}
-                is_text = False
-                full_output_tokens = 0
-                stop_reason = None
-                partial_inputs = {}
+        message_request = FkUSTChat_MessagesRequest(core, request.json)
+    except FkUSTChat_RequestError as e:
+        return jsonify(e.to_anthropic_dict()), e.status_code
+    g.model = message_request.model
 
-                for line in openai_stream:
-                    if line.startswith('data: '):
-                        chunk_str = line[6:].strip()
-                        if chunk_str == '[DONE]':
-                            break
-                        try:
-                            chunk = json.loads(chunk_str)
-                        except json.JSONDecodeError:
-                            continue
-                        if "choices" in chunk and chunk["choices"]:
-                            delta = chunk["choices"][0]["delta"]
-                            if "content" in delta and delta["content"] is not None:
-                                text = delta["content"]
-                                if not is_text:
-                                    is_text = True
-                                    yield 'event: content_block_start\n'
-                                    yield f'data: {{"type":"content_block_start", "index":{content_index}, "content_block":{{"type":"text", "text":""}}}}\n\n'
-                                    content_index += 1
-                                yield 'event: content_block_delta\n'
-                                yield f'data: {{"type":"content_block_delta", "index":{content_index-1}, "delta":{{"type":"text_delta", "text":{json.dumps(text)}}}}}\n\n'
-                                full_output_tokens += len(text.split())
-                            if "tool_calls" in delta and delta["tool_calls"]:
-                                for tc_delta in delta["tool_calls"]:
-                                    idx = tc_delta["index"]
-                                    if idx not in tool_indices:
-                                        tool_indices[idx] = content_index
-                                        partial_inputs[idx] = ""
-                                        content_index += 1
-                                        tc_id = tc_delta.get("id", f"toolu_{idx}")
-                                        fn = tc_delta.get("function", {})
-                                        name = fn.get("name", "unknown")
-                                        yield 'event: content_block_start\n'
-                                        yield f'data: {{"type":"content_block_start", "index":{tool_indices[idx]}, "content_block":{{"type":"tool_use", "id":"{tc_id}", "name":"{name}", "input":{{}}}}}}\n\n'
-                                    fn = tc_delta.get("function", {})
-                                    if "arguments" in fn and fn["arguments"]:
-                                        arg_chunk = fn["arguments"]
-                                        partial_inputs[idx] += arg_chunk
-                                        yield 'event: content_block_delta\n'
-                                        yield f'data: {{"type":"content_block_delta", "index":{tool_indices[idx]}, "delta":{{"type":"input_json_delta", "partial_json":{json.dumps(arg_chunk)}}}}}\n\n'
-                                        full_output_tokens += len(arg_chunk.split())
-                            if "finish_reason" in chunk["choices"][0] and chunk["choices"][0]["finish_reason"]:
-                                stop_reason = chunk["choices"][0]["finish_reason"]
-
-                for i in range(content_index):
-                    yield 'event: content_block_stop\n'
-                    yield f'data: {{"type":"content_block_stop", "index":{i}}}\n\n'
-
-                claude_stop_reason = "end_turn" if stop_reason == "stop" else "tool_use" if stop_reason == "tool_calls" else stop_reason or "end_turn"
-                yield 'event: message_delta\n'
-                yield f'data: {{"type":"message_delta", "delta":{{"stop_reason":"{claude_stop_reason}", "stop_sequence":null}}, "usage":{{"output_tokens":{full_output_tokens}}}}}\n\n'
-
-                yield 'event: message_stop\n'
-                yield 'data: {"type":"message_stop"}\n\n'
-
-            return Response(transform_stream(openai_response), content_type='text/event-stream')
-        else:
-            choice = openai_response["choices"][0]
-            message = choice["message"]
-            claude_content = []
-            if "content" in message and message["content"]:
-                claude_content.append({"type": "text", "text": message["content"]})
-            if "tool_calls" in message:
-                for tc in message["tool_calls"]:
-                    fn = tc["function"]
-                    input_dict = json.loads(fn["arguments"])
-                    claude_content.append({
-                        "type": "tool_use",
-                        "id": tc["id"],
-                        "name": fn["name"],
-                        "input": input_dict
-                    })
-            stop_reason = "end_turn" if choice["finish_reason"] == "stop" else "tool_use" if choice["finish_reason"] == "tool_calls" else choice["finish_reason"]
-            claude_resp = {
-                "id": openai_response.get("id", "msg_1"),
-                "type": "message",
-                "role": "assistant",
-                "model": openai_response["model"],
-                "content": claude_content,
-                "stop_reason": stop_reason,
-                "stop_sequence": None,
-                "usage": openai_response.get("usage", {"input_tokens": 0, "output_tokens": 0})
-            }
-            return jsonify(claude_resp)
+    try:
+        message_request.start()
+        openai_response = message_request.get_response(get_client_id())
+        if message_request.stream:
+            return Response(message_request.create_transcoder().transcode(openai_response), content_type='text/event-stream')
+        return jsonify(message_request.to_message(openai_response))
+    except FkUSTChat_RequestError as e:
+        return jsonify(e.to_anthropic_dict()), e.status_code
+    except FkUSTChat_UpstreamError as e:
+        return jsonify(anthropic_error_body(e.message, e.error_type)), e.status_code
     except Exception as e:
-        return jsonify({
-            "type": "error",
-            "error": {
-                "type": "server_error",
-                "message": str(e)
-            }
-        }), 500
+        return jsonify(anthropic_error_body(str(e), "server_error")), 500
 
 
 if __name__ == '__main__':
-    print(load_adapter(core, 'ustc'))
+    print(load_adapters(core, preload=core.get_core_config().get('preload_adapters', False)))
+    reloader = FkUSTChat_Reloader.from_config(core, core.get_core_config().get('hot_reload'))
+    if reloader is not None:
+        reloader.start()
     if len(sys.argv) > 0:
         try:
             port = int(sys.argv[1])
         except Exception as e:
             port = 5000
-    app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
+    # 调试模式会开启 Werkzeug 调试器并在出错时显示源码，只应在本机开发时打开
+    app.run(host='0.0.0.0', port=port, debug=core.get_core_config().get('debug', False))
\ No newline at end of file
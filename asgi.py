@@ -0,0 +1,206 @@
+import asyncio
+import json
+import sys
+import time
+
+from app import app, core
+from libs.adapter_loader import load_adapters
+from libs.reload import FkUSTChat_Reloader
+from libs.aio import FkUSTChat_WSGIBridge, read_body, wait_disconnect
+from libs.retry import FkUSTChat_UpstreamError
+from libs.chat import FkUSTChat_ChatRequest, FkUSTChat_MessagesRequest, FkUSTChat_RequestError, error_body, anthropic_error_body
+from libs.metrics import REQUESTS, REQUEST_DURATION
+from libs.tracing import TRACER, new_request_id, set_current_span
+
+wsgi_app = FkUSTChat_WSGIBridge(app, threads=core.get_core_config().get('bridge_threads', 16))
+
+
+def get_headers(scope):
+    return {name.decode('latin1'): value.decode('latin1') for name, value in scope.get('headers', [])}
+
+
+async def send_json(send, payload, status=200, headers=()):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()), *headers]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def stream_sse(receive, send, chunks, headers=()):
+    """
+    Sends an async iterator of SSE chunks, stopping the upstream read if the client goes away.
+    """
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'), *headers]
+    })
+
+    async def pump():
+        async for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+    pump_task = asyncio.ensure_future(pump())
+    disconnect_task = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        await asyncio.wait([pump_task, disconnect_task], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnect_task.cancel()
+        if not pump_task.done():
+            pump_task.cancel()
+            await asyncio.gather(pump_task, return_exceptions=True)
+        aclose = getattr(chunks, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+    if pump_task.done() and not pump_task.cancelled():
+        pump_task.result()
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def get_client_id(scope, headers):
+    auth = headers.get('authorization', '')
+    if auth.startswith('Bearer '):
+        return auth[7:]
+    return headers.get('x-api-key') or (scope.get('client') or ('',))[0]
+
+
+async def iterate(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def encode_headers(headers):
+    return [(name.lower().encode('latin1'), value.encode('utf-8')) for name, value in headers]
+
+
+async def chat_completions(scope, receive, send):
+    try:
+        data = json.loads(await read_body(receive))
+    except ValueError:
+        return await send_json(send, error_body("Request body must be valid JSON"), 400)
+    headers = get_headers(scope)
+    try:
+        chat = FkUSTChat_ChatRequest(core, data, headers)
+    except FkUSTChat_RequestError as e:
+        return await send_json(send, e.to_dict(), e.status_code)
+    scope.setdefault('state', {})['model'] = chat.model
+
+    try:
+        cached = chat.start(get_client_id(scope, headers))
+    except FkUSTChat_RequestError as e:
+        return await send_json(send, e.to_dict(), e.status_code)
+    if cached is not None:
+        if chat.stream:
+            return await stream_sse(receive, send, iterate(chat.replay(cached)), encode_headers(chat.response_headers()))
+        return await send_json(send, chat.finish(cached), headers=encode_headers(chat.response_headers()))
+
+    try:
+        response = await chat.aget_responses(get_client_id(scope, headers))
+    except FkUSTChat_UpstreamError as e:
+        return await send_json(send, e.to_dict(), e.status_code)
+    except Exception as e:
+        return await send_json(send, error_body(str(e), "server_error"), 500)
+    if chat.stream:
+        await stream_sse(receive, send, chat.awrap_stream(response), encode_headers(chat.response_headers()))
+    else:
+        await send_json(send, chat.finish(response), headers=encode_headers(chat.response_headers()))
+
+
+async def messages(scope, receive, send):
+    try:
+        data = json.loads(await read_body(receive))
+    except ValueError:
+        return await send_json(send, anthropic_error_body("Request body must be valid JSON"), 400)
+    try:
+        message_request = FkUSTChat_MessagesRequest(core, data)
+    except FkUSTChat_RequestError as e:
+        return await send_json(send, e.to_anthropic_dict(), e.status_code)
+    scope.setdefault('state', {})['model'] = message_request.model
+
+    try:
+        message_request.start()
+        openai_response = await message_request.aget_response(get_client_id(scope, get_headers(scope)))
+        if not message_request.stream:
+            body = message_request.to_message(openai_response)
+    except FkUSTChat_RequestError as e:
+        return await send_json(send, e.to_anthropic_dict(), e.status_code)
+    except FkUSTChat_UpstreamError as e:
+        return await send_json(send, anthropic_error_body(e.message, e.error_type), e.status_code)
+    except Exception as e:
+        return await send_json(send, anthropic_error_body(str(e), "server_error"), 500)
+    if message_request.stream:
+        await stream_sse(receive, send, message_request.create_transcoder().atranscode(openai_response))
+    else:
+        await send_json(send, body)
+
+
+# 在事件循环中直接处理的路由，其余路由经线程池交给 Flask
+NATIVE_ROUTES = {
+    '/v1/chat/completions': chat_completions,
+    '/v1/messages': messages,
+}
+
+
+async def application(scope, receive, send):
+    """
+    ASGI entry point. Chat completions and Anthropic messages are served natively on the event
+    loop, every other route is handed to the Flask app through the thread-pool bridge.
+    """
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+    route = scope['path']
+    handler = NATIVE_ROUTES.get(route) if scope['method'] == 'POST' else None
+    if handler is not None:
+        started_at = time.perf_counter()
+        headers = get_headers(scope)
+        request_id = headers.get('x-request-id') or new_request_id()
+        span = TRACER.start_trace(f'POST {route}', request_id, headers.get('traceparent'))
+        # 每个请求运行在自己的 task 中，追踪上下文不会串到其他请求
+        set_current_span(span)
+
+        async def send_with_metrics(message):
+            if message['type'] == 'http.response.start':
+                model = scope.get('state', {}).get('model', '')
+                REQUESTS.labels(route, model, str(message['status'])).inc()
+                REQUEST_DURATION.labels(route, model).observe(time.perf_counter() - started_at)
+                span.set_attribute('model', model)
+                span.set_attribute('status', message['status'])
+                message = dict(message, headers=[*message.get('headers', []), (b'x-request-id', request_id.encode('latin1'))])
+            await send(message)
+
+        try:
+            return await handler(scope, receive, send_with_metrics)
+        except BaseException as e:
+            span.end(e)
+            raise
+        finally:
+            span.end()
+    return await wsgi_app(scope, receive, send)
+
+
+load_adapters(core, preload=core.get_core_config().get('preload_adapters', False))
+reloader = FkUSTChat_Reloader.from_config(core, core.get_core_config().get('hot_reload'))
+if reloader is not None:
+    reloader.start()
+
+if __name__ == '__main__':
+    import uvicorn # pip install uvicorn httpx
+
+    try:
+        port = int(sys.argv[1])
+    except Exception as e:
+        port = 5000
+    uvicorn.run(application, host='0.0.0.0', port=port)
@@ -0,0 +1,273 @@
+"""
+Load test of the gateway: sends chat requests at a fixed concurrency and reports throughput,
+time to first token and latency percentiles.
+
+Against a running gateway:
+
+    python benchmarks/bench_load.py --url http://127.0.0.1:5000 --route chat --concurrency 32 --requests 500
+
+Fully offline: ``--spawn`` starts benchmarks/mock_upstream.py and a gateway whose USTC adapter points at it,
+using a temporary config, runs the load and stops both. The mock options (``--latency``, ``--token-rate``,
+``--tokens``, ``--error-rate``, ``--tool-call-rate`` ...) are passed through:
+
+    python benchmarks/bench_load.py --spawn --server asgi --concurrency 64 --requests 1000 --latency 0.2 --token-rate 100
+
+``--route`` selects ``/v1/chat/completions`` (chat) or ``/v1/messages`` (messages); ``--no-stream`` sends
+non-streaming requests, whose time to first token is their full latency. Every request has a distinct prompt
+so it reaches the upstream; ``--same-prompt`` sends identical requests to measure the response cache and
+single-flight instead.
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+import requests
+
+sys.path.insert(0, path.dirname(__file__))
+
+from mock_upstream import add_arguments
+
+ROOT = path.join(path.dirname(path.abspath(__file__)), '..')
+SERVERS = {
+    "asgi": lambda port, workers: [sys.executable, 'asgi.py', str(port)],
+    "wsgi": lambda port, workers: [sys.executable, 'app.py', str(port)],
+    "serve": lambda port, workers: [sys.executable, 'serve.py', str(port), str(workers)]
+}
+
+
+def build_body(args, number):
+    prompt = args.prompt if args.same_prompt else f'{args.prompt} ({number})'
+    messages = [{"role": "user", "content": prompt}]
+    body = {"model": args.model, "messages": messages, "stream": not args.no_stream}
+    if args.max_tokens is not None or args.route == 'messages':
+        body["max_tokens"] = args.max_tokens or 1024
+    if args.route == 'messages':
+        if args.tools:
+            body["tools"] = [{"name": "search", "description": "Searches the web.", "input_schema": {"type": "object", "properties": {"query": {"type": "string"}}}}]
+    elif args.tools:
+        body["tools"] = [{"type": "function", "function": {"name": "search", "description": "Searches the web.", "parameters": {"type": "object", "properties": {"query": {"type": "string"}}}}}]
+    return body
+
+
+def is_token_event(route, payload):
+    """
+    Whether an SSE data payload carries generated content, i.e. counts for time to first token.
+    """
+    if route == 'messages':
+        return payload.get('type') == 'content_block_delta'
+    choices = payload.get('choices') or [{}]
+    delta = choices[0].get('delta') or {}
+    return bool(delta.get('content') or delta.get('reasoning_content') or delta.get('tool_calls'))
+
+
+def send_request(session, url, body, route, timeout):
+    """
+    :return: ``(ok, time to first token, latency, tokens, error)``, times in seconds.
+    """
+    started_at = time.perf_counter()
+    first_token_at = None
+    tokens = 0
+    try:
+        with session.post(url, json=body, stream=body["stream"], timeout=timeout) as response:
+            if response.status_code != 200:
+                return False, None, time.perf_counter() - started_at, 0, f'HTTP {response.status_code}'
+            if not body["stream"]:
+                response.json()
+                latency = time.perf_counter() - started_at
+                return True, latency, latency, 0, None
+            for line in response.iter_lines():
+                if not line.startswith(b'data:'):
+                    continue
+                data = line[5:].strip()
+                if data == b'[DONE]':
+                    break
+                payload = json.loads(data)
+                if payload.get('type') == 'error' or 'error' in payload:
+                    return False, None, time.perf_counter() - started_at, tokens, 'stream error'
+                if is_token_event(route, payload):
+                    tokens += 1
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+    except Exception as e:
+        return False, None, time.perf_counter() - started_at, tokens, type(e).__name__
+    finished_at = time.perf_counter()
+    return True, (first_token_at or finished_at) - started_at, finished_at - started_at, tokens, None
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def run_load(args):
+    url = args.url.rstrip('/') + ('/v1/messages' if args.route == 'messages' else '/v1/chat/completions')
+    local = threading.local()
+    results = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration if args.duration else None
+    sent = [0]
+
+    def take():
+        with lock:
+            if deadline is not None and time.perf_counter() >= deadline or deadline is None and sent[0] >= args.requests:
+                return None
+            sent[0] += 1
+            return sent[0]
+
+    def worker():
+        # 每个并发使用自己的连接，模拟独立的客户端
+        local.session = requests.Session()
+        while (number := take()) is not None:
+            result = send_request(local.session, url, build_body(args, f'{args.run}-{number}'), args.route, args.timeout)
+            with lock:
+                results.append(result)
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(args.concurrency)]:
+            future.result()
+    elapsed = time.perf_counter() - started_at
+    return results, elapsed
+
+
+def report(args, results, elapsed):
+    succeeded = [r for r in results if r[0]]
+    errors = {}
+    for r in results:
+        if not r[0]:
+            errors[r[4]] = errors.get(r[4], 0) + 1
+    ttft = [r[1] for r in succeeded]
+    latency = [r[2] for r in succeeded]
+    tokens = sum(r[3] for r in succeeded)
+
+    print(f"{args.route} stream={not args.no_stream} concurrency={args.concurrency}: "
+          f"{len(results)} requests in {elapsed:.2f}s, {len(succeeded)} ok, {len(results) - len(succeeded)} failed")
+    print(f"  throughput  {len(succeeded) / elapsed:8.2f} req/s  {tokens / elapsed:10.1f} tokens/s")
+    for name, values in (("ttft", ttft), ("latency", latency)):
+        print(f"  {name:<10}  p50 {percentile(values, 0.5) * 1000:8.1f}ms  p90 {percentile(values, 0.9) * 1000:8.1f}ms  "
+              f"p99 {percentile(values, 0.99) * 1000:8.1f}ms  max {max(values, default=float('nan')) * 1000:8.1f}ms")
+    for error, count in sorted(errors.items(), key=lambda item: -item[1]):
+        print(f"  error       {error}: {count}")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_ready(url, process, timeout=60):
+    started_at = time.time()
+    while time.time() - started_at < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f'{url} exited with {process.returncode}')
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f'{url} did not start within {timeout}s')
+
+
+def spawn(args, workdir):
+    """
+    Starts the mock upstream and a gateway configured to use it.
+
+    :return: The started processes.
+    """
+    mock_port, gateway_port = free_port(), free_port()
+    mock_command = [sys.executable, path.join(ROOT, 'benchmarks', 'mock_upstream.py'), '--port', str(mock_port),
+                    '--latency', str(args.latency), '--token-rate', str(args.token_rate), '--tokens', str(args.tokens),
+                    '--queue-latency', str(args.queue_latency), '--error-rate', str(args.error_rate),
+                    '--error-status', str(args.error_status), '--tool-call-rate', str(args.tool_call_rate),
+                    '--invalid-tokens', *args.invalid_tokens]
+    if args.retry_after is not None:
+        mock_command += ['--retry-after', str(args.retry_after)]
+    if args.require_queue:
+        mock_command.append('--require-queue')
+
+    # 临时 config：每个账号直接使用一个 mock 接受的 Credential，不需要登录
+    config = {
+        "USTC_Adapter": {
+            "backend_url": f"http://127.0.0.1:{mock_port}",
+            "accounts": [{"username": f"bench-{i}", "password": "bench", "credentials": f"bench-token-{i}"} for i in range(args.accounts)],
+            "max_concurrency": args.concurrency * 2
+        },
+        "FkUSTChat_Core": {}
+    }
+    if args.server == 'serve':
+        config["FkUSTChat_Core"]["shared_state"] = {"path": path.join(workdir, 'shared_state.db')}
+    config_file = path.join(workdir, 'config')
+    with open(config_file, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=4)
+
+    env = dict(os.environ, FKUSTCHAT_CONFIG=config_file)
+    output = None if args.verbose else subprocess.DEVNULL
+    processes = [subprocess.Popen(mock_command, stdout=output, stderr=output)]
+    processes.append(subprocess.Popen(SERVERS[args.server](gateway_port, args.workers), cwd=ROOT, env=env, stdout=output, stderr=output))
+    wait_until_ready(f"http://127.0.0.1:{mock_port}/stats", processes[0])
+    wait_until_ready(f"http://127.0.0.1:{gateway_port}/v1/models", processes[1])
+    args.url = f"http://127.0.0.1:{gateway_port}"
+    args.mock_url = f"http://127.0.0.1:{mock_port}"
+    return processes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='gateway URL, ignored with --spawn')
+    parser.add_argument('--route', choices=('chat', 'messages'), default='chat')
+    parser.add_argument('--model', default='__USTC_Adapter__deepseek-v3')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=200, help='requests in total')
+    parser.add_argument('--duration', type=float, default=None, help='run for this many seconds instead of --requests')
+    parser.add_argument('--no-stream', action='store_true')
+    parser.add_argument('--tools', action='store_true', help='send a tool definition with every request')
+    parser.add_argument('--max-tokens', type=int, default=None, help='max_tokens of every request, 1024 for messages if unset')
+    parser.add_argument('--prompt', default='Write a short story about a robot learning to paint.')
+    parser.add_argument('--same-prompt', action='store_true', help='send identical requests, which the gateway may serve from its cache')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--warmup', type=int, default=None, help='requests sent before measuring, default one per concurrent client')
+    spawn_group = parser.add_argument_group('--spawn', 'start a mock upstream and a gateway for the run')
+    spawn_group.add_argument('--spawn', action='store_true')
+    spawn_group.add_argument('--server', choices=tuple(SERVERS), default='asgi')
+    spawn_group.add_argument('--workers', type=int, default=2, help='worker processes of --server serve')
+    spawn_group.add_argument('--accounts', type=int, default=1, help='mock accounts configured')
+    spawn_group.add_argument('--verbose', action='store_true', help='show the output of the spawned processes')
+    add_arguments(spawn_group)
+    args = parser.parse_args()
+
+    processes = []
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            if args.spawn:
+                processes = spawn(args, workdir)
+            requests_wanted, duration = args.requests, args.duration
+            args.requests, args.duration, args.run = args.concurrency if args.warmup is None else args.warmup, None, 'warmup'
+            if args.requests:
+                run_load(args)
+            args.requests, args.duration, args.run = requests_wanted, duration, time.time_ns()
+            report(args, *run_load(args))
+            if args.spawn:
+                print(f"  upstream    {requests.get(args.mock_url + '/stats').json()}")
+        finally:
+            for process in reversed(processes):
+                process.terminate()
+            for process in processes:
+                try:
+                    process.wait(10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+
+if __name__ == '__main__':
+    main()
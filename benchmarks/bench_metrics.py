@@ -0,0 +1,35 @@
+"""
+Micro-benchmark of the per-chunk cost of stream instrumentation.
+
+Iterates a synthetic stream of SSE chunks once directly and once through FkUSTChat_MeteredStream
+and reports the added cost per chunk.
+
+    python benchmarks/bench_metrics.py [chunks]
+"""
+import sys
+import time
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..'))
+
+from libs.metrics import FkUSTChat_MeteredStream
+
+
+def consume(stream):
+    start = time.perf_counter()
+    for _ in stream:
+        pass
+    return time.perf_counter() - start
+
+
+def main():
+    chunks = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    stream = [b'data: {"choices":[{"delta":{"content":"hi"}}]}\n\n'] * chunks
+    plain = consume(iter(stream))
+    metered = consume(FkUSTChat_MeteredStream(iter(stream), "bench", time.perf_counter()))
+    print(f"{chunks} chunks: plain {plain:.3f}s, metered {metered:.3f}s")
+    print(f"overhead {(metered - plain) / chunks * 1e9:.0f} ns/chunk")
+
+
+if __name__ == '__main__':
+    main()
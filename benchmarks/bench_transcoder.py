@@ -0,0 +1,48 @@
+"""
+Micro-benchmark of the /v1/messages stream transcoder.
+
+Feeds a synthetic OpenAI chunk stream (many tiny text deltas followed by a tool call) through
+FkUSTChat_AnthropicTranscoder and reports the frames converted per second.
+
+    python benchmarks/bench_transcoder.py [frames]
+"""
+import json
+import sys
+import time
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..'))
+
+from libs.anthropic_stream import FkUSTChat_AnthropicTranscoder
+from libs.json_codec import orjson
+
+
+def build_stream(frames, batch=32):
+    def chunk(delta, finish_reason=None):
+        payload = {"id": "chatcmpl-1", "object": "chat.completion.chunk", "created": 0, "model": "m",
+                   "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8')
+
+    events = [chunk({"content": "你好, \"world\" "}) for _ in range(frames)]
+    events.append(chunk({"tool_calls": [{"index": 0, "id": "call_1", "function": {"name": "get_weather", "arguments": ""}}]}))
+    events.extend(chunk({"tool_calls": [{"index": 0, "function": {"arguments": '{"city":'}}]}) for _ in range(8))
+    events.append(chunk({}, "tool_calls"))
+    events.append(b"data: [DONE]\n\n")
+    # 模拟上游一次读取携带多个帧
+    return [b''.join(events[i:i + batch]) for i in range(0, len(events), batch)]
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    stream = build_stream(frames)
+    start = time.perf_counter()
+    size = 0
+    for out in FkUSTChat_AnthropicTranscoder("m").transcode(iter(stream)):
+        size += len(out)
+    elapsed = time.perf_counter() - start
+    print(f"json backend: {'orjson' if orjson is not None else 'json'}")
+    print(f"{frames} frames in {elapsed:.3f}s, {frames / elapsed:,.0f} frames/s, {size / elapsed / 1e6:.1f} MB/s out")
+
+
+if __name__ == '__main__':
+    main()
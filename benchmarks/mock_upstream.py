@@ -0,0 +1,205 @@
+"""
+A local stand-in for the chat.ustc.edu.cn endpoints used by the USTC adapter, for tests and load tests.
+
+    python benchmarks/mock_upstream.py --port 8900 --latency 0.2 --token-rate 50 --tokens 100
+
+Point the adapter at it with ``"backend_url": "http://127.0.0.1:8900"`` in its config. Every token
+is accepted unless it is listed in ``--invalid-tokens``. Served endpoints:
+
+- ``POST /ms-api/search-app``: the login probe, 401 for invalid tokens.
+- ``GET /ms-api/mei-wei-bu-yong-deng``: enters a queue code, after ``--queue-latency`` seconds.
+- ``POST /ms-api/chat-messages``: streams ``chat.completion.chunk`` SSE events at ``--token-rate``,
+  or a tool call when the request has tools and the ``--tool-call-rate`` draw hits. ``--error-rate``
+  of the requests fail with ``--error-status`` instead.
+- ``GET /stats``: request counters; ``cancelled`` counts answers the client stopped reading early.
+
+Requires uvicorn (``pip install uvicorn``).
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+
+class FkUSTChat_MockUpstream:
+    def __init__(self, latency=0.2, token_rate=50, tokens=100, queue_latency=0.05, error_rate=0.0,
+                 error_status=429, retry_after=None, tool_call_rate=0.0, invalid_tokens=(), require_queue=False):
+        """
+        :param latency: Seconds before the first token, i.e. the upstream queue and prefill time.
+        :param token_rate: Tokens streamed per second; 0 streams them as fast as possible.
+        :param tokens: Tokens per answer.
+        :param queue_latency: Seconds the queue endpoint takes to answer.
+        :param error_rate: Share of chat requests that fail with ``error_status``.
+        :param error_status: The injected status code, e.g. 429, 500 or 401.
+        :param retry_after: ``Retry-After`` seconds sent with injected errors, if any.
+        :param tool_call_rate: Share of requests with tools that are answered with a tool call.
+        :param invalid_tokens: Tokens answered with 401.
+        :param require_queue: Whether chat requests need a queue code that entered the queue first.
+        """
+        self.latency = latency
+        self.token_rate = token_rate
+        self.tokens = tokens
+        self.queue_latency = queue_latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.tool_call_rate = tool_call_rate
+        self.invalid_tokens = set(invalid_tokens)
+        self.require_queue = require_queue
+
+        self.queue_codes = set()
+        self.stats = {"probes": 0, "queue_entries": 0, "chats": 0, "errors": 0, "tool_calls": 0, "cancelled": 0, "active": 0, "max_active": 0}
+
+    @staticmethod
+    def get_token(scope):
+        for name, value in scope.get('headers', []):
+            if name == b'authorization':
+                return value.decode('latin1')[len('Bearer '):]
+        return None
+
+    @staticmethod
+    async def read_body(receive):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                return body
+
+    @staticmethod
+    async def send_json(send, payload, status=200, headers=()):
+        body = json.dumps(payload).encode('utf-8')
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()), *headers]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+        path = scope['path']
+        if path == '/stats':
+            return await self.send_json(send, self.stats)
+        token = self.get_token(scope)
+        if path == '/ms-api/search-app':
+            self.stats["probes"] += 1
+            await self.read_body(receive)
+            if token is None or token in self.invalid_tokens:
+                return await self.send_json(send, {"detail": "Unauthorized"}, 401)
+            return await self.send_json(send, {"data": []})
+        if path == '/ms-api/mei-wei-bu-yong-deng':
+            self.stats["queue_entries"] += 1
+            await asyncio.sleep(self.queue_latency)
+            query = dict(pair.split('=', 1) for pair in scope.get('query_string', b'').decode().split('&') if '=' in pair)
+            self.queue_codes.add(query.get('queue_code'))
+            return await self.send_json(send, {"code": 0})
+        if path == '/ms-api/chat-messages':
+            return await self.chat(scope, receive, send, token)
+        return await self.send_json(send, {"detail": "Not Found"}, 404)
+
+    async def chat(self, scope, receive, send, token):
+        data = json.loads(await self.read_body(receive) or b'{}')
+        self.stats["chats"] += 1
+        if token is None or token in self.invalid_tokens:
+            self.stats["errors"] += 1
+            return await self.send_json(send, {"detail": "Unauthorized"}, 401)
+        if self.require_queue and data.get('queue_code') not in self.queue_codes:
+            self.stats["errors"] += 1
+            return await self.send_json(send, {"detail": "Queue code has not entered the queue"}, 400)
+        self.queue_codes.discard(data.get('queue_code'))
+        if self.error_rate and random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            headers = [(b'retry-after', str(self.retry_after).encode())] if self.retry_after is not None else []
+            return await self.send_json(send, {"detail": "Injected error"}, self.error_status, headers)
+
+        self.stats["active"] += 1
+        self.stats["max_active"] = max(self.stats["max_active"], self.stats["active"])
+        disconnected = asyncio.ensure_future(self.wait_disconnect(receive))
+        try:
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': [(b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache')]})
+            await asyncio.sleep(self.latency)
+            answer_id = f"chatcmpl-{uuid.uuid4().hex}"
+            if data.get('tools') and random.random() < self.tool_call_rate:
+                self.stats["tool_calls"] += 1
+                events = self.tool_call_events(data['tools'][0])
+            else:
+                events = self.content_events()
+            delay = 1 / self.token_rate if self.token_rate else 0
+            next_at = time.perf_counter()
+            for delta, finish_reason in events:
+                if disconnected.done():
+                    # 客户端提前关闭连接，停止生成
+                    self.stats["cancelled"] += 1
+                    return
+                chunk = {"id": answer_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": data.get('model', ''),
+                         "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+                await send({'type': 'http.response.body', 'body': f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'), 'more_body': True})
+                if delay:
+                    # 按固定节奏发送，避免 sleep 的误差累积导致实际速率偏低
+                    next_at += delay
+                    await asyncio.sleep(max(next_at - time.perf_counter(), 0))
+            await send({'type': 'http.response.body', 'body': b"data: [DONE]\n\n", 'more_body': False})
+        finally:
+            disconnected.cancel()
+            self.stats["active"] -= 1
+
+    @staticmethod
+    async def wait_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    def content_events(self):
+        yield {"role": "assistant", "content": ""}, None
+        for i in range(self.tokens):
+            yield {"content": "你好" if i % 2 else " world"}, None
+        yield {}, "stop"
+
+    def tool_call_events(self, tool):
+        name = tool.get('function', {}).get('name', 'tool')
+        arguments = json.dumps({"query": "mock " * 8, "limit": 10})
+        yield {"role": "assistant", "tool_calls": [{"index": 0, "id": f"call_{uuid.uuid4().hex[:24]}", "type": "function", "function": {"name": name, "arguments": ""}}]}, None
+        for i in range(0, len(arguments), 8):
+            yield {"tool_calls": [{"index": 0, "function": {"arguments": arguments[i:i + 8]}}]}, None
+        yield {}, "tool_calls"
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds before the first token')
+    parser.add_argument('--token-rate', type=float, default=50, help='tokens per second, 0 for unthrottled')
+    parser.add_argument('--tokens', type=int, default=100, help='tokens per answer')
+    parser.add_argument('--queue-latency', type=float, default=0.05, help='seconds to enter the queue')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of chat requests that fail')
+    parser.add_argument('--error-status', type=int, default=429, help='status of injected failures')
+    parser.add_argument('--retry-after', type=float, default=None, help='Retry-After of injected failures')
+    parser.add_argument('--tool-call-rate', type=float, default=0.0, help='share of requests with tools answered with a tool call')
+    parser.add_argument('--invalid-tokens', nargs='*', default=[], help='tokens answered with 401')
+    parser.add_argument('--require-queue', action='store_true', help='reject queue codes that did not enter the queue')
+
+
+def create_mock(args):
+    return FkUSTChat_MockUpstream(
+        latency=args.latency, token_rate=args.token_rate, tokens=args.tokens, queue_latency=args.queue_latency,
+        error_rate=args.error_rate, error_status=args.error_status, retry_after=args.retry_after,
+        tool_call_rate=args.tool_call_rate, invalid_tokens=args.invalid_tokens, require_queue=args.require_queue
+    )
+
+
+if __name__ == '__main__':
+    import uvicorn # pip install uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_mock(args), host=args.host, port=args.port, log_level='warning', backlog=4096)
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import openai # pip install openai
 import subprocess
@@ -277,6 +278,79 @@ async def parse_tool_output(tool_call, webpage_content, alerts):
         alerts.append(f'Agent 错误：工具 {tool_name} 不存在')
         return
     
+class ToolCallAccumulator:
+    """把流式返回的 tool_calls 片段拼成完整的工具调用；后一个调用开始时，前一个调用就已经完整"""
+    def __init__(self):
+        # 片段先放进列表，调用完整时再拼接，避免长参数反复拼接字符串
+        self.calls = {}
+        self.done = {}
+
+    def _complete(self, indexes):
+        completed = []
+        for i in sorted(indexes):
+            if i not in self.done:
+                call = self.calls[i]
+                self.done[i] = {'id': call['id'], 'type': 'function',
+                                'function': {'name': ''.join(call['name']), 'arguments': ''.join(call['arguments'])}}
+                completed.append(self.done[i])
+        return completed
+
+    def feed(self, deltas):
+        completed = []
+        for tc in deltas:
+            index = tc.get('index', 0)
+            if index not in self.calls:
+                completed += self._complete(i for i in self.calls if i < index)
+                self.calls[index] = {'id': tc.get('id'), 'name': [], 'arguments': []}
+            call = self.calls[index]
+            call['id'] = call['id'] or tc.get('id')
+            function = tc.get('function') or {}
+            call['name'].append(function.get('name') or '')
+            call['arguments'].append(function.get('arguments') or '')
+        return completed
+
+    def finish(self):
+        return self._complete(self.calls)
+
+    def get_tool_calls(self):
+        self.finish()
+        return [self.done[i] for i in sorted(self.done)]
+
+async def stream_tool_calls(webpage_content, **kwargs):
+    """流式请求模型，每个工具调用的参数一完整就开始执行，不必等整个回答输出完"""
+    stream = await client.chat.completions.create(
+        model=config['model'],
+        stream=True,
+        **kwargs,
+    )
+    accumulator = ToolCallAccumulator()
+    content = []
+    finish_reason = None
+    running = []
+
+    def start(tool_calls):
+        for tool_call in tool_calls:
+            alerts = []
+            running.append((asyncio.create_task(parse_tool_output(tool_call, webpage_content, alerts)), alerts))
+
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        if choice.delta.content:
+            content.append(choice.delta.content)
+        if choice.delta.tool_calls:
+            start(accumulator.feed([tool_call.model_dump() for tool_call in choice.delta.tool_calls]))
+        if choice.finish_reason:
+            finish_reason = choice.finish_reason
+    start(accumulator.finish())
+
+    message = {'role': 'assistant', 'content': ''.join(content)}
+    tool_calls = accumulator.get_tool_calls()
+    if tool_calls:
+        message['tool_calls'] = tool_calls
+    return finish_reason, message, running
+
 async def run_llm(webpage_content):
     msgs = [
         {'role': 'system', 'content': SYSTEM_PROMPT},
@@ -285,28 +359,32 @@ async def run_llm(webpage_content):
 
     while True:
         try:
-            resp = await get_response(messages=msgs, tools=TOOLS, tool_choice='required', max_tokens=300, temperature=0, n=1, seed=6)
+            finish_reason, message, running = await stream_tool_calls(webpage_content, messages=msgs, tools=TOOLS, tool_choice='required', max_tokens=300, temperature=0, n=1, seed=6)
         except Exception as e:
             yield f'Agent 错误：{type(e)}'
             return
         
-        if resp['finish_reason']!='tool_calls':
-            yield f'Agent 错误：缺失工具调用 (finish_reason = {resp["finish_reason"]})'
-            print(resp['message']['content'])
+        if finish_reason!='tool_calls':
+            for task, _ in running:
+                task.cancel()
+            yield f'Agent 错误：缺失工具调用 (finish_reason = {finish_reason})'
+            print(message['content'])
             return
         
-        msgs.append(resp['message'])
-        #print('->', resp['message'])
+        msgs.append(message)
+        #print('->', message)
         
-        for tool_call in resp['message']['tool_calls']:
-            alerts = []
-            tool_resp = await parse_tool_output(tool_call, webpage_content, alerts)
+        # 工具在流式输出期间已经开始执行，这里按调用顺序收集结果
+        for i, (task, alerts) in enumerate(running):
+            tool_resp = await task
             #print('  <-', tool_resp)
 
             for alert in alerts:
                 yield alert
             
             if not tool_resp:
+                for remaining, _ in running[i + 1:]:
+                    remaining.cancel()
                 return
 
             msgs.append(tool_resp)
@@ -317,5 +395,4 @@ async def main():
         print('【', msg, '】')
 
 if __name__=='__main__':
-    import asyncio
     asyncio.run(main())
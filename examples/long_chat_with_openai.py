@@ -2,6 +2,7 @@ import json
 import openai
 from typing import List, Dict, Optional
 import time
+import uuid
 
 config = {
     'base_url': 'http://127.0.0.1:5000/v1',
@@ -43,6 +44,10 @@ class MultiTurnChatAI:
         # 最大历史轮数（防止对话过长）
         self.max_history_turns = 20  # 可根据需求调整
 
+        # 服务端保存对话历史，之后每轮只需发送新消息
+        self.conversation_id = f"chat-{uuid.uuid4().hex}"
+        self.stored = False
+
     def add_message(self, role: str, content: str) -> None:
         """
         添加消息到对话历史
@@ -71,11 +76,12 @@ class MultiTurnChatAI:
         
         try:
             # 调用LLM获取回复
-            stream = self.client.chat.completions.create(
-                model=self.model,
-                messages=self.conversation_history,
-                stream=True
-            )
+            try:
+                stream = self.create_stream()
+            except openai.NotFoundError:
+                # 服务端的对话已过期，重新发送完整历史
+                self.stored = False
+                stream = self.create_stream()
             
             print("助手：", end="", flush=True)
             full_reply = ""
@@ -92,6 +98,7 @@ class MultiTurnChatAI:
             
             # 添加完整回复到历史
             self.add_message(role="assistant", content=full_reply)
+            self.stored = True
             
             return full_reply
         
@@ -111,9 +118,30 @@ class MultiTurnChatAI:
             print(f"未知错误：{e}")
             return None
 
+    def create_stream(self):
+        """
+        发起流式请求：对话已保存在服务端时只发送最新的用户消息，否则发送完整历史并让服务端保存
+        :return: 流式响应
+        """
+        if self.stored:
+            messages = self.conversation_history[-1:]
+            extra_body = {"conversation_id": self.conversation_id}
+        else:
+            messages = self.conversation_history
+            extra_body = {"conversation_id": self.conversation_id, "conversation": {"create": True}}
+        return self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            stream=True,
+            extra_body=extra_body
+        )
+
     def clear_history(self) -> None:
         """清空对话历史（保留系统提示词）"""
         self.conversation_history = [self.conversation_history[0]]
+        # 换一个新的服务端对话
+        self.conversation_id = f"chat-{uuid.uuid4().hex}"
+        self.stored = False
         print("对话历史已清空！")
 
     def show_history(self) -> None:
@@ -0,0 +1,158 @@
+import threading
+import time
+
+
+class FkUSTChat_Account:
+    def __init__(self, name, credential_manager):
+        """
+        One upstream account of an adapter, with its own token and health state.
+
+        :param name: A label for logs and stats, e.g. the username.
+        :param credential_manager: The :class:`FkUSTChat_CredentialManager` holding the account's token.
+        """
+        self.name = name
+        self.credential_manager = credential_manager
+
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0
+        self.readmitted_at = 0
+
+    def get_token(self):
+        return self.credential_manager.get_token()
+
+
+class FkUSTChat_AccountLease:
+    def __init__(self, pool, account):
+        """
+        One request's hold on an account. Releasing it more than once has no effect, so it can
+        be handed to :class:`FkUSTChat_SlotIterator` like a scheduler slot.
+        """
+        self.pool = pool
+        self.account = account
+        self.status = None
+        self.released = False
+
+    def get_token(self):
+        return self.account.get_token()
+
+    def release(self, status=None):
+        """
+        Gives the account back to the pool.
+
+        :param status: The upstream status of the request; defaults to the last one recorded in ``status``.
+        """
+        if self.released:
+            return
+        self.released = True
+        self.pool.release(self.account, status if status is not None else self.status)
+
+
+class FkUSTChat_AccountPool:
+    def __init__(self, base_ejection=30, max_ejection=600, ramp_up=60, eject_statuses=(401, 429)):
+        """
+        Spreads requests over several upstream accounts.
+
+        Each request goes to the healthy account with the fewest outstanding requests. An account
+        that answers with one of ``eject_statuses`` is ejected for ``base_ejection`` seconds, doubling
+        with every consecutive failure up to ``max_ejection``. After the ejection it is re-admitted
+        gradually: its share of the load ramps from a tenth to full over ``ramp_up`` seconds. When
+        every account is ejected, the one that comes back first is used anyway.
+
+        :param base_ejection: Seconds an account is ejected after its first failure.
+        :param max_ejection: Upper bound of the ejection time.
+        :param ramp_up: Seconds over which a re-admitted account gets back to its full share.
+        :param eject_statuses: Upstream status codes that eject an account.
+        """
+        self.base_ejection = base_ejection
+        self.max_ejection = max_ejection
+        self.ramp_up = ramp_up
+        self.eject_statuses = eject_statuses
+
+        self._lock = threading.Lock()
+        self.accounts = []
+
+    def set_accounts(self, accounts):
+        """
+        Replaces the accounts of the pool. Requests holding an old account release it as usual.
+
+        :param accounts: A list of :class:`FkUSTChat_Account`.
+        """
+        with self._lock:
+            self.accounts = list(accounts)
+
+    def _weight(self, account, now):
+        # 重新接入后的账号按 ramp_up 逐步恢复到完整的分配比例
+        if not account.readmitted_at or self.ramp_up <= 0:
+            return 1.0
+        return min(1.0, max(0.1, (now - account.readmitted_at) / self.ramp_up))
+
+    def acquire(self, exclude=()):
+        """
+        Picks an account for a request and counts the request as outstanding on it.
+
+        :param exclude: Accounts to avoid, e.g. the one that just failed, unless no other is left.
+        :return: The :class:`FkUSTChat_Account`; hand it back with :meth:`release`.
+        """
+        with self._lock:
+            if not self.accounts:
+                raise ValueError("没有可用的账号")
+            now = time.time()
+            candidates = [account for account in self.accounts if account not in exclude] or self.accounts
+            healthy = [account for account in candidates if account.ejected_until <= now]
+            if healthy:
+                account = min(healthy, key=lambda a: ((a.outstanding + 1) / self._weight(a, now), a.requests))
+            else:
+                account = min(candidates, key=lambda a: a.ejected_until)
+            account.outstanding += 1
+            account.requests += 1
+            return account
+
+    def lease(self, exclude=()):
+        """
+        Like :meth:`acquire`, but returns a :class:`FkUSTChat_AccountLease`.
+        """
+        return FkUSTChat_AccountLease(self, self.acquire(exclude))
+
+    def release(self, account, status=None):
+        """
+        Ends a request on an account.
+
+        :param account: The account from :meth:`acquire`.
+        :param status: The upstream status of the request; 200 marks the account healthy,
+                       one of ``eject_statuses`` ejects it, None leaves its health unchanged.
+        """
+        with self._lock:
+            account.outstanding -= 1
+            if status is None:
+                return
+            if status in self.eject_statuses:
+                now = time.time()
+                if account.ejected_until > now:
+                    # 同一批并发请求的失败只算一次
+                    return
+                account.failures += 1
+                account.ejections += 1
+                duration = min(self.base_ejection * 2 ** (account.failures - 1), self.max_ejection)
+                account.ejected_until = now + duration
+                account.readmitted_at = account.ejected_until
+                print(f'[!] 账号 {account.name} 返回 {status}，暂停使用 {duration:.0f} 秒')
+            elif status == 200:
+                account.failures = 0
+
+    def stats(self):
+        with self._lock:
+            now = time.time()
+            return [
+                {
+                    "name": account.name,
+                    "outstanding": account.outstanding,
+                    "requests": account.requests,
+                    "ejections": account.ejections,
+                    "ejected_for": max(account.ejected_until - now, 0),
+                    "weight": self._weight(account, now) if account.ejected_until <= now else 0.0
+                }
+                for account in self.accounts
+            ]
@@ -1,44 +1,228 @@
 from os import path, listdir
+from concurrent.futures import ThreadPoolExecutor
+import ast
+import asyncio
 import importlib.util
-
-from adapters.base import FkUSTChat_BaseAdapter
+import threading
 
 ADAPTER_DIR = path.join(path.dirname(__file__), "../adapters")
+MANIFEST_NAME = "ADAPTER_MANIFEST"
 
 def get_adapter_files():
     """
     Returns a list of adapter files in the ADAPTER_DIR directory.
     """
-    return [f for f in listdir(ADAPTER_DIR) if f.endswith('.py') and f != '__init__.py']
+    return [f for f in listdir(ADAPTER_DIR) if f.endswith('.py') and f != '__init__.py' and f != 'base.py']
 
-def load_adapter(context, adapter_filename):
-    """
-    Dynamically loads an adapter module given its filename.
-    
-    :param adapter_filename: The name of the adapter file (without .py extension).
-    :return: The loaded adapter module.
-    """
+def get_adapter_path(adapter_filename):
     if not adapter_filename.endswith('.py'):
         adapter_filename += '.py'
-    
-    # 从指定文件导入
     adapter_path = path.join(ADAPTER_DIR, adapter_filename)
     if not path.exists(adapter_path):
         raise FileNotFoundError(f"Adapter file {adapter_filename} does not exist in {ADAPTER_DIR}.")
-    spec = importlib.util.spec_from_file_location(adapter_filename[:-3], adapter_path)
+    return adapter_path
+
+def read_manifest(adapter_filename):
+    """
+    Reads the ``ADAPTER_MANIFEST`` literal of an adapter file without importing it.
+
+    The manifest is a dict with the adapter's ``name``, ``description`` and ``author``, and a
+    ``models`` dict mapping each model key to its model info (``name``, ``show``, ``tokenizer``...).
+
+    :param adapter_filename: The name of the adapter file.
+    :return: The manifest, or None if the file does not declare one.
+    """
+    with open(get_adapter_path(adapter_filename), 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read(), adapter_filename)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(target, ast.Name) and target.id == MANIFEST_NAME for target in node.targets):
+            try:
+                return ast.literal_eval(node.value)
+            except ValueError:
+                return None
+    return None
+
+def instantiate_adapters(context, adapter_filename):
+    """
+    Imports an adapter file and instantiates every adapter class it defines.
+
+    :return: The list of adapter instances.
+    """
+    from adapters.base import FkUSTChat_BaseAdapter
+
+    adapter_path = get_adapter_path(adapter_filename)
+    module_name = path.basename(adapter_path)[:-3]
+    spec = importlib.util.spec_from_file_location(module_name, adapter_path)
     adapter_module = importlib.util.module_from_spec(spec)
     spec.loader.exec_module(adapter_module)
-    
+
     # 获取其中全部的 class
     adapter_classes = [getattr(adapter_module, attr) for attr in dir(adapter_module) if isinstance(getattr(adapter_module, attr), type)]
     # 这个 class 必须为 FkUSTChat_BaseAdapter 的子类，但是不包括 FkUSTChat_BaseAdapter 自身
-    adapter_classes = [cls(context) for cls in adapter_classes if issubclass(cls, FkUSTChat_BaseAdapter) and cls is not FkUSTChat_BaseAdapter]
-    
+    adapters = [cls(context) for cls in adapter_classes if issubclass(cls, FkUSTChat_BaseAdapter) and cls is not FkUSTChat_BaseAdapter]
+    for adapter in adapters:
+        adapter.adapter_filename = path.basename(adapter_path)
+    return adapters
+
+def register_adapters(context, adapters):
     successful_adapters = []
-    for adapter in adapter_classes:
+    for adapter in adapters:
         try:
             successful_adapters.append(context.register_adapter(adapter))
         except Exception as e:
             print(f"Failed to register adapter {adapter.name}: {e}")
-    
-    return successful_adapters
\ No newline at end of file
+    return successful_adapters
+
+def load_adapter(context, adapter_filename):
+    """
+    Dynamically loads an adapter module given its filename.
+
+    :param adapter_filename: The name of the adapter file (without .py extension).
+    :return: The loaded adapter module.
+    """
+    return register_adapters(context, instantiate_adapters(context, adapter_filename))
+
+
+class FkUSTChat_LazyModel:
+    def __init__(self, adapter, key, model_info):
+        """
+        Stands in for a model of a lazily loaded adapter, using the model info from the manifest.
+        The first request imports the adapter and is then forwarded to the real model.
+        """
+        self.adapter = adapter
+        self.key = key
+        self.model_info = model_info
+        self.name = model_info.get('name', 'FkUSTChat_BaseModel')
+        self.description = model_info.get('description', 'Base Model for FkUSTChat')
+        self.author = model_info.get('author', 'yemaster')
+        self.tokenizer = model_info.get('tokenizer')
+
+    def resolve(self):
+        return self.adapter.resolve().models[self.key]
+
+    def get_response(self, prompt, stream=False, **kwargs):
+        return self.resolve().get_response(prompt, stream=stream, **kwargs)
+
+    async def aget_response(self, prompt, stream=False, **kwargs):
+        if not self.adapter.loaded:
+            await asyncio.get_running_loop().run_in_executor(None, self.adapter.resolve)
+        return await self.resolve().aget_response(prompt, stream=stream, **kwargs)
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return getattr(self.resolve(), attr)
+
+
+class FkUSTChat_LazyAdapter:
+    def __init__(self, context, adapter_filename, manifest):
+        """
+        Registers an adapter from its manifest and imports its module on first use.
+
+        :param context: The core.
+        :param adapter_filename: The adapter file.
+        :param manifest: The manifest read by :func:`read_manifest`.
+        """
+        self.context = context
+        self.adapter_filename = adapter_filename
+        self.adapter_info = manifest
+        self.name = manifest.get('name', 'FkUSTChat_BaseAdapter')
+        self.description = manifest.get('description', 'Base Adapter for FkUSTChat')
+        self.author = manifest.get('author', 'yemaster')
+        self.config = {}
+        self.models = {key: FkUSTChat_LazyModel(self, key, info) for key, info in manifest.get('models', {}).items()}
+
+        self._adapter = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._adapter is not None
+
+    def resolve(self):
+        """
+        Imports the adapter module once and returns the real adapter.
+        """
+        if self._adapter is not None:
+            return self._adapter
+        with self._lock:
+            if self._adapter is None:
+                adapters = [adapter for adapter in instantiate_adapters(self.context, self.adapter_filename) if adapter.name == self.name]
+                if not adapters:
+                    raise ValueError(f"Adapter {self.name} not found in {self.adapter_filename}.")
+                adapter = adapters[0]
+                if self.config:
+                    adapter.load_config(self.config)
+                self._adapter = adapter
+                print(f'[+] Loaded adapter {self.name}')
+        return self._adapter
+
+    def load_config(self, config):
+        self.config = config
+        if self._adapter is not None:
+            self._adapter.load_config(config)
+
+    def close(self):
+        if self._adapter is not None:
+            self._adapter.close()
+
+    def collect_metrics(self):
+        # 尚未导入的适配器没有可报告的状态，不能因为抓取指标而导入它
+        if self._adapter is None:
+            return []
+        return self._adapter.collect_metrics()
+
+    def set_config(self, key, config):
+        if self._adapter is not None:
+            return self._adapter.set_config(key, config)
+        self.config[key] = config
+        self.context.set_adapter_config(self.name, key, config)
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return getattr(self.resolve(), attr)
+
+
+def discover_adapters(context, adapter_filename, lazy=True):
+    """
+    Creates the adapters of one file: a :class:`FkUSTChat_LazyAdapter` if it has a manifest and ``lazy`` is on, otherwise the imported adapters.
+    """
+    manifest = read_manifest(adapter_filename) if lazy else None
+    if manifest is not None:
+        return [FkUSTChat_LazyAdapter(context, adapter_filename, manifest)]
+    return instantiate_adapters(context, adapter_filename)
+
+
+def load_adapters(context, adapter_filenames=None, lazy=True, preload=False):
+    """
+    Discovers and registers adapters.
+
+    Adapters that declare an ``ADAPTER_MANIFEST`` are registered from it without importing their
+    code, unless ``lazy`` is off; the module and its dependencies are imported on first use. The
+    others are imported right away. Manifests are read and modules imported in parallel.
+
+    :param context: The core.
+    :param adapter_filenames: The adapter files to load; defaults to every file of :func:`get_adapter_files`.
+    :param lazy: Whether adapters with a manifest are imported on first use.
+    :param preload: Whether lazy adapters are still imported in the background right after startup.
+    :return: The names of the registered adapters.
+    """
+    if adapter_filenames is None:
+        adapter_filenames = sorted(get_adapter_files())
+
+    adapters = []
+    with ThreadPoolExecutor(max_workers=max(len(adapter_filenames), 1)) as executor:
+        for adapter_filename, future in [(f, executor.submit(discover_adapters, context, f, lazy)) for f in adapter_filenames]:
+            try:
+                adapters.extend(future.result())
+            except Exception as e:
+                print(f"Failed to load adapter file {adapter_filename}: {e}")
+
+    successful_adapters = register_adapters(context, adapters)
+
+    if preload:
+        lazy_adapters = [adapter for adapter in adapters if isinstance(adapter, FkUSTChat_LazyAdapter)]
+        for adapter in lazy_adapters:
+            threading.Thread(target=adapter.resolve, daemon=True).start()
+    return successful_adapters
@@ -0,0 +1,157 @@
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+_STOP = object()
+
+
+async def iterate_in_threadpool(iterator, executor=None):
+    """
+    Turns a blocking iterator into an async generator by pulling each item in the thread pool.
+
+    :param iterator: The blocking iterator, e.g. the generator returned by a sync ``get_response``.
+    :param executor: The executor to pull the items in; defaults to the event loop's default executor.
+    :return: An async generator yielding the same items.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = iter(iterator)
+    try:
+        while True:
+            item = await loop.run_in_executor(executor, next, iterator, _STOP)
+            if item is _STOP:
+                break
+            yield item
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            try:
+                await loop.run_in_executor(executor, close)
+            except ValueError:
+                # 生成器仍在其他线程中执行，交给垃圾回收关闭
+                pass
+
+
+async def wait_disconnect(receive):
+    """
+    Returns once the client of an ASGI HTTP request has gone away. Call it after the body has been read.
+    """
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def read_body(receive):
+    """
+    Reads the full request body of an ASGI HTTP request.
+
+    :param receive: The ASGI receive callable.
+    :return: The body as bytes.
+    """
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            break
+    return body
+
+
+def build_environ(scope, body):
+    """
+    Builds a WSGI environ for an ASGI HTTP scope.
+
+    :param scope: The ASGI scope.
+    :param body: The already read request body.
+    :return: The WSGI environ dict.
+    """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1')
+        value = value.decode('latin1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        if key in environ:
+            value = f'{environ[key]},{value}'
+        environ[key] = value
+    return environ
+
+
+class FkUSTChat_WSGIBridge:
+    def __init__(self, wsgi_app, threads=16):
+        """
+        Serves a WSGI application from ASGI, running it and its response iterator in a thread pool of its own.
+
+        The pool is separate from the event loop's default executor, which the adapters use for blocking
+        work such as preparing upstream requests, so long bridged streams cannot starve them. When the
+        client goes away, the response iterator is closed instead of being read to the end.
+
+        :param wsgi_app: The WSGI application, e.g. the Flask app.
+        :param threads: The size of the pool, i.e. how many bridged requests run at the same time.
+        """
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='wsgi-bridge')
+
+    async def __call__(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        body = await read_body(receive)
+        environ = build_environ(scope, body)
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(k.lower().encode('latin1'), v.encode('latin1')) for k, v in headers]
+
+        result = await loop.run_in_executor(self.executor, self.wsgi_app, environ, start_response)
+        chunks = iterate_in_threadpool(result, self.executor)
+
+        async def pump():
+            sent_start = False
+            async for chunk in chunks:
+                if not chunk:
+                    continue
+                if not sent_start:
+                    await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+                    sent_start = True
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if not sent_start:
+                await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        pump_task = asyncio.ensure_future(pump())
+        disconnect_task = asyncio.ensure_future(wait_disconnect(receive))
+        try:
+            await asyncio.wait([pump_task, disconnect_task], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            disconnect_task.cancel()
+            if not pump_task.done():
+                # 客户端已断开，不再读取剩余的响应
+                pump_task.cancel()
+                await asyncio.gather(pump_task, return_exceptions=True)
+            await chunks.aclose()
+        if pump_task.done() and not pump_task.cancelled():
+            pump_task.result()
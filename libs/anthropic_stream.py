@@ -0,0 +1,190 @@
+from libs.json_codec import dumps, loads
+from libs.sse import iter_sse_payloads, aiter_sse_payloads, FkUSTChat_ClosingStream, FkUSTChat_AsyncClosingStream
+from libs.tokens import FkUSTChat_HeuristicTokenizer, FkUSTChat_TokenCounter
+from libs.tool_calls import FkUSTChat_ToolCallAccumulator
+
+STOP_REASONS = {
+    "stop": "end_turn",
+    "tool_calls": "tool_use",
+    "length": "max_tokens",
+}
+
+# 预先编码好的帧模板，热路径上只需拼接 index 与 JSON 编码后的值
+_TEXT_START = (b'event: content_block_start\ndata: {"type":"content_block_start","index":',
+               b',"content_block":{"type":"text","text":""}}\n\n')
+_TEXT_DELTA = (b'event: content_block_delta\ndata: {"type":"content_block_delta","index":',
+               b',"delta":{"type":"text_delta","text":', b'}}\n\n')
+_TOOL_START = (b'event: content_block_start\ndata: {"type":"content_block_start","index":',
+               b',"content_block":{"type":"tool_use","id":', b',"name":', b',"input":{}}}\n\n')
+_TOOL_DELTA = (b'event: content_block_delta\ndata: {"type":"content_block_delta","index":',
+               b',"delta":{"type":"input_json_delta","partial_json":', b'}}\n\n')
+_BLOCK_STOP = (b'event: content_block_stop\ndata: {"type":"content_block_stop","index":', b'}\n\n')
+_MESSAGE_STOP = b'event: message_stop\ndata: {"type":"message_stop"}\n\n'
+
+
+class FkUSTChat_AnthropicTranscoder:
+    def __init__(self, model, message_id="msg_1", input_tokens=0, counter=None):
+        """
+        Incrementally converts an OpenAI chat.completion.chunk stream into Anthropic Messages SSE frames.
+
+        Content blocks are opened and closed in order: a text block stays open until output of another
+        kind arrives, and a tool_use block is closed as soon as its input is a complete JSON object, so
+        clients can start running the tool before the rest of the answer is streamed. Frames are built from pre-encoded templates, and only
+        the dynamic values (text, tool ids and names) go through the JSON encoder, so they are
+        always escaped correctly.
+
+        :param model: The model name reported in message_start.
+        :param message_id: The message id reported in message_start.
+        :param input_tokens: The prompt token count reported in message_start.
+        :param counter: The :class:`FkUSTChat_TokenCounter` measuring the output; defaults to the approximate tokenizer.
+        """
+        self.model = model
+        self.message_id = message_id
+        self.input_tokens = input_tokens
+
+        self.next_index = 0
+        self.open_index = None
+        self.text_index = None
+        self.tool_indices = {}
+        self.tool_calls = FkUSTChat_ToolCallAccumulator(validate=True)
+        self.counter = counter or FkUSTChat_TokenCounter(FkUSTChat_HeuristicTokenizer())
+        self.stop_reason = None
+
+    def start(self):
+        """
+        Returns the message_start frame.
+        """
+        message = {
+            "id": self.message_id,
+            "type": "message",
+            "role": "assistant",
+            "content": [],
+            "model": self.model,
+            "stop_reason": None,
+            "stop_sequence": None,
+            "usage": {"input_tokens": self.input_tokens, "output_tokens": 0}
+        }
+        return b'event: message_start\ndata: ' + dumps({"type": "message_start", "message": message}) + b'\n\n'
+
+    def _open(self, frames):
+        # 关闭当前块并分配新块的 index
+        if self.open_index is not None:
+            frames.append(_BLOCK_STOP[0] + b'%d' % self.open_index + _BLOCK_STOP[1])
+        index = self.next_index
+        self.next_index += 1
+        self.open_index = index
+        return index
+
+    def feed(self, payload):
+        """
+        Consumes one OpenAI chunk.
+
+        :param payload: The JSON payload of a ``data:`` line, as bytes or str.
+        :return: The Anthropic frames it produces, as bytes (possibly empty).
+        """
+        try:
+            chunk = loads(payload)
+        except ValueError:
+            return b''
+        choices = chunk.get("choices")
+        if not choices:
+            return b''
+        choice = choices[0]
+        delta = choice.get("delta") or {}
+        frames = []
+
+        # 推理模型的思考过程不转成 Anthropic 的块，但同样计入输出 token
+        if delta.get("reasoning_content"):
+            self.counter.feed(delta["reasoning_content"])
+
+        text = delta.get("content")
+        if text:
+            if self.text_index is None or self.open_index != self.text_index:
+                self.text_index = self._open(frames)
+                frames.append(_TEXT_START[0] + b'%d' % self.text_index + _TEXT_START[1])
+            frames.append(_TEXT_DELTA[0] + b'%d' % self.text_index + _TEXT_DELTA[1] + dumps(text) + _TEXT_DELTA[2])
+            self.counter.feed(text)
+
+        tool_deltas = delta.get("tool_calls")
+        for tc_delta in tool_deltas or ():
+            idx = tc_delta.get("index", 0)
+            fn = tc_delta.get("function") or {}
+            index = self.tool_indices.get(idx)
+            if index is None:
+                index = self.tool_indices[idx] = self._open(frames)
+                tc_id = tc_delta.get("id") or f"toolu_{idx}"
+                name = fn.get("name") or "unknown"
+                frames.append(_TOOL_START[0] + b'%d' % index + _TOOL_START[1] + dumps(tc_id) + _TOOL_START[2] + dumps(name) + _TOOL_START[3])
+            arguments = fn.get("arguments")
+            if arguments and idx not in self.tool_calls.emitted:
+                frames.append(_TOOL_DELTA[0] + b'%d' % index + _TOOL_DELTA[1] + dumps(arguments) + _TOOL_DELTA[2])
+                self.counter.feed(arguments)
+        if tool_deltas:
+            for call in self.tool_calls.feed(tool_deltas):
+                # 参数已经完整的工具调用立即关闭，不必等到下一个块开始
+                if self.open_index == self.tool_indices[call["index"]]:
+                    frames.append(_BLOCK_STOP[0] + b'%d' % self.open_index + _BLOCK_STOP[1])
+                    self.open_index = None
+
+        finish_reason = choice.get("finish_reason")
+        if finish_reason:
+            self.stop_reason = finish_reason
+        return b''.join(frames)
+
+    def finish(self):
+        """
+        Returns the frames closing the open block and the message.
+        """
+        frames = []
+        if self.open_index is not None:
+            frames.append(_BLOCK_STOP[0] + b'%d' % self.open_index + _BLOCK_STOP[1])
+            self.open_index = None
+        stop_reason = STOP_REASONS.get(self.stop_reason, self.stop_reason or "end_turn")
+        frames.append(b'event: message_delta\ndata: ' + dumps({
+            "type": "message_delta",
+            "delta": {"stop_reason": stop_reason, "stop_sequence": None},
+            "usage": {"output_tokens": self.counter.total}
+        }) + b'\n\n')
+        frames.append(_MESSAGE_STOP)
+        return b''.join(frames)
+
+    def transcode(self, openai_stream):
+        """
+        Converts a whole OpenAI SSE stream.
+
+        :param openai_stream: An iterator of SSE chunks (bytes or str), as returned by ``get_response(stream=True)``.
+        :return: An iterator of Anthropic SSE frames as bytes; closing it closes ``openai_stream``.
+        """
+        return FkUSTChat_ClosingStream(self._transcode(openai_stream), (openai_stream,))
+
+    def _transcode(self, openai_stream):
+        try:
+            yield self.start()
+            for payload in iter_sse_payloads(openai_stream):
+                frames = self.feed(payload)
+                if frames:
+                    yield frames
+            yield self.finish()
+        finally:
+            close = getattr(openai_stream, 'close', None)
+            if close is not None:
+                close()
+
+    def atranscode(self, openai_stream):
+        """
+        Async version of :meth:`transcode`, for the async iterator returned by ``aget_response(stream=True)``.
+        """
+        return FkUSTChat_AsyncClosingStream(self._atranscode(openai_stream), (openai_stream,))
+
+    async def _atranscode(self, openai_stream):
+        try:
+            yield self.start()
+            async for payload in aiter_sse_payloads(openai_stream):
+                frames = self.feed(payload)
+                if frames:
+                    yield frames
+            yield self.finish()
+        finally:
+            aclose = getattr(openai_stream, 'aclose', None)
+            if aclose is not None:
+                await aclose()
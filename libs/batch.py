@@ -0,0 +1,248 @@
+import contextvars
+import os
+import re
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from os import path
+
+from libs.chat import FkUSTChat_ChatRequest, FkUSTChat_RequestError, error_body
+from libs.json_codec import dumps, loads
+from libs.retry import FkUSTChat_UpstreamError
+
+BATCH_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def is_retryable(status_code):
+    """
+    Whether a failed batch request should run again when the batch is resumed, i.e. it failed for a transient reason.
+    """
+    return status_code == 429 or status_code >= 500
+
+
+class FkUSTChat_BatchRunner:
+    def __init__(self, core, directory='./batches', concurrency=4, max_requests=50000):
+        """
+        Runs batches of chat completion requests through the core, for offline jobs.
+
+        A batch is a JSONL document whose lines are ``{"custom_id": ..., "body": {chat request}}``, as in
+        the OpenAI batch API. Requests run in parallel, at most ``concurrency`` at a time per model, and
+        their results are returned as JSONL lines in the order they finish. Every result is appended to
+        ``<directory>/<batch id>.jsonl`` as soon as it is known, so a batch that is sent again with the
+        same id replays the finished results and only runs the rest. Requests that failed with 429 or
+        5xx are not recorded and run again; malformed lines are not recorded either, they are checked
+        again on every run.
+
+        :param core: The :class:`FkUSTChat_Core` to run the requests with.
+        :param directory: Where the checkpoint files are kept.
+        :param concurrency: Requests run at the same time per model.
+        :param max_requests: The largest batch accepted.
+        """
+        self.core = core
+        self.directory = directory
+        self.concurrency = concurrency
+        self.max_requests = max_requests
+
+        self._lock = threading.Lock()
+        self._running = set()
+
+    @classmethod
+    def from_config(cls, core, config):
+        """
+        Builds a runner from the ``batch`` section of the core config.
+        """
+        config = config or {}
+        return cls(
+            core,
+            directory=config.get('directory', './batches'),
+            concurrency=config.get('concurrency', 4),
+            max_requests=config.get('max_requests', 50000)
+        )
+
+    @staticmethod
+    def new_batch_id():
+        return f"batch_{uuid.uuid4().hex}"
+
+    def checkpoint_path(self, batch_id):
+        return path.join(self.directory, f"{batch_id}.jsonl")
+
+    def parse(self, body):
+        """
+        Splits a JSONL batch into requests.
+
+        :param body: The batch as bytes or str.
+        :return: A list of ``(custom_id, request body or None, error or None)``; malformed lines get an error instead of a body.
+        """
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        items = []
+        seen = set()
+        for number, line in enumerate(body.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                item = loads(line)
+            except ValueError:
+                items.append((f"line-{number}", None, f"Line {number} is not valid JSON"))
+                continue
+            if not isinstance(item, dict):
+                items.append((f"line-{number}", None, f"Line {number} is not a JSON object"))
+                continue
+            custom_id = str(item.get("custom_id") or f"line-{number}")
+            request = item.get("body")
+            if custom_id in seen:
+                items.append((custom_id, None, f"Duplicate custom_id '{custom_id}'"))
+            elif not isinstance(request, dict):
+                items.append((custom_id, None, "body must be a chat completion request object"))
+            else:
+                items.append((custom_id, request, None))
+            seen.add(custom_id)
+        return items
+
+    def load_checkpoint(self, batch_id):
+        """
+        :return: The recorded result lines of a batch, by custom_id.
+        """
+        results = {}
+        try:
+            with open(self.checkpoint_path(batch_id), 'rb') as f:
+                for line in f:
+                    try:
+                        result = loads(line)
+                    except ValueError:
+                        # 中断时可能只写了半行
+                        continue
+                    results[result["custom_id"]] = line.rstrip(b'\n') + b'\n'
+        except FileNotFoundError:
+            pass
+        return results
+
+    def open_checkpoint(self, batch_id):
+        """
+        Opens the checkpoint of a batch for appending, first cutting off a line left half-written
+        by an interrupted run so that the next result starts on a line of its own.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        checkpoint = open(self.checkpoint_path(batch_id), 'a+b')
+        try:
+            checkpoint.seek(0)
+            data = checkpoint.read()
+            if data and not data.endswith(b'\n'):
+                checkpoint.truncate(data.rfind(b'\n') + 1)
+        except BaseException:
+            checkpoint.close()
+            raise
+        return checkpoint
+
+    def run_request(self, request, client):
+        """
+        Runs one request of a batch like a non-streaming ``/v1/chat/completions`` call.
+
+        :return: A ``(status_code, response body)`` tuple.
+        """
+        # 批处理只返回完整的回答，忽略请求中的 stream
+        try:
+            chat = FkUSTChat_ChatRequest(self.core, dict(request, stream=False), {})
+            cached = chat.start(client)
+        except FkUSTChat_RequestError as e:
+            return e.status_code, e.to_dict()
+        if cached is not None:
+            return 200, chat.finish(cached)
+        try:
+            response = chat.get_responses(client)
+        except FkUSTChat_UpstreamError as e:
+            return e.status_code, e.to_dict()
+        except Exception as e:
+            return 500, error_body(str(e), "server_error")
+        return 200, chat.finish(response)
+
+    def run(self, batch_id, items):
+        """
+        Runs a batch, skipping the requests already recorded in its checkpoint.
+
+        Closing the generator early stops starting new requests; the running ones are still waited
+        for and recorded, so resuming does not repeat them.
+
+        :param batch_id: The batch id, see :data:`BATCH_ID`.
+        :param items: The requests, as returned by :meth:`parse`.
+        :return: A generator of JSONL result lines (bytes).
+        :raises ValueError: If the same batch is already running.
+        """
+        with self._lock:
+            if batch_id in self._running:
+                raise ValueError(f"Batch '{batch_id}' is already running")
+            self._running.add(batch_id)
+        try:
+            checkpoint = self.open_checkpoint(batch_id)
+        except BaseException:
+            self._release(batch_id)
+            raise
+        results = self._run(batch_id, items, checkpoint)
+        # 先进入 try，这样即使结果一行都没有被读取，关闭生成器时也会释放批次
+        next(results)
+        return results
+
+    def _release(self, batch_id):
+        with self._lock:
+            self._running.discard(batch_id)
+
+    def _result_line(self, custom_id, status_code, body):
+        return dumps({
+            "id": f"batch_req_{uuid.uuid4().hex}",
+            "custom_id": custom_id,
+            "response": {"status_code": status_code, "body": body},
+            "error": None
+        }) + b'\n'
+
+    def _run(self, batch_id, items, checkpoint):
+        client = f"batch:{batch_id}"
+        queues = {}
+        executor = None
+        running = {}
+        try:
+            yield None
+            done = self.load_checkpoint(batch_id)
+            for custom_id, request, error in items:
+                if error is not None:
+                    # 不写入检查点：重复的 custom_id 会覆盖原请求的结果，而这些错误每次都能重新得出
+                    yield self._result_line(custom_id, 400, error_body(error))
+                elif custom_id in done:
+                    yield done[custom_id]
+                else:
+                    queues.setdefault(request.get("model"), deque()).append((custom_id, request))
+            if not queues:
+                return
+
+            # 每个模型最多 concurrency 个请求同时进行，不会因为一个模型排队而占满线程
+            executor = ThreadPoolExecutor(self.concurrency * len(queues))
+            active = dict.fromkeys(queues, 0)
+            while running or any(queues.values()):
+                for model, queue in queues.items():
+                    while queue and active[model] < self.concurrency:
+                        custom_id, request = queue.popleft()
+                        future = executor.submit(contextvars.copy_context().run, self.run_request, request, client)
+                        running[future] = model, custom_id
+                        active[model] += 1
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    model, custom_id = running.pop(future)
+                    active[model] -= 1
+                    line = self._record(checkpoint, custom_id, *future.result())
+                    yield line
+        finally:
+            if running:
+                # 客户端断开时，已经开始的请求仍然记录下来，恢复时不再重复
+                for future in wait(running).done:
+                    self._record(checkpoint, running[future][1], *future.result())
+            if executor is not None:
+                executor.shutdown(wait=False)
+            checkpoint.close()
+            self._release(batch_id)
+
+    def _record(self, checkpoint, custom_id, status_code, body):
+        line = self._result_line(custom_id, status_code, body)
+        if not is_retryable(status_code):
+            checkpoint.write(line)
+            checkpoint.flush()
+        return line
@@ -0,0 +1,205 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def make_request_key(model, messages, tools=None, with_search=False, max_tokens=None, stop=None, sampling=None):
+    """
+    Returns a canonical hash of the parts of a chat request that determine its answer.
+
+    :param model: The registered model name.
+    :param messages: The chat messages.
+    :param tools: The tool definitions.
+    :param with_search: Whether search augmentation is enabled.
+    :param max_tokens: The output token limit, if any.
+    :param stop: The stop sequences, if any.
+    :param sampling: The sampling parameters passed to the upstream, if any.
+    :return: A hex digest usable as a cache or deduplication key.
+    """
+    request = {
+        "model": model,
+        "messages": messages,
+        "tools": tools or [],
+        "with_search": bool(with_search)
+    }
+    # 只在设置时加入，未设置的请求保持原来的键
+    if max_tokens is not None:
+        request["max_tokens"] = max_tokens
+    if stop:
+        request["stop"] = stop
+    if sampling:
+        request["sampling"] = sampling
+    canonical = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def get_cache_mode(cache, data, headers):
+    """
+    Decides how a chat request uses the response cache.
+
+    Only requests without sampling randomness and with a single choice are cached. Clients can skip the cache with
+    ``Cache-Control: no-cache`` or ``X-FkUSTChat-Cache: bypass``.
+
+    :param cache: The response cache, or None if it is disabled.
+    :param data: The request body.
+    :param headers: The request headers, looked up by lower-case name.
+    :return: None if the cache is disabled, ``'BYPASS'`` if it is skipped, otherwise ``'USE'``.
+    """
+    if cache is None:
+        return None
+    directives = headers.get('cache-control', '').lower()
+    if 'no-cache' in directives or 'no-store' in directives or headers.get('x-fkustchat-cache', '').lower() == 'bypass':
+        return 'BYPASS'
+    if data.get("temperature") not in (None, 0) or (data.get("n") or 1) > 1:
+        return 'BYPASS'
+    return 'USE'
+
+
+def completion_to_sse(result):
+    """
+    Replays a chat.completion result as an SSE stream of chat.completion.chunk events.
+
+    :param result: The chat.completion dict.
+    :return: A generator of SSE strings, ending with ``data: [DONE]``.
+    """
+    for choice in result.get("choices", []):
+        message = choice.get("message", {})
+        delta = {"role": "assistant", "content": message.get("content") or ""}
+        if message.get("tool_calls"):
+            delta["tool_calls"] = [dict(tc, index=i) for i, tc in enumerate(message["tool_calls"])]
+        for payload_choice in ({"index": choice.get("index", 0), "delta": delta, "finish_reason": None},
+                               {"index": choice.get("index", 0), "delta": {}, "finish_reason": choice.get("finish_reason", "stop")}):
+            chunk = {
+                "id": result.get("id", ""),
+                "object": "chat.completion.chunk",
+                "created": result.get("created", int(time.time())),
+                "model": result.get("model", ""),
+                "choices": [payload_choice]
+            }
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+class FkUSTChat_ResponseCache:
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024, ttl=3600, path=None):
+        """
+        An LRU cache of non-streaming chat completions with TTL, bounded by entry count and size.
+
+        :param max_entries: Maximum number of entries kept in memory.
+        :param max_bytes: Maximum total size of the serialized entries kept in memory.
+        :param ttl: Seconds an entry stays valid.
+        :param path: Optional SQLite file used as a backing store, so entries survive restarts.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._db = None
+        if path:
+            # 多个 worker 进程可以共用同一个文件
+            self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, expires_at REAL, value BLOB)")
+            self._db.execute("DELETE FROM response_cache WHERE expires_at < ?", (time.time(),))
+            self._db.commit()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Builds a cache from the ``response_cache`` section of the core config.
+
+        :param config: The section dict, or None.
+        :return: The cache, or None if it is not enabled.
+        """
+        if not config or not config.get('enabled', False):
+            return None
+        return cls(
+            max_entries=config.get('max_entries', 1024),
+            max_bytes=config.get('max_bytes', 64 * 1024 * 1024),
+            ttl=config.get('ttl', 3600),
+            path=config.get('path')
+        )
+
+    def _evict(self):
+        # 在持有锁时调用
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, value) = self._entries.popitem(last=False)
+            self._bytes -= len(value)
+            self.evictions += 1
+
+    def _put(self, key, expires_at, value):
+        # 在持有锁时调用
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old[1])
+        if len(value) > self.max_bytes:
+            return
+        self._entries[key] = (expires_at, value)
+        self._bytes += len(value)
+        self._evict()
+
+    def get(self, key):
+        """
+        Looks up a cached response.
+
+        :param key: The key from :func:`make_request_key`.
+        :return: The cached chat.completion dict, or None.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < now:
+                self._entries.pop(key)
+                self._bytes -= len(entry[1])
+                entry = None
+            if entry is None and self._db is not None:
+                row = self._db.execute("SELECT expires_at, value FROM response_cache WHERE key = ? AND expires_at >= ?", (key, now)).fetchone()
+                if row is not None:
+                    entry = (row[0], bytes(row[1]))
+                    self._put(key, *entry)
+            if entry is None:
+                self.misses += 1
+                return None
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self.hits += 1
+            value = entry[1]
+        return json.loads(value)
+
+    def set(self, key, response):
+        """
+        Stores a response.
+
+        :param key: The key from :func:`make_request_key`.
+        :param response: The chat.completion dict.
+        """
+        value = json.dumps(response, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._put(key, expires_at, value)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO response_cache (key, expires_at, value) VALUES (?, ?, ?)", (key, expires_at, value))
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+                "evictions": self.evictions
+            }
@@ -0,0 +1,378 @@
+import json
+
+from libs.anthropic_stream import FkUSTChat_AnthropicTranscoder, STOP_REASONS
+from libs.cache import make_request_key, completion_to_sse, get_cache_mode
+from libs.completion import get_sampling
+from libs.conversations import FkUSTChat_ConversationNotFound, iter_recording, aiter_recording
+from libs.tokens import iter_with_usage, aiter_with_usage
+
+DEFAULT_MODEL = "__USTC_Adapter__deepseek-r1"
+
+
+def error_body(message, error_type="invalid_request_error", param=None, code=None):
+    return {
+        "error": {
+            "message": message,
+            "type": error_type,
+            "param": param,
+            "code": code
+        }
+    }
+
+
+def anthropic_error_body(message, error_type="invalid_request_error"):
+    return {
+        "type": "error",
+        "error": {
+            "type": error_type,
+            "message": message
+        }
+    }
+
+
+class FkUSTChat_RequestError(Exception):
+    def __init__(self, message, status_code=400, param=None, code=None):
+        """
+        A chat request the server refuses, reported to the client as an OpenAI-style ``invalid_request_error``.
+
+        :param message: The error message.
+        :param status_code: The HTTP status returned to the client.
+        :param param: The request parameter at fault, if any.
+        :param code: A machine-readable error code, if any.
+        """
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.param = param
+        self.code = code
+
+    def to_dict(self):
+        return error_body(self.message, param=self.param, code=self.code)
+
+    def to_anthropic_dict(self):
+        return anthropic_error_body(self.message)
+
+
+class FkUSTChat_ChatRequest:
+    def __init__(self, core, data, headers):
+        """
+        The work of a ``/v1/chat/completions`` call that does not depend on the web framework, shared
+        by the Flask app and the ASGI server: validating the body, continuing a conversation kept on
+        the server, the response cache and wrapping the answer. The frontends only read the request,
+        call the core and write the response.
+
+        :param core: The :class:`FkUSTChat_Core`.
+        :param data: The parsed request body.
+        :param headers: The request headers, looked up by lower-case name.
+        :raises FkUSTChat_RequestError: If ``n`` or the model is invalid.
+        """
+        self.core = core
+        self.data = data
+        self.headers = headers
+        self.stream = data.get("stream", False)
+        self.with_search = data.get("with_search", False)
+        self.model = data.get("model", DEFAULT_MODEL)
+        self.messages = data.get("messages", [])
+        self.new_messages = self.messages
+        self.tools = data.get("tools", [])
+        self.max_tokens = data.get("max_completion_tokens", data.get("max_tokens"))
+        self.stop = data.get("stop")
+        self.sampling = get_sampling(data)
+        self.n = data.get("n") or 1
+        self.include_usage = self.stream and (data.get("stream_options") or {}).get("include_usage")
+        self.conversation_id = None
+        self.conversation_key = None
+        self.cache_mode = None
+        self.cache_key = None
+        self.cache_hit = False
+
+        max_choices = core.get_core_config().get('max_choices', 8)
+        if not isinstance(self.n, int) or not 1 <= self.n <= max_choices:
+            raise FkUSTChat_RequestError(f"n must be an integer between 1 and {max_choices}", param="n")
+        if self.model not in core.models:
+            raise FkUSTChat_RequestError(f"Model '{self.model}' not found")
+
+    def start(self, client):
+        """
+        Continues the conversation the request belongs to and looks up the response cache.
+
+        :param client: The id the request is queued under; conversations are scoped by it.
+        :return: The cached chat.completion, or None if the request has to go upstream.
+        :raises FkUSTChat_RequestError: If the conversation does not exist or cannot be used.
+        """
+        # 带 conversation_id 的请求只包含本轮的新消息，历史由服务端保存
+        conversations = self.core.conversations
+        conversation_id = self.data.get("conversation_id")
+        options = self.data.get("conversation") or {}
+        if not isinstance(options, dict):
+            raise FkUSTChat_RequestError("conversation must be an object", param="conversation")
+        create = bool(options.get("create"))
+        if conversations is not None and (conversation_id or create):
+            if self.n > 1:
+                raise FkUSTChat_RequestError("n must be 1 in a conversation", param="n")
+            try:
+                self.conversation_id, self.conversation_key, self.messages = conversations.start_turn(
+                    conversation_id, self.messages, create=create, owner=client
+                )
+            except FkUSTChat_ConversationNotFound:
+                raise FkUSTChat_RequestError(
+                    f"Conversation '{conversation_id}' not found, send the full history with \"conversation\": {{\"create\": true}} to start it again",
+                    404, param="conversation_id", code="conversation_not_found"
+                )
+            except ValueError as e:
+                raise FkUSTChat_RequestError(str(e), param="conversation_id")
+
+        self.cache_mode = get_cache_mode(self.core.response_cache, self.data, self.headers)
+        if self.cache_mode != 'USE':
+            return None
+        self.cache_key = make_request_key(self.model, self.messages, self.tools, self.with_search, self.max_tokens, self.stop, self.sampling)
+        cached = self.core.response_cache.get(self.cache_key)
+        self.cache_hit = cached is not None
+        return cached
+
+    def response_headers(self):
+        """
+        :return: The ``X-FkUSTChat-*`` headers of the response, as ``(name, value)`` pairs.
+        """
+        headers = []
+        if self.cache_hit:
+            headers.append(('X-FkUSTChat-Cache', 'HIT'))
+        elif self.cache_mode:
+            headers.append(('X-FkUSTChat-Cache', 'MISS' if self.cache_key else self.cache_mode))
+        if self.conversation_id:
+            headers.append(('X-FkUSTChat-Conversation-Id', self.conversation_id))
+        return headers
+
+    def _options(self, client):
+        return dict(client=client, stream=self.stream, dedupe=self.data.get("temperature") in (None, 0), with_search=self.with_search,
+                    tools=self.tools, max_tokens=self.max_tokens, stop=self.stop, sampling=self.sampling)
+
+    def get_responses(self, client):
+        """
+        Sends the request upstream through :meth:`FkUSTChat_Core.get_responses`.
+
+        :param client: The id the request is queued under.
+        """
+        return self.core.get_responses(self.model, self.messages, self.n, **self._options(client))
+
+    async def aget_responses(self, client):
+        """
+        Async version of :meth:`get_responses`.
+        """
+        return await self.core.aget_responses(self.model, self.messages, self.n, **self._options(client))
+
+    def finish(self, response):
+        """
+        Completes a non-streamed answer: stores it in the cache and records the conversation turn.
+
+        :param response: The chat.completion from upstream or from the cache.
+        :return: The body to send.
+        """
+        if self.cache_key and not self.cache_hit:
+            self.core.response_cache.set(self.cache_key, response)
+        if self.conversation_id:
+            self.core.conversations.record(self.conversation_key, self.new_messages, response)
+            response = dict(response, conversation_id=self.conversation_id)
+        return response
+
+    def _prompt_tokens(self):
+        return self.core.count_prompt_tokens(self.model, self.messages, self.tools)
+
+    def wrap_stream(self, chunks):
+        """
+        Wraps a streamed answer to record the conversation turn and add the usage chunk, as requested.
+
+        :param chunks: An iterable of SSE chunks.
+        """
+        if self.conversation_id:
+            chunks = iter_recording(chunks, self.core.conversations, self.conversation_key, self.new_messages, self.model)
+        if self.include_usage:
+            chunks = iter_with_usage(chunks, self.core.create_token_counter(self.model), self._prompt_tokens())
+        return chunks
+
+    def awrap_stream(self, chunks):
+        """
+        Async version of :meth:`wrap_stream`.
+        """
+        if self.conversation_id:
+            chunks = aiter_recording(chunks, self.core.conversations, self.conversation_key, self.new_messages, self.model)
+        if self.include_usage:
+            chunks = aiter_with_usage(chunks, self.core.create_token_counter(self.model), self._prompt_tokens())
+        return chunks
+
+    def replay(self, cached):
+        """
+        Streams a cached chat.completion, see :meth:`wrap_stream`.
+        """
+        return self.wrap_stream(completion_to_sse(cached))
+
+
+def claude_to_openai_messages(claude_messages, system=None):
+    openai_msgs = []
+    if system:
+        openai_msgs.append({"role": "system", "content": system})
+    
+    for msg in claude_messages:
+        role = msg["role"]
+        content = msg["content"]
+        
+        if isinstance(content, str):
+            openai_msgs.append({"role": role, "content": content})
+        elif isinstance(content, list):
+            if role == "user":
+                for block in content:
+                    if block["type"] == "text":
+                        openai_msgs.append({"role": "user", "content": block["text"]})
+                    elif block["type"] == "tool_result":
+                        tool_content = block["content"]
+                        if not isinstance(tool_content, str):
+                            tool_content = json.dumps(tool_content)
+                        openai_msgs.append({
+                            "role": "tool",
+                            "content": tool_content,
+                            "tool_call_id": block["tool_use_id"]
+                        })
+            elif role == "assistant":
+                asst_content = ""
+                tool_calls = []
+                for block in content:
+                    if block["type"] == "text":
+                        asst_content += block["text"]
+                    elif block["type"] == "tool_use":
+                        tool_calls.append({
+                            "id": block["id"],
+                            "type": "function",
+                            "function": {
+                                "name": block["name"],
+                                "arguments": json.dumps(block["input"])
+                            }
+                        })
+                openai_msg = {"role": "assistant"}
+                if asst_content:
+                    openai_msg["content"] = asst_content
+                if tool_calls:
+                    openai_msg["tool_calls"] = tool_calls
+                openai_msgs.append(openai_msg)
+    
+    return openai_msgs
+
+
+def claude_to_openai_tools(claude_tools):
+    openai_tools = []
+    for tool in claude_tools:
+        openai_tools.append({
+            "type": "function",
+            "function": {
+                "name": tool["name"],
+                "description": tool.get("description", ""),
+                "parameters": tool.get("input_schema", {})
+            }
+        })
+    return openai_tools
+
+
+class FkUSTChat_MessagesRequest:
+    def __init__(self, core, data):
+        """
+        The work of an Anthropic ``/v1/messages`` call that does not depend on the web framework, shared
+        like :class:`FkUSTChat_ChatRequest`: validating the body and translating the request to, and the
+        answer from, the OpenAI format the adapters speak.
+
+        :param core: The :class:`FkUSTChat_Core`.
+        :param data: The parsed request body.
+        :raises FkUSTChat_RequestError: If the model is missing or unknown.
+        """
+        self.core = core
+        self.data = data
+        self.stream = data.get("stream", False)
+        self.with_search = data.get("with_search", False)
+        self.max_tokens = data.get("max_tokens")
+        self.messages = []
+        self.tools = []
+
+        model = data.get("model")
+        if not model:
+            raise FkUSTChat_RequestError("model is required")
+        if model not in core.models:
+            for model_txt in core.models:
+                if model_txt.lower() == model.lower():
+                    model = model_txt
+                    break
+            else:
+                raise FkUSTChat_RequestError(f"Model '{model}' not found")
+        self.model = model
+
+    def start(self):
+        """
+        Checks the rest of the body and converts the messages and tools to the OpenAI format.
+
+        :raises FkUSTChat_RequestError: If ``messages`` or ``max_tokens`` is missing.
+        """
+        if not self.data.get("messages"):
+            raise FkUSTChat_RequestError("messages is required")
+        if self.max_tokens is None:
+            raise FkUSTChat_RequestError("max_tokens is required")
+        self.messages = claude_to_openai_messages(self.data["messages"], self.data.get("system", None))
+        self.tools = claude_to_openai_tools(self.data.get("tools", []))
+
+    def _options(self, client):
+        return dict(client=client, stream=self.stream, dedupe=self.data.get("temperature") in (None, 0), with_search=self.with_search,
+                    tools=self.tools, max_tokens=self.max_tokens, stop=self.data.get("stop_sequences"))
+
+    def get_response(self, client):
+        """
+        Sends the request upstream through :meth:`FkUSTChat_Core.get_response`.
+
+        :param client: The id the request is queued under.
+        """
+        return self.core.get_response(self.model, self.messages, **self._options(client))
+
+    async def aget_response(self, client):
+        """
+        Async version of :meth:`get_response`.
+        """
+        return await self.core.aget_response(self.model, self.messages, **self._options(client))
+
+    def create_transcoder(self):
+        """
+        :return: A :class:`FkUSTChat_AnthropicTranscoder` for the streamed answer.
+        """
+        return FkUSTChat_AnthropicTranscoder(
+            self.model,
+            input_tokens=self.core.count_prompt_tokens(self.model, self.messages, self.tools),
+            counter=self.core.create_token_counter(self.model)
+        )
+
+    def to_message(self, openai_response):
+        """
+        Converts a chat.completion into an Anthropic message.
+        """
+        choice = openai_response["choices"][0]
+        message = choice["message"]
+        claude_content = []
+        if "content" in message and message["content"]:
+            claude_content.append({"type": "text", "text": message["content"]})
+        if "tool_calls" in message:
+            for tc in message["tool_calls"]:
+                fn = tc["function"]
+                input_dict = json.loads(fn["arguments"])
+                claude_content.append({
+                    "type": "tool_use",
+                    "id": tc["id"],
+                    "name": fn["name"],
+                    "input": input_dict
+                })
+        stop_reason = STOP_REASONS.get(choice["finish_reason"], choice["finish_reason"])
+        return {
+            "id": openai_response.get("id", "msg_1"),
+            "type": "message",
+            "role": "assistant",
+            "model": openai_response["model"],
+            "content": claude_content,
+            "stop_reason": stop_reason,
+            "stop_sequence": None,
+            "usage": {
+                "input_tokens": openai_response.get("usage", {}).get("prompt_tokens", 0),
+                "output_tokens": openai_response.get("usage", {}).get("completion_tokens", 0)
+            }
+        }
@@ -0,0 +1,428 @@
+import time
+
+from libs.json_codec import dumps, loads
+from libs.sse import FkUSTChat_ClosingStream, FkUSTChat_AsyncClosingStream
+from libs.tokens import FkUSTChat_HeuristicTokenizer, FkUSTChat_TokenCounter
+from libs.tool_calls import FkUSTChat_ToolCallAccumulator
+
+
+# 请求中可以转发给上游的采样参数
+SAMPLING_PARAMS = ("temperature", "top_p", "presence_penalty", "frequency_penalty", "seed")
+
+
+def get_sampling(data):
+    """
+    Picks the sampling parameters set in a chat request.
+
+    :return: A dict of the parameters that are present and not null, or None if there are none.
+    """
+    sampling = {name: data[name] for name in SAMPLING_PARAMS if data.get(name) is not None}
+    return sampling or None
+
+
+def normalize_stop(stop):
+    """
+    Turns the ``stop`` parameter of a chat request (a string, a list or None) into a list of non-empty strings.
+    """
+    if not stop:
+        return []
+    if isinstance(stop, str):
+        return [stop]
+    return [s for s in stop if isinstance(s, str) and s]
+
+
+class FkUSTChat_StopMatcher:
+    def __init__(self, stop):
+        """
+        Finds the first stop sequence in a text that arrives in pieces, including sequences split
+        across two pieces. Only a tail as long as the longest sequence is kept between pieces.
+
+        :param stop: The stop sequences.
+        """
+        self.stop = normalize_stop(stop)
+        self.keep = max((len(s) for s in self.stop), default=1) - 1
+        self.tail = ''
+        self.offset = 0
+
+    def feed(self, text):
+        """
+        :param text: The next piece.
+        :return: ``(position, sequence)`` of the first match in the whole text so far, or None.
+        """
+        window = self.tail + text
+        found = None
+        for sequence in self.stop:
+            position = window.find(sequence)
+            if position != -1 and (found is None or position < found[0]):
+                found = position, sequence
+        if found is not None:
+            return self.offset + found[0], found[1]
+        cut = max(len(window) - self.keep, 0)
+        self.offset += cut
+        self.tail = window[cut:]
+        return None
+
+    def pending(self):
+        """
+        Whether the text so far ends with the beginning of a stop sequence, i.e. the next piece may complete a match.
+        """
+        tail = self.tail
+        for sequence in self.stop:
+            for length in range(min(len(sequence) - 1, len(tail)), 0, -1):
+                if tail.endswith(sequence[:length]):
+                    return True
+        return False
+
+
+class FkUSTChat_CompletionCollector:
+    def __init__(self, model_name, max_tokens=None, stop=None, counter=None):
+        """
+        Builds a chat.completion result from the SSE lines of a streamed upstream answer.
+
+        Content is collected in a list and joined once. Collection ends at the upstream's finish
+        reason, after ``max_tokens`` output tokens (``finish_reason`` "length") or at the first stop
+        sequence (``finish_reason`` "stop", the sequence itself is cut off), so the caller can close
+        the upstream connection without reading the rest of the answer.
+
+        :param model_name: The model name reported in the result.
+        :param max_tokens: The maximum number of output tokens, or None.
+        :param stop: The stop sequences, as in the ``stop`` parameter of a chat request.
+        :param counter: The :class:`FkUSTChat_TokenCounter` measuring the output; defaults to the approximate tokenizer.
+        """
+        self.model_name = model_name
+        self.max_tokens = max_tokens
+        self.stop = FkUSTChat_StopMatcher(stop) if normalize_stop(stop) else None
+        self.counter = counter or FkUSTChat_TokenCounter(FkUSTChat_HeuristicTokenizer())
+
+        self.answer_id = ""
+        self.reasoning = []
+        self.content = []
+        self.content_length = 0
+        self.tool_calls = FkUSTChat_ToolCallAccumulator()
+        self.finish_reason = None
+        self.done = False
+
+    def feed_line(self, line):
+        """
+        Consumes one SSE line, as str or UTF-8 bytes.
+
+        :return: True once the answer is complete and the rest of the stream can be dropped.
+        """
+        if self.done or not line:
+            return self.done
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.startswith("data: "):
+            if line.strip() == "[DONE]":
+                self.done = True
+            return self.done
+        line = line[6:]
+        if line.strip() == "[DONE]":
+            self.done = True
+            return True
+        try:
+            data = loads(line)
+        except ValueError:
+            return False
+        return self.feed(data)
+
+    def feed(self, data):
+        """
+        Consumes one parsed chat.completion.chunk.
+
+        :return: True once the answer is complete.
+        """
+        if "id" in data:
+            self.answer_id = data.get("id", "")
+        if data.get("object") != "chat.completion.chunk":
+            return False
+        choice = (data.get("choices") or [{}])[0]
+        delta = choice.get("delta") or {}
+
+        # 推理模型的思考过程不参与停止序列匹配，但计入 max_tokens
+        reasoning = delta.get("reasoning_content")
+        if reasoning:
+            self.reasoning.append(reasoning)
+            if self.max_tokens is not None:
+                self.counter.feed(reasoning)
+
+        text = delta.get("content")
+        if text:
+            if self.stop is not None:
+                match = self.stop.feed(text)
+                if match is not None:
+                    # 去掉停止序列及其之后的内容
+                    keep = match[0] - self.content_length
+                    if keep > 0:
+                        self._add_content(text[:keep])
+                    elif keep < 0:
+                        self._truncate(match[0])
+                    return self._finish("stop")
+            self._add_content(text)
+
+        if delta.get("tool_calls"):
+            self.tool_calls.feed(delta["tool_calls"])
+            if self.max_tokens is not None:
+                for tc in delta["tool_calls"]:
+                    arguments = (tc.get("function") or {}).get("arguments")
+                    if arguments:
+                        self.counter.feed(arguments)
+
+        if self.max_tokens is not None and self._reached_max_tokens():
+            return self._finish("length")
+
+        finish_reason = choice.get("finish_reason")
+        if finish_reason:
+            return self._finish(finish_reason)
+        return False
+
+    def _add_content(self, text):
+        self.content.append(text)
+        self.content_length += len(text)
+        if self.max_tokens is not None:
+            self.counter.feed(text)
+
+    def _truncate(self, length):
+        # 停止序列跨越了已收集的片段，截到停止序列之前
+        content = ''.join(self.content)[:length]
+        self.content = [content]
+        self.content_length = len(content)
+
+    def _reached_max_tokens(self):
+        # 每个 token 至少一个字符，字符数没到上限时不必调用分词器
+        if self.counter.counted + self.counter.pending_size < self.max_tokens:
+            return False
+        return self.counter.total >= self.max_tokens
+
+    def _finish(self, finish_reason):
+        self.finish_reason = finish_reason
+        self.done = True
+        return True
+
+    def result(self):
+        """
+        Returns the collected chat.completion dict.
+        """
+        message = {
+            "role": "assistant",
+            "content": ''.join(self.content)
+        }
+        if self.reasoning:
+            message["reasoning_content"] = ''.join(self.reasoning)
+        tool_calls = self.tool_calls.get_tool_calls()
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+        finish_reason = self.finish_reason
+        if finish_reason is None or finish_reason == "stop" and tool_calls:
+            finish_reason = "tool_calls" if tool_calls else "stop"
+        return {
+            "id": self.answer_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": self.model_name,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": message,
+                    "finish_reason": finish_reason
+                }
+            ]
+        }
+
+
+class FkUSTChat_StreamLimiter:
+    def __init__(self, counter, max_tokens=None, stop=None):
+        """
+        Enforces ``max_tokens`` and ``stop`` on a streamed OpenAI answer, for upstreams that do not honour them.
+
+        Frames are forwarded unchanged until a limit is met. Then the stream is ended with a final
+        chunk carrying ``finish_reason`` "length" or "stop" and ``[DONE]``, and the caller can
+        close the upstream. Frames whose text may be the start of a stop sequence are held back
+        until the next text shows whether it is one, so the client never sees part of a stop sequence.
+
+        :param counter: The :class:`FkUSTChat_TokenCounter` measuring the output.
+        :param max_tokens: The maximum number of output tokens, or None.
+        :param stop: The stop sequences, as in the ``stop`` parameter of a chat request.
+        """
+        self.counter = counter
+        self.max_tokens = max_tokens
+        self.stop = FkUSTChat_StopMatcher(stop) if normalize_stop(stop) else None
+        self.meta = {}
+        self.index = 0
+        self.content_length = 0
+        self.held = []
+        self.held_text = []
+        self.held_from = 0
+        self.done = False
+
+    def _frame(self, delta, finish_reason=None):
+        chunk = {
+            "id": self.meta.get("id", ""),
+            "object": "chat.completion.chunk",
+            "created": self.meta.get("created", int(time.time())),
+            "model": self.meta.get("model", ""),
+            "choices": [{"index": self.index, "delta": delta, "finish_reason": finish_reason}]
+        }
+        return b'data: ' + dumps(chunk) + b'\n\n'
+
+    def _release(self, out):
+        out.extend(self.held)
+        self.held = []
+        self.held_text = []
+
+    def _end(self, out, finish_reason):
+        out.append(self._frame({}, finish_reason))
+        out.append(b'data: [DONE]\n\n')
+        self.done = True
+
+    def _reached_max_tokens(self):
+        # 每个 token 至少一个字符，字符数没到上限时不必调用分词器
+        if self.counter.counted + self.counter.pending_size < self.max_tokens:
+            return False
+        return self.counter.total >= self.max_tokens
+
+    def feed(self, chunk):
+        """
+        Consumes a chunk of complete frames.
+
+        :param chunk: Bytes or str holding one or more frames.
+        :return: A list of byte strings to forward.
+        """
+        if self.done:
+            return []
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        if b'\r' in chunk:
+            chunk = chunk.replace(b'\r\n', b'\n')
+        out = []
+        for frame in chunk.split(b'\n\n'):
+            if frame.strip():
+                self._feed_frame(frame + b'\n\n', out)
+                if self.done:
+                    break
+        return [b''.join(out)] if out else []
+
+    def _feed_frame(self, frame, out):
+        payload = None
+        for line in frame.split(b'\n'):
+            if line.startswith(b'data:'):
+                payload = line[5:].strip()
+        if payload == b'[DONE]':
+            self._release(out)
+            out.append(frame)
+            self.done = True
+            return
+        try:
+            data = loads(payload) if payload else None
+        except ValueError:
+            data = None
+        choices = data.get("choices") if isinstance(data, dict) else None
+        if not choices:
+            self._release(out)
+            out.append(frame)
+            return
+        if not self.meta:
+            self.meta.update((key, data[key]) for key in ("id", "created", "model") if key in data)
+        choice = choices[0]
+        self.index = choice.get("index", 0)
+        delta = choice.get("delta") or {}
+
+        text = delta.get("content")
+        if text and self.stop is not None:
+            match = self.stop.feed(text)
+            if match is not None:
+                # 只发送停止序列之前的内容（包括暂存的帧中的内容）
+                base = self.held_from if self.held else self.content_length
+                keep = (''.join(self.held_text) + text)[:max(match[0] - base, 0)]
+                self.held = []
+                self.held_text = []
+                if keep:
+                    out.append(self._frame({"content": keep}))
+                self._end(out, "stop")
+                return
+            if self.stop.pending() and not choice.get("finish_reason"):
+                if not self.held:
+                    self.held_from = self.content_length
+                self.held.append(frame)
+                self.held_text.append(text)
+                self.content_length += len(text)
+                if self.max_tokens is not None:
+                    if delta.get("reasoning_content"):
+                        self.counter.feed(delta["reasoning_content"])
+                    self.counter.feed(text)
+                    if self._reached_max_tokens():
+                        self._release(out)
+                        self._end(out, "length")
+                return
+        self._release(out)
+        out.append(frame)
+        if text:
+            self.content_length += len(text)
+        if self.max_tokens is None:
+            return
+        if delta.get("reasoning_content"):
+            self.counter.feed(delta["reasoning_content"])
+        if text:
+            self.counter.feed(text)
+        for tool_call in delta.get("tool_calls") or ():
+            arguments = (tool_call.get("function") or {}).get("arguments")
+            if arguments:
+                self.counter.feed(arguments)
+        if not choice.get("finish_reason") and self._reached_max_tokens():
+            self._end(out, "length")
+
+    def flush(self):
+        """
+        Returns the held frames if the stream ended without ``[DONE]``.
+        """
+        out = []
+        if not self.done:
+            self._release(out)
+            self.done = True
+        return [b''.join(out)] if out else []
+
+
+def iter_with_limits(chunks, counter, max_tokens=None, stop=None):
+    """
+    Applies :class:`FkUSTChat_StreamLimiter` to a stream of SSE chunks and closes the stream as soon as a limit is met.
+
+    :return: An iterator of bytes; closing it closes ``chunks``.
+    """
+    return FkUSTChat_ClosingStream(_iter_with_limits(chunks, counter, max_tokens, stop), (chunks,))
+
+
+def _iter_with_limits(chunks, counter, max_tokens=None, stop=None):
+    limiter = FkUSTChat_StreamLimiter(counter, max_tokens, stop)
+    try:
+        for chunk in chunks:
+            yield from limiter.feed(chunk)
+            if limiter.done:
+                return
+        yield from limiter.flush()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def aiter_with_limits(chunks, counter, max_tokens=None, stop=None):
+    """
+    Async version of :func:`iter_with_limits`.
+    """
+    return FkUSTChat_AsyncClosingStream(_aiter_with_limits(chunks, counter, max_tokens, stop), (chunks,))
+
+
+async def _aiter_with_limits(chunks, counter, max_tokens=None, stop=None):
+    limiter = FkUSTChat_StreamLimiter(counter, max_tokens, stop)
+    try:
+        async for chunk in chunks:
+            for frame in limiter.feed(chunk):
+                yield frame
+            if limiter.done:
+                return
+        for frame in limiter.flush():
+            yield frame
+    finally:
+        aclose = getattr(chunks, 'aclose', None)
+        if aclose is not None:
+            await aclose()
@@ -0,0 +1,216 @@
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+from os import path
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+    import msvcrt
+
+
+CONFIG_ENV = "FKUSTCHAT_CONFIG"
+
+
+class FkUSTChat_FileLock:
+    def __init__(self, lock_path):
+        """
+        An exclusive lock shared by every process using the same lock file.
+
+        :param lock_path: The lock file; it is created if missing and never removed.
+        """
+        self.lock_path = lock_path
+        self._local = threading.Lock()
+        self._file = None
+
+    def acquire(self):
+        self._local.acquire()
+        try:
+            self._file = open(self.lock_path, 'a+b')
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            else:
+                self._file.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        # LK_LOCK 只重试 10 秒，超时后继续等待
+                        continue
+        except BaseException:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._local.release()
+            raise
+
+    def release(self):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._file.close()
+            self._file = None
+            self._local.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def get_signature(file_path):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+class FkUSTChat_ConfigStore:
+    def __init__(self, config_path, flush_delay=0.5):
+        """
+        The config file, safe to share between threads and worker processes.
+
+        Writes go to an in-memory copy right away and are flushed to disk after ``flush_delay``
+        seconds, so a burst of writes (e.g. several tokens refreshed together) costs one rewrite.
+        A flush takes a lock shared with the other processes, re-reads the file, applies only the
+        keys written by this process on top of it, and replaces the file with an atomic rename, so
+        readers never see a half-written file and concurrent writers do not undo each other.
+
+        :param config_path: The config file.
+        :param flush_delay: Seconds writes are collected before they are flushed.
+        """
+        self.config_path = config_path
+        self.flush_delay = flush_delay
+
+        self.lock = FkUSTChat_FileLock(config_path + '.lock')
+        self._lock = threading.RLock()
+        self._pending = {}
+        self._timer = None
+        self._signature = None
+        self._watcher = None
+        self._stop = threading.Event()
+        self.data = {}
+
+        atexit.register(self.close)
+
+    def _read(self):
+        # 文件总是整体替换的，读取时不需要加锁
+        signature = get_signature(self.config_path)
+        if signature is None:
+            return {}, None
+        with open(self.config_path, 'r', encoding='utf-8') as f:
+            return json.load(f), signature
+
+    def _overlay(self, data):
+        # 尚未写入磁盘的修改覆盖在磁盘内容之上
+        for section, values in self._pending.items():
+            data.setdefault(section, {}).update(values)
+        return data
+
+    def load(self):
+        """
+        Reads the config from disk, including the writes of this process that are not flushed yet.
+
+        :return: A new dict; it also becomes :attr:`data`.
+        """
+        with self._lock:
+            data, self._signature = self._read()
+            self.data = self._overlay(data)
+            return self.data
+
+    def set(self, section, key, value):
+        """
+        Sets ``data[section][key]`` and schedules a flush.
+        """
+        with self._lock:
+            self.data.setdefault(section, {})[key] = value
+            self._pending.setdefault(section, {})[key] = value
+            if self._timer is None:
+                self._timer = threading.Timer(self.flush_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """
+        Writes the pending changes to disk now.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._pending:
+                return
+            with self.lock:
+                data, _ = self._read()
+                data = self._overlay(data)
+                self._write(data)
+                self._pending = {}
+                self._signature = get_signature(self.config_path)
+
+    def _write(self, data):
+        directory = path.dirname(path.abspath(self.config_path))
+        fd, temp_path = tempfile.mkstemp(prefix='.config.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            for attempt in range(10):
+                try:
+                    os.replace(temp_path, self.config_path)
+                    break
+                except PermissionError:
+                    # Windows 上其他进程正在读取时无法替换，稍后重试
+                    if attempt == 9:
+                        raise
+                    time.sleep(0.05)
+        except BaseException:
+            if path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def changed(self):
+        """
+        :return: True if another process replaced the file since this process last read or wrote it.
+        """
+        with self._lock:
+            return get_signature(self.config_path) != self._signature
+
+    def watch(self, callback, interval=2):
+        """
+        Calls ``callback`` from a background thread whenever another process changed the file.
+        Changes made by this process do not trigger it.
+        """
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    if self.changed():
+                        callback()
+                except Exception as e:
+                    print(f'[!] 配置同步失败: {e}')
+
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=run, daemon=True)
+            self._watcher.start()
+
+    def close(self):
+        """
+        Flushes the pending changes and stops the watcher.
+        """
+        self._stop.set()
+        try:
+            self.flush()
+        except Exception as e:
+            print(f'[!] 保存配置失败: {e}')
@@ -0,0 +1,326 @@
+import hashlib
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from libs.completion import FkUSTChat_CompletionCollector
+from libs.json_codec import dumps, loads
+from libs.sse import FkUSTChat_ClosingStream, FkUSTChat_AsyncClosingStream
+
+
+class FkUSTChat_ConversationNotFound(KeyError):
+    pass
+
+
+class _Conversation:
+    __slots__ = ('messages', 'size', 'updated_at')
+
+    def __init__(self, messages, size, updated_at):
+        self.messages = messages
+        self.size = size
+        self.updated_at = updated_at
+
+
+class FkUSTChat_ConversationStore:
+    def __init__(self, max_conversations=1024, max_bytes=64 * 1024 * 1024, ttl=86400, max_messages=0, path=None):
+        """
+        Keeps the history of chat conversations on the server, so a client only sends the new messages of each turn.
+
+        Conversations are kept in memory in LRU order, bounded by count and by the serialized size of
+        their messages. Messages are appended, never rewritten, so a turn costs only its own messages.
+        With ``path`` every conversation is also written to SQLite; it survives restarts and
+        evictions, and worker processes sharing the file see each other's turns. Conversations are
+        stored under the keys returned by :meth:`scoped_id`.
+
+        :param max_conversations: Maximum number of conversations kept in memory.
+        :param max_bytes: Maximum total size of the messages kept in memory.
+        :param ttl: Seconds an idle conversation is kept.
+        :param max_messages: Maximum number of non-system messages sent upstream per turn, the oldest are left out; 0 for no limit.
+        :param path: Optional SQLite file used as a backing store.
+        """
+        self.max_conversations = max_conversations
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_messages = max_messages
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+        self.evictions = 0
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS conversations (id TEXT PRIMARY KEY, length INTEGER, updated_at REAL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS conversation_messages (conversation_id TEXT, position INTEGER, message TEXT, PRIMARY KEY (conversation_id, position))")
+            self._delete_expired()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Builds a store from the ``conversations`` section of the core config.
+
+        :param config: The section dict, or None.
+        :return: The store, or None if it is disabled.
+        """
+        config = config or {}
+        if not config.get('enabled', True):
+            return None
+        return cls(
+            max_conversations=config.get('max_conversations', 1024),
+            max_bytes=config.get('max_bytes', 64 * 1024 * 1024),
+            ttl=config.get('ttl', 86400),
+            max_messages=config.get('max_messages', 0),
+            path=config.get('path')
+        )
+
+    @staticmethod
+    def new_id():
+        return f"conv_{uuid.uuid4().hex}"
+
+    @staticmethod
+    def scoped_id(owner, conversation_id):
+        """
+        Returns the key a conversation is stored under. Conversation ids are chosen by clients, so
+        they are scoped by the client that created the conversation; other clients cannot read or
+        continue it even if they know the id.
+
+        :param owner: The client id, e.g. the API key used for fair queueing. Only its hash is stored.
+        :param conversation_id: The conversation id sent by the client.
+        """
+        owner_hash = hashlib.sha256((owner or '').encode('utf-8')).hexdigest()[:32]
+        return f"{owner_hash}:{conversation_id}"
+
+    def _delete_expired(self):
+        expired_before = time.time() - self.ttl
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            self._db.execute("DELETE FROM conversation_messages WHERE conversation_id IN (SELECT id FROM conversations WHERE updated_at < ?)", (expired_before,))
+            self._db.execute("DELETE FROM conversations WHERE updated_at < ?", (expired_before,))
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+    def _drop(self, conversation_id):
+        # 在持有锁时调用
+        entry = self._entries.pop(conversation_id, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def _evict(self):
+        # 在持有锁时调用
+        while self._entries and (len(self._entries) > self.max_conversations or self._bytes > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            self.evictions += 1
+
+    def _load(self, conversation_id, now):
+        # 在持有锁时调用；内存中的记录可能过期、被淘汰，或落后于其他 worker 写入的内容
+        entry = self._entries.get(conversation_id)
+        if entry is not None and entry.updated_at + self.ttl < now:
+            self._drop(conversation_id)
+            entry = None
+        if self._db is None:
+            return entry
+        row = self._db.execute("SELECT length, updated_at FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+        if row is not None and row[1] + self.ttl < now:
+            self._delete_rows(conversation_id)
+            row = None
+        if row is None:
+            self._drop(conversation_id)
+            return None
+        if entry is None:
+            entry = self._entries[conversation_id] = _Conversation([], 0, row[1])
+        if len(entry.messages) < row[0]:
+            rows = self._db.execute(
+                "SELECT message FROM conversation_messages WHERE conversation_id = ? AND position >= ? ORDER BY position",
+                (conversation_id, len(entry.messages))
+            ).fetchall()
+            for (message,) in rows:
+                entry.messages.append(loads(message))
+                entry.size += len(message)
+                self._bytes += len(message)
+            entry.updated_at = row[1]
+        return entry
+
+    def get(self, conversation_id):
+        """
+        :return: The messages of a conversation, or None if it does not exist or has expired.
+        """
+        with self._lock:
+            entry = self._load(conversation_id, time.time())
+            if entry is None:
+                return None
+            self._entries.move_to_end(conversation_id)
+            messages = list(entry.messages)
+            self._evict()
+        return messages
+
+    def append(self, conversation_id, messages):
+        """
+        Appends messages to a conversation, creating it if needed.
+
+        :param conversation_id: The conversation.
+        :param messages: The new messages, e.g. the user message of a turn and the assistant reply.
+        """
+        now = time.time()
+        values = [dumps(message) for message in messages]
+        with self._lock:
+            entry = self._load(conversation_id, now)
+            if entry is None:
+                entry = self._entries[conversation_id] = _Conversation([], 0, now)
+            if self._db is not None:
+                self._db.execute("BEGIN IMMEDIATE")
+                try:
+                    row = self._db.execute("SELECT length FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+                    length = row[0] if row is not None else 0
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO conversation_messages (conversation_id, position, message) VALUES (?, ?, ?)",
+                        [(conversation_id, length + i, value.decode('utf-8')) for i, value in enumerate(values)]
+                    )
+                    self._db.execute("INSERT OR REPLACE INTO conversations (id, length, updated_at) VALUES (?, ?, ?)", (conversation_id, length + len(values), now))
+                    self._db.execute("COMMIT")
+                except BaseException:
+                    self._db.execute("ROLLBACK")
+                    raise
+                if length != len(entry.messages):
+                    # 其他 worker 在这期间也写入了，下次读取时重新加载
+                    self._drop(conversation_id)
+                    return
+            entry.messages.extend(messages)
+            size = sum(len(value) for value in values)
+            entry.size += size
+            entry.updated_at = now
+            self._bytes += size
+            self._entries.move_to_end(conversation_id)
+            self._evict()
+
+    def delete(self, conversation_id):
+        """
+        :return: Whether the conversation existed.
+        """
+        with self._lock:
+            existed = self._load(conversation_id, time.time()) is not None
+            self._drop(conversation_id)
+            if self._db is not None:
+                self._delete_rows(conversation_id)
+        return existed
+
+    def _delete_rows(self, conversation_id):
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            self._db.execute("DELETE FROM conversation_messages WHERE conversation_id = ?", (conversation_id,))
+            self._db.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+    def build_messages(self, history, messages):
+        """
+        Builds the messages sent upstream for a turn: the history followed by the new messages,
+        keeping the system messages and at most ``max_messages`` of the others.
+        """
+        messages = history + messages
+        if not self.max_messages:
+            return messages
+        others = [i for i, message in enumerate(messages) if message.get("role") != "system"]
+        if len(others) <= self.max_messages:
+            return messages
+        first = others[-self.max_messages]
+        return [message for i, message in enumerate(messages) if i >= first or message.get("role") == "system"]
+
+    def start_turn(self, conversation_id, messages, create=False, owner=None):
+        """
+        Looks up the conversation a chat request continues.
+
+        :param conversation_id: The conversation id sent by the client, or None to create a new conversation.
+        :param messages: The new messages of the request.
+        :param create: Whether an unknown conversation is created, with ``messages`` as its first messages.
+        :param owner: The client id the conversation is scoped by, see :meth:`scoped_id`.
+        :return: ``(conversation_id, the key to record the turn under, the messages to send upstream)``.
+        :raises FkUSTChat_ConversationNotFound: If the conversation does not exist and ``create`` is not set.
+        :raises ValueError: If the id is not a string of at most 128 characters.
+        """
+        if conversation_id is not None and (not isinstance(conversation_id, str) or len(conversation_id) > 128):
+            raise ValueError("conversation_id must be a string of at most 128 characters")
+        history = self.get(self.scoped_id(owner, conversation_id)) if conversation_id else None
+        if history is None:
+            if not create:
+                raise FkUSTChat_ConversationNotFound(conversation_id)
+            conversation_id = conversation_id or self.new_id()
+            return conversation_id, self.scoped_id(owner, conversation_id), messages
+        return conversation_id, self.scoped_id(owner, conversation_id), self.build_messages(history, messages)
+
+    def record(self, conversation_id, messages, completion):
+        """
+        Records a finished turn: the new messages of the request and the first choice of the answer.
+        The reasoning of the answer is left out, it is not sent upstream again in later turns.
+        """
+        choices = completion.get("choices") or ()
+        if choices:
+            message = {key: value for key, value in choices[0]["message"].items() if key != "reasoning_content"}
+            self.append(conversation_id, list(messages) + [message])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "conversations": len(self._entries),
+                "bytes": self._bytes,
+                "evictions": self.evictions
+            }
+
+
+def _feed_chunk(collector, chunk):
+    if isinstance(chunk, str):
+        chunk = chunk.encode('utf-8')
+    for line in chunk.split(b'\n'):
+        collector.feed_line(line.rstrip(b'\r'))
+
+
+def iter_recording(chunks, store, conversation_id, messages, model_name):
+    """
+    Passes an SSE stream through and records the turn once the answer is complete. Nothing is
+    recorded if the stream fails or the client leaves, so the turn can be sent again.
+    """
+    return FkUSTChat_ClosingStream(_iter_recording(chunks, store, conversation_id, messages, model_name), (chunks,))
+
+
+def _iter_recording(chunks, store, conversation_id, messages, model_name):
+    collector = FkUSTChat_CompletionCollector(model_name)
+    try:
+        for chunk in chunks:
+            _feed_chunk(collector, chunk)
+            yield chunk
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+    if collector.done:
+        store.record(conversation_id, messages, collector.result())
+
+
+def aiter_recording(chunks, store, conversation_id, messages, model_name):
+    """
+    Async version of :func:`iter_recording`.
+    """
+    return FkUSTChat_AsyncClosingStream(_aiter_recording(chunks, store, conversation_id, messages, model_name), (chunks,))
+
+
+async def _aiter_recording(chunks, store, conversation_id, messages, model_name):
+    collector = FkUSTChat_CompletionCollector(model_name)
+    try:
+        async for chunk in chunks:
+            _feed_chunk(collector, chunk)
+            yield chunk
+    finally:
+        aclose = getattr(chunks, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+    if collector.done:
+        store.record(conversation_id, messages, collector.result())
@@ -1,14 +1,50 @@
-import json
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from os import path
 
+from libs.cache import FkUSTChat_ResponseCache, make_request_key
+from libs.conversations import FkUSTChat_ConversationStore
+from libs.scheduler import FkUSTChat_Scheduler, FkUSTChat_SlotIterator, FkUSTChat_AsyncSlotIterator
+from libs.singleflight import FkUSTChat_SingleFlight
+from libs.config_store import FkUSTChat_ConfigStore, CONFIG_ENV
+from libs.shared_state import FkUSTChat_SharedState, get_worker_count
+from libs.metrics import REGISTRY, FkUSTChat_MeteredStream, FkUSTChat_AsyncMeteredStream
+from libs.tracing import TRACER, start_span
+from libs.tokens import FkUSTChat_Tokenizers, FkUSTChat_TokenCounter, make_usage
+from libs.completion import iter_with_limits, aiter_with_limits
+from libs.fanout import merge_completions, iter_merged_streams, aiter_merged_streams
+
 class FkUSTChat_Core:
-    def __init__(self):
+    def __init__(self, config_file=None):
         self.adapters = {}
         self.models = {}
 
-        self.CONFIG_FILE = path.join(path.dirname(__file__), "../config")
+        self.CONFIG_FILE = config_file or os.environ.get(CONFIG_ENV) or path.join(path.dirname(__file__), "../config")
+        self.config_store = FkUSTChat_ConfigStore(self.CONFIG_FILE)
         self.config = {}
+        self._reload_lock = threading.Lock()
         self.load_config()
+
+        store_config = self.get_core_config().get('config_store', {})
+        self.config_store.flush_delay = store_config.get('flush_delay', 0.5)
+        if store_config.get('watch_interval', 2) > 0:
+            # 其他 worker 进程写入的配置（如新的 Credential）在这里同步过来
+            self.config_store.watch(self.reload_config, store_config.get('watch_interval', 2))
+
+        self.shared_state = FkUSTChat_SharedState.from_config(self.get_core_config().get('shared_state'))
+        self.scheduler = FkUSTChat_Scheduler(worker_count=get_worker_count())
+        self.scheduler.configure(self.get_core_config().get('scheduler', {}))
+        self.response_cache = FkUSTChat_ResponseCache.from_config(self.get_response_cache_config())
+        self.conversations = FkUSTChat_ConversationStore.from_config(self.get_conversations_config())
+        self.single_flight = FkUSTChat_SingleFlight() if self.get_core_config().get('single_flight', True) else None
+        self.tokenizers = FkUSTChat_Tokenizers.from_config(self.get_core_config().get('tokenizers'))
+        REGISTRY.add_collector(self.collect_metrics)
+        TRACER.configure(self.get_core_config().get('tracing'))
     
     def add_model(self, model_name, model):
         """
@@ -34,28 +70,298 @@ class FkUSTChat_Core:
             adapter.load_config(self.config[adapter.name])
         for model_name, model in adapter.models.items():
             self.add_model(f'__{adapter.name}__{model_name}', model)
+
+        self.apply_adapter_limits(adapter)
         return adapter.name
+
+    def apply_adapter_limits(self, adapter):
+        self.scheduler.set_adapter_limit(adapter.name, adapter.config.get('max_concurrency'))
+        model_limits = adapter.config.get('model_concurrency', {})
+        for model_name in adapter.models:
+            self.scheduler.set_model_limit(f'__{adapter.name}__{model_name}', model_limits.get(model_name))
+
+    def replace_adapter(self, adapter):
+        """
+        Registers an adapter, atomically replacing a registered adapter with the same name.
+
+        The adapter and model tables are swapped as a whole, so a request sees either the old or the
+        new instances. Requests that already started keep running on the old ones.
+
+        :param adapter: The new adapter instance.
+        """
+        if adapter.name in self.config:
+            adapter.load_config(self.config[adapter.name])
+        old = self.adapters.get(adapter.name)
+        adapters = dict(self.adapters)
+        adapters[adapter.name] = adapter
+        models = {name: model for name, model in self.models.items() if old is None or not name.startswith(f'__{old.name}__')}
+        for model_name, model in adapter.models.items():
+            models[f'__{adapter.name}__{model_name}'] = model
+        self.adapters, self.models = adapters, models
+        self.apply_adapter_limits(adapter)
+        if old is not None:
+            old.close()
+        return adapter.name
+
+    def unregister_adapter(self, adapter_name):
+        """
+        Removes an adapter and its models. Requests that already started keep running on them.
+        """
+        old = self.adapters.get(adapter_name)
+        if old is None:
+            return
+        adapters = {name: adapter for name, adapter in self.adapters.items() if name != adapter_name}
+        models = {name: model for name, model in self.models.items() if not name.startswith(f'__{adapter_name}__')}
+        self.adapters, self.models = adapters, models
+        old.close()
+
+    def get_response(self, model_name, prompt, client=None, stream=False, dedupe=False, **kwargs):
+        """
+        Runs a request against a registered model once the scheduler grants it an upstream slot.
+
+        :param model_name: The registered model name.
+        :param prompt: The input messages.
+        :param client: The id used for fair queueing, e.g. the API key.
+        :param stream: Whether to return an iterator of SSE chunks.
+        :param dedupe: Whether the request may share the upstream call of an identical in-flight request.
+        :return: The model response. For streams the slot is held until the iterator is exhausted or closed,
+                 and ``max_tokens`` and ``stop`` are enforced on the streamed output.
+        :raises FkUSTChat_QueueTimeout: If no slot became free in time.
+        """
+        started_at = time.perf_counter()
+        if dedupe and self.single_flight is not None:
+            key = make_request_key(model_name, prompt, kwargs.get('tools'), kwargs.get('with_search'), kwargs.get('max_tokens'), kwargs.get('stop'), kwargs.get('sampling'))
+            call = lambda: self._call_model(model_name, prompt, client, stream, **kwargs)
+            if stream:
+                return self.limit_stream(model_name, FkUSTChat_MeteredStream(self.single_flight.stream(key, call), model_name, started_at, start_span('stream', model=model_name, shared=True)), kwargs)
+            return self.single_flight.do(key, call)
+        response = self._call_model(model_name, prompt, client, stream, **kwargs)
+        if stream:
+            return self.limit_stream(model_name, FkUSTChat_MeteredStream(response, model_name, started_at, start_span('stream', model=model_name)), kwargs)
+        return response
+
+    def get_responses(self, model_name, prompt, n=1, client=None, stream=False, dedupe=False, **kwargs):
+        """
+        Runs ``n`` upstream calls for the same request concurrently and merges them into one response with ``n`` choices.
+
+        Every call is scheduled like a request of its own, so together they respect the concurrency
+        limits, and identical calls are never merged into one upstream call.
+
+        :param n: The number of choices.
+        :return: As :meth:`get_response` for ``n == 1``; otherwise the merged chat.completion, or
+                 a stream interleaving the chunks of the calls with the choice index rewritten.
+        :raises Exception: The first error of the calls, after closing the streams that did open.
+        """
+        if n <= 1:
+            return self.get_response(model_name, prompt, client, stream, dedupe, **kwargs)
+        with ThreadPoolExecutor(n) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, partial(self.get_response, model_name, prompt, client, stream, False, **kwargs)) for _ in range(n)]
+        results, errors = [], []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            for result in results if stream else ():
+                result.close()
+            raise errors[0]
+        return iter_merged_streams(results) if stream else merge_completions(results)
+
+    def limit_stream(self, model_name, stream, kwargs):
+        """
+        Wraps a streamed response to enforce the request's ``max_tokens`` and ``stop``, for upstreams that do not apply them.
+        """
+        max_tokens, stop = kwargs.get('max_tokens'), kwargs.get('stop')
+        if max_tokens is None and not stop:
+            return stream
+        limit = aiter_with_limits if hasattr(stream, '__aiter__') else iter_with_limits
+        return limit(stream, self.create_token_counter(model_name), max_tokens, stop)
+
+    def _call_model(self, model_name, prompt, client, stream, **kwargs):
+        model = self.models[model_name]
+        with start_span('scheduler.acquire', model=model_name):
+            slot = self.scheduler.acquire(model_name, model.adapter.name, client)
+        try:
+            with start_span('adapter.get_response', model=model_name, stream=stream):
+                response = model.get_response(prompt, stream=stream, **kwargs)
+        except BaseException:
+            slot.release()
+            raise
+        if stream:
+            return FkUSTChat_SlotIterator(response, slot)
+        slot.release()
+        self.add_usage(model_name, prompt, kwargs.get('tools'), response)
+        return response
+
+    async def aget_response(self, model_name, prompt, client=None, stream=False, dedupe=False, **kwargs):
+        """
+        Async version of :meth:`get_response`.
+        """
+        started_at = time.perf_counter()
+        if dedupe and self.single_flight is not None:
+            key = make_request_key(model_name, prompt, kwargs.get('tools'), kwargs.get('with_search'), kwargs.get('max_tokens'), kwargs.get('stop'), kwargs.get('sampling'))
+            call = lambda: self._acall_model(model_name, prompt, client, stream, **kwargs)
+            if stream:
+                return self.limit_stream(model_name, FkUSTChat_AsyncMeteredStream(await self.single_flight.astream(key, call), model_name, started_at, start_span('stream', model=model_name, shared=True)), kwargs)
+            return await self.single_flight.ado(key, call)
+        response = await self._acall_model(model_name, prompt, client, stream, **kwargs)
+        if stream:
+            return self.limit_stream(model_name, FkUSTChat_AsyncMeteredStream(response, model_name, started_at, start_span('stream', model=model_name)), kwargs)
+        return response
+
+    async def aget_responses(self, model_name, prompt, n=1, client=None, stream=False, dedupe=False, **kwargs):
+        """
+        Async version of :meth:`get_responses`.
+        """
+        if n <= 1:
+            return await self.aget_response(model_name, prompt, client, stream, dedupe, **kwargs)
+        outcomes = await asyncio.gather(*(self.aget_response(model_name, prompt, client, stream, False, **kwargs) for _ in range(n)), return_exceptions=True)
+        results = [outcome for outcome in outcomes if not isinstance(outcome, BaseException)]
+        if len(results) < n:
+            for result in results if stream else ():
+                await result.aclose()
+            raise next(outcome for outcome in outcomes if isinstance(outcome, BaseException))
+        return aiter_merged_streams(results) if stream else merge_completions(results)
+
+    async def _acall_model(self, model_name, prompt, client, stream, **kwargs):
+        model = self.models[model_name]
+        with start_span('scheduler.acquire', model=model_name):
+            slot = await self.scheduler.aacquire(model_name, model.adapter.name, client)
+        try:
+            with start_span('adapter.get_response', model=model_name, stream=stream):
+                response = await model.aget_response(prompt, stream=stream, **kwargs)
+        except BaseException:
+            slot.release()
+            raise
+        if stream:
+            return FkUSTChat_AsyncSlotIterator(response, slot)
+        slot.release()
+        self.add_usage(model_name, prompt, kwargs.get('tools'), response)
+        return response
+
+    def collect_metrics(self):
+        """
+        Reports the scheduler, cache and single-flight counters and the adapters' own metrics at scrape time.
+        """
+        stats = self.scheduler.stats()
+        yield 'fkustchat_scheduler_queue_depth', 'gauge', 'Requests waiting for an upstream slot.', [({}, stats['queue_depth'])]
+        yield 'fkustchat_scheduler_granted_total', 'counter', 'Upstream slots granted.', [({}, stats['granted_total'])]
+        yield 'fkustchat_scheduler_rejected_total', 'counter', 'Requests rejected because no slot became free.', [({}, stats['rejected_total'])]
+        yield 'fkustchat_scheduler_wait_seconds_total', 'counter', 'Total time spent waiting for slots.', [({}, stats['wait_time_seconds_total'])]
+        yield 'fkustchat_model_active_requests', 'gauge', 'Upstream requests holding a slot, by model.', [({'model': name}, model['active']) for name, model in stats['models'].items()]
+        yield 'fkustchat_model_waiting_requests', 'gauge', 'Requests waiting for a slot, by model.', [({'model': name}, model['waiting']) for name, model in stats['models'].items()]
+        if self.response_cache is not None:
+            cache = self.response_cache.stats()
+            yield 'fkustchat_response_cache_hits_total', 'counter', 'Response cache hits.', [({}, cache['hits'])]
+            yield 'fkustchat_response_cache_misses_total', 'counter', 'Response cache misses.', [({}, cache['misses'])]
+            yield 'fkustchat_response_cache_hit_ratio', 'gauge', 'Share of cache lookups that hit.', [({}, cache['hit_ratio'])]
+            yield 'fkustchat_response_cache_entries', 'gauge', 'Entries in the in-memory response cache.', [({}, cache['entries'])]
+        if self.conversations is not None:
+            yield 'fkustchat_conversations', 'gauge', 'Conversations kept in memory.', [({}, self.conversations.stats()['conversations'])]
+        if self.single_flight is not None:
+            flights = self.single_flight.stats()
+            yield 'fkustchat_single_flight_followers_total', 'counter', 'Requests that shared an identical in-flight upstream call.', [({}, flights['followers'])]
+        for adapter in self.adapters.values():
+            yield from adapter.collect_metrics()
+
+    def count_prompt_tokens(self, model_name, messages, tools=None):
+        """
+        Counts the prompt tokens of a request with the tokenizer of the model's family.
+
+        :param model_name: The registered model name.
+        :param messages: The chat messages.
+        :param tools: The tool definitions.
+        :return: The number of prompt tokens.
+        """
+        return self.tokenizers.count_messages(self.models[model_name].tokenizer, messages, tools)
+
+    def create_token_counter(self, model_name):
+        """
+        Returns a :class:`FkUSTChat_TokenCounter` for the streamed output of a model.
+        """
+        return FkUSTChat_TokenCounter(self.tokenizers.get(self.models[model_name].tokenizer))
+
+    def add_usage(self, model_name, prompt, tools, response):
+        """
+        Fills in the ``usage`` of a chat.completion result when the upstream did not report it.
+        """
+        if isinstance(response, dict) and not response.get("usage"):
+            response["usage"] = make_usage(
+                self.count_prompt_tokens(model_name, prompt, tools),
+                self.tokenizers.count_completion(self.models[model_name].tokenizer, response)
+            )
     
     def set_adapter_config(self, adapter_name, key, config):
         """
-        Sets the config for a specific adapter.
+        Sets the config for a specific adapter. The change is visible at once and written to the
+        config file shortly after, see :class:`FkUSTChat_ConfigStore`.
         
         :param adapter_name: The name of the adapter.
         :param config: The config data to be set for the adapter.
         """
-        if adapter_name not in self.config:
-            self.config[adapter_name] = {}
-
-        self.config[adapter_name][key] = config
-        with open(self.CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(self.config, f, ensure_ascii=False, indent=4)
+        self.config_store.set(adapter_name, key, config)
     
+    def get_core_config(self):
+        """
+        Returns the settings of the core itself, stored under the ``FkUSTChat_Core`` key of the config file.
+        """
+        return self.config.get('FkUSTChat_Core', {})
+
+    def get_response_cache_config(self):
+        """
+        Returns the ``response_cache`` section; with shared state, the cache is kept in the shared file by default so every worker sees it.
+        """
+        config = self.get_core_config().get('response_cache')
+        if config and self.shared_state is not None and not config.get('path'):
+            config = dict(config, path=self.shared_state.path)
+        return config
+
+    def get_conversations_config(self):
+        """
+        Returns the ``conversations`` section; with shared state, conversations are kept in the shared file by default so every worker sees them.
+        """
+        config = self.get_core_config().get('conversations') or {}
+        if self.shared_state is not None and not config.get('path'):
+            config = dict(config, path=self.shared_state.path)
+        return config
+
+    def reload_config(self):
+        """
+        Re-reads the config file and applies the sections that changed.
+
+        :return: True if anything changed.
+        """
+        with self._reload_lock:
+            return self._reload_config()
+
+    def _reload_config(self):
+        old = self.config
+        self.load_config()
+        if self.config == old:
+            return False
+        core_config = self.get_core_config()
+        old_core_config = old.get('FkUSTChat_Core', {})
+        if core_config.get('scheduler') != old_core_config.get('scheduler'):
+            self.scheduler.configure(core_config.get('scheduler', {}))
+        if core_config.get('response_cache') != old_core_config.get('response_cache'):
+            self.response_cache = FkUSTChat_ResponseCache.from_config(self.get_response_cache_config())
+        if core_config.get('conversations') != old_core_config.get('conversations'):
+            self.conversations = FkUSTChat_ConversationStore.from_config(self.get_conversations_config())
+        if core_config.get('single_flight', True) != old_core_config.get('single_flight', True):
+            self.single_flight = FkUSTChat_SingleFlight() if core_config.get('single_flight', True) else None
+        if core_config.get('tracing') != old_core_config.get('tracing'):
+            TRACER.configure(core_config.get('tracing'))
+        if core_config.get('tokenizers') != old_core_config.get('tokenizers'):
+            self.tokenizers = FkUSTChat_Tokenizers.from_config(core_config.get('tokenizers'))
+        for adapter_name, adapter in self.adapters.items():
+            if self.config.get(adapter_name, {}) != old.get(adapter_name, {}):
+                adapter.load_config(self.config.get(adapter_name, {}))
+                self.apply_adapter_limits(adapter)
+        return True
+
     def load_config(self):
         """
         Loads the config from the config file.
         """
-        if path.exists(self.CONFIG_FILE):
-            with open(self.CONFIG_FILE, 'r', encoding='utf-8') as f:
-                self.config = json.load(f)
-        else:
-            self.config = {}
\ No newline at end of file
+        self.config = self.config_store.load()
\ No newline at end of file
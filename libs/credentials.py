@@ -0,0 +1,193 @@
+import base64
+import json
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+
+def decode_token_expiry(token):
+    """
+    Decodes the expiry time of a JWT-style bearer token.
+
+    :param token: The bearer token.
+    :return: The ``exp`` claim as a unix timestamp, or None if the token carries no readable expiry.
+    """
+    if not token or not isinstance(token, str):
+        return None
+    parts = token.split('.')
+    if len(parts) != 3:
+        return None
+    try:
+        payload = parts[1] + '=' * (-len(parts[1]) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+        exp = claims.get('exp')
+        return float(exp) if exp is not None else None
+    except Exception:
+        return None
+
+
+class FkUSTChat_CredentialManager:
+    def __init__(self, load_token, probe, login, ttl=300, expiry_margin=60, refresh_ahead=300, login_timeout=60, login_retry_delay=30):
+        """
+        Keeps an upstream token valid without making requests wait for probes or logins.
+
+        A token that passed a probe is trusted for ``ttl`` seconds. After that it keeps being
+        served while a background thread re-checks it. Once the token enters its ``refresh_ahead``
+        window before the decoded expiry, a login starts in the background and requests keep using
+        the old token until the new one arrives.
+
+        Only one probe or login runs at a time. Requests that have no usable token (none stored,
+        invalidated after a 401, or past ``expiry_margin``) wait on that shared attempt instead of
+        starting their own. A failed login is not retried for ``login_retry_delay`` seconds, so a
+        broken login does not make every request wait for it again.
+
+        :param load_token: Callable returning the currently stored token, or None.
+        :param probe: Callable taking a token and returning True if upstream still accepts it.
+        :param login: Callable performing a login and returning the new token, or a falsy value on failure.
+        :param ttl: Seconds a successful probe is trusted before a background re-check.
+        :param expiry_margin: Seconds before the decoded expiry after which the token is no longer used.
+        :param refresh_ahead: Seconds before the decoded expiry at which a background login starts.
+        :param login_timeout: Seconds a request waits for a running login.
+        :param login_retry_delay: Seconds after a failed login before the next attempt.
+        """
+        self.load_token = load_token
+        self.probe = probe
+        self.login = login
+        self.ttl = ttl
+        self.expiry_margin = expiry_margin
+        self.refresh_ahead = refresh_ahead
+        self.login_timeout = login_timeout
+        self.login_retry_delay = login_retry_delay
+
+        self._lock = threading.Lock()
+        self._token = None
+        self._validated_at = 0
+        self._expires_at = None
+        self._rechecking = False
+        self._pending = None
+        self._failure = None
+        self._failed_at = 0
+        self._timer = None
+
+    def _accept(self, token):
+        # 在持有锁时调用
+        self._token = token
+        self._validated_at = time.time()
+        self._expires_at = decode_token_expiry(token)
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._expires_at is not None:
+            # 到期前 refresh_ahead 秒主动在后台登录
+            delay = max(self._expires_at - self.refresh_ahead - time.time(), 0)
+            self._timer = threading.Timer(delay, self.refresh)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _is_expiring(self, now):
+        return self._expires_at is not None and now >= self._expires_at - self.expiry_margin
+
+    def _is_due(self, now):
+        return self._expires_at is not None and now >= self._expires_at - self.refresh_ahead
+
+    def _recheck(self, token):
+        try:
+            valid = self.probe(token)
+        except Exception:
+            valid = True
+        with self._lock:
+            self._rechecking = False
+            if self._token != token:
+                return
+            if valid:
+                self._validated_at = time.time()
+            else:
+                self._token = None
+
+    def _obtain(self, candidate, future):
+        try:
+            if candidate and self.probe(candidate):
+                token = candidate
+            else:
+                token = self.login()
+                if not token:
+                    raise ValueError("登录失败，无法获取 Credential")
+        except BaseException as e:
+            with self._lock:
+                self._pending = None
+                self._failure = e
+                self._failed_at = time.time()
+            print(f'[!] 获取 Credential 失败: {e}')
+            future.set_exception(e)
+            return
+        with self._lock:
+            self._pending = None
+            self._failure = None
+            self._accept(token)
+        future.set_result(token)
+
+    def _start(self, candidate=None):
+        # 在持有锁时调用；返回正在进行的获取任务，必要时新建一个
+        if self._pending is None:
+            if self._failure is not None and time.time() - self._failed_at < self.login_retry_delay:
+                future = Future()
+                future.set_exception(self._failure)
+                return future
+            self._pending = Future()
+            threading.Thread(target=self._obtain, args=(candidate, self._pending), daemon=True).start()
+        return self._pending
+
+    def get_token(self):
+        """
+        Returns a token that is believed to be valid, waiting only when there is no usable one.
+
+        :return: The bearer token.
+        :raises ValueError: If no token could be obtained.
+        """
+        with self._lock:
+            token = self.load_token()
+            now = time.time()
+            if token and token == self._token and not self._is_expiring(now):
+                if self._is_due(now):
+                    self._start()
+                elif now - self._validated_at >= self.ttl and not self._rechecking:
+                    self._rechecking = True
+                    threading.Thread(target=self._recheck, args=(token,), daemon=True).start()
+                return token
+
+            # 配置中新出现的 Credential 先校验再使用，已失效或快过期的直接重新登录
+            candidate = token if token and token != self._token else None
+            expires_at = decode_token_expiry(candidate)
+            if expires_at is not None and now >= expires_at - self.expiry_margin:
+                candidate = None
+            future = self._start(candidate)
+        try:
+            return future.result(timeout=self.login_timeout)
+        except FutureTimeout:
+            raise ValueError("登录超时，无法获取 Credential")
+
+    def refresh(self):
+        """
+        Starts a background login unless one is already running. Requests keep using the current token meanwhile.
+        """
+        with self._lock:
+            self._start()
+
+    def close(self):
+        """
+        Cancels the scheduled background login, e.g. when the account is removed from the config.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def invalidate(self, token=None):
+        """
+        Marks the cached token as invalid, e.g. after upstream answered with 401.
+
+        :param token: The token that was rejected. If a newer token is already cached, it is kept.
+        """
+        with self._lock:
+            if token is None or token == self._token:
+                self._token = None
@@ -0,0 +1,137 @@
+import asyncio
+import queue
+import threading
+
+from libs.json_codec import dumps, loads
+from libs.sse import iter_sse_payloads, FkUSTChat_ClosingStream, FkUSTChat_AsyncClosingStream
+from libs.tokens import make_usage
+
+_END = object()
+
+
+def merge_completions(results):
+    """
+    Merges the chat.completion results of independent calls for the same request into one result
+    whose ``choices`` hold one entry per call, numbered in call order.
+
+    :param results: The chat.completion dicts.
+    :return: The merged dict; the prompt is counted once in ``usage``, the completions are summed.
+    """
+    merged = dict(results[0])
+    merged["choices"] = [dict(choice, index=index) for index, result in enumerate(results) for choice in result.get("choices", [])[:1]]
+    usages = [result.get("usage") for result in results]
+    if all(usages):
+        merged["usage"] = make_usage(usages[0].get("prompt_tokens", 0), sum(usage.get("completion_tokens", 0) for usage in usages))
+    return merged
+
+
+def reindex_frames(chunk, index):
+    """
+    Rewrites the choice index of the frames of one stream, dropping its ``[DONE]``.
+
+    :param chunk: Bytes or str holding one or more complete frames.
+    :param index: The choice index of the stream in the merged response.
+    :return: The rewritten frames as bytes.
+    """
+    frames = []
+    for payload in iter_sse_payloads((chunk,)):
+        try:
+            data = loads(payload)
+        except ValueError:
+            continue
+        for choice in data.get("choices") or ():
+            choice["index"] = index
+        frames.append(b'data: ' + dumps(data) + b'\n\n')
+    return b''.join(frames)
+
+
+def iter_merged_streams(streams):
+    """
+    Interleaves several SSE streams into one, in arrival order, with each stream's choices numbered by its position.
+
+    Every stream is read by its own thread; closing the merged stream makes the threads close
+    their streams at the next chunk.
+
+    :param streams: The iterators of SSE chunks.
+    :return: An iterator of bytes ending with ``data: [DONE]``; closing it closes the streams.
+    """
+    return FkUSTChat_ClosingStream(_iter_merged_streams(streams), streams)
+
+
+def _iter_merged_streams(streams):
+    chunks = queue.Queue()
+    stopped = threading.Event()
+
+    def pump(index, stream):
+        try:
+            for chunk in stream:
+                chunks.put((index, chunk))
+                if stopped.is_set():
+                    break
+        except BaseException as e:
+            chunks.put((index, e))
+        finally:
+            close = getattr(stream, 'close', None)
+            if close is not None:
+                close()
+            chunks.put((index, _END))
+
+    for index, stream in enumerate(streams):
+        threading.Thread(target=pump, args=(index, stream), daemon=True).start()
+    try:
+        remaining = len(streams)
+        while remaining:
+            index, chunk = chunks.get()
+            if chunk is _END:
+                remaining -= 1
+            elif isinstance(chunk, BaseException):
+                raise chunk
+            else:
+                frames = reindex_frames(chunk, index)
+                if frames:
+                    yield frames
+        yield b'data: [DONE]\n\n'
+    finally:
+        stopped.set()
+
+
+def aiter_merged_streams(streams):
+    """
+    Async version of :func:`iter_merged_streams`, reading every stream in its own task.
+    """
+    return FkUSTChat_AsyncClosingStream(_aiter_merged_streams(streams), streams)
+
+
+async def _aiter_merged_streams(streams):
+    chunks = asyncio.Queue()
+
+    async def pump(index, stream):
+        try:
+            async for chunk in stream:
+                await chunks.put((index, chunk))
+        except Exception as e:
+            await chunks.put((index, e))
+        finally:
+            aclose = getattr(stream, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+            await chunks.put((index, _END))
+
+    tasks = [asyncio.ensure_future(pump(index, stream)) for index, stream in enumerate(streams)]
+    try:
+        remaining = len(streams)
+        while remaining:
+            index, chunk = await chunks.get()
+            if chunk is _END:
+                remaining -= 1
+            elif isinstance(chunk, BaseException):
+                raise chunk
+            else:
+                frames = reindex_frames(chunk, index)
+                if frames:
+                    yield frames
+        yield b'data: [DONE]\n\n'
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
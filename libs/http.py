@@ -0,0 +1,96 @@
+import asyncio
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+def create_session(pool_connections=10, pool_maxsize=10, pool_block=False, keep_alive=True, headers=None, cookies=None):
+    """
+    Creates a pooled, keep-alive HTTP session.
+
+    :param pool_connections: Number of per-host connection pools to keep.
+    :param pool_maxsize: Maximum number of connections kept open to a single host.
+    :param pool_block: If True, never open more than ``pool_maxsize`` connections to a host and wait for a free one instead.
+    :param keep_alive: If False, connections are closed after every request.
+    :param headers: Static headers sent with every request.
+    :param cookies: Static cookies sent with every request.
+    :return: The configured ``requests.Session``.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if headers:
+        session.headers.update(headers)
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    if cookies:
+        session.cookies.update(cookies)
+    return session
+
+
+def iter_response_bytes(response, chunk_size=8192):
+    """
+    Yields the body of a streamed response as soon as bytes arrive, up to ``chunk_size`` at a time.
+
+    Unlike ``iter_content``, it never waits for a full ``chunk_size`` buffer when the upstream
+    response is not chunk-encoded, so large buffers do not delay the first token.
+
+    :param response: A ``requests`` response opened with ``stream=True``.
+    :param chunk_size: Maximum number of bytes per read.
+    :return: A generator of bytes.
+    """
+    read1 = getattr(response.raw, 'read1', None)
+    if read1 is None:
+        yield from response.iter_content(chunk_size)
+        return
+    while True:
+        chunk = read1(chunk_size, decode_content=True)
+        if not chunk:
+            return
+        yield chunk
+
+
+def create_async_client(max_connections=32, max_keepalive_connections=10, keep_alive=True, headers=None, cookies=None):
+    """
+    Creates a pooled async HTTP client for the ASGI serving mode.
+
+    :param max_connections: Maximum number of concurrent connections.
+    :param max_keepalive_connections: Maximum number of idle connections kept open.
+    :param keep_alive: If False, connections are closed after every request.
+    :param headers: Static headers sent with every request.
+    :param cookies: Static cookies sent with every request.
+    :return: An ``httpx.AsyncClient``, or None if httpx is not installed.
+    """
+    if httpx is None:
+        return None
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections if keep_alive else 0
+    )
+    return httpx.AsyncClient(limits=limits, headers=headers, cookies=cookies, timeout=httpx.Timeout(None, connect=10))
+
+
+def close_async_client(client, loop):
+    """
+    Closes an ``httpx.AsyncClient`` from any thread, on the event loop it was used on.
+
+    :param client: The client.
+    :param loop: The loop the client was used on, or None if it never was.
+    """
+    if loop is None or loop.is_closed():
+        # 事件循环已经结束，连接也随之关闭
+        return
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        loop.create_task(client.aclose())
+    else:
+        asyncio.run_coroutine_threadsafe(client.aclose(), loop)
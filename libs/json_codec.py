@@ -0,0 +1,24 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+    def dumps(obj):
+        """
+        Serializes ``obj`` to compact UTF-8 JSON bytes, using orjson when it is installed.
+        """
+        return orjson.dumps(obj)
+
+    loads = orjson.loads
+else:
+    def dumps(obj):
+        """
+        Serializes ``obj`` to compact UTF-8 JSON bytes, using orjson when it is installed.
+        """
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    loads = json.loads
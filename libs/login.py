@@ -0,0 +1,97 @@
+import importlib
+import shutil
+import sys
+from os import path
+
+
+def create_webdriver(browser="auto", headless=False, driver_path=None):
+    """
+    Starts a Selenium WebDriver. Selenium is imported here, so adapters that never log in through a browser do not need it.
+
+    :param browser: ``edge``, ``chrome``, ``firefox``, ``safari``, or ``auto`` to pick one for the current OS:
+                    Edge on Windows, Safari on macOS, and headless Chrome/Chromium or Firefox on Linux.
+    :param headless: Whether to run the browser without a window. Always on for ``auto`` on Linux.
+    :param driver_path: Optional path of the driver executable; otherwise Selenium Manager or webdriver-manager finds one.
+    :return: The WebDriver.
+    """
+    from selenium import webdriver
+
+    if browser == "auto":
+        if sys.platform.startswith('win32'):
+            browser = "edge"
+        elif sys.platform.startswith('darwin'):
+            browser = "safari"
+        else:
+            has_chrome = any(shutil.which(name) for name in ("google-chrome", "chromium", "chromium-browser"))
+            browser = "chrome" if has_chrome or not shutil.which("firefox") else "firefox"
+            headless = True
+
+    if browser == "edge":
+        if driver_path is None:
+            try:
+                from webdriver_manager.microsoft import EdgeChromiumDriverManager
+                driver_path = EdgeChromiumDriverManager().install()
+            except Exception:
+                driver_path = path.join(path.dirname(__file__), "../dependencies/msedgedriver.exe")
+        options = webdriver.EdgeOptions()
+        if headless:
+            options.add_argument("--headless=new")
+        service = webdriver.EdgeService(executable_path=driver_path)
+        return webdriver.Edge(service=service, options=options)
+    if browser == "chrome":
+        options = webdriver.ChromeOptions()
+        if headless:
+            # 服务器上通常没有显示器，也没有 /dev/shm 的足够空间
+            for argument in ("--headless=new", "--no-sandbox", "--disable-dev-shm-usage", "--disable-gpu"):
+                options.add_argument(argument)
+        service = webdriver.ChromeService(executable_path=driver_path) if driver_path else webdriver.ChromeService()
+        return webdriver.Chrome(service=service, options=options)
+    if browser == "firefox":
+        options = webdriver.FirefoxOptions()
+        if headless:
+            options.add_argument("-headless")
+        service = webdriver.FirefoxService(executable_path=driver_path) if driver_path else webdriver.FirefoxService()
+        return webdriver.Firefox(service=service, options=options)
+    if browser == "safari":
+        return webdriver.Safari()
+    raise ValueError(f"Unsupported browser: {browser}")
+
+
+class FkUSTChat_LoginBackend:
+    def __init__(self, adapter, options=None):
+        """
+        A way of obtaining an upstream token. Adapters pick one with their ``login_backend`` setting.
+
+        :param adapter: The adapter that logs in.
+        :param options: Backend-specific settings.
+        """
+        self.adapter = adapter
+        self.options = options or {}
+
+    def login(self, username, password):
+        """
+        Logs in and returns the token.
+
+        :return: The token, or a falsy value on failure.
+        """
+        raise NotImplementedError("This method should be overridden by subclasses.")
+
+
+def load_login_backend(spec, backends, adapter, options=None):
+    """
+    Instantiates a login backend by name.
+
+    :param spec: A key of ``backends``, or ``module:Class`` naming a :class:`FkUSTChat_LoginBackend` subclass.
+    :param backends: The backends the adapter ships, by name.
+    :param adapter: The adapter that logs in.
+    :param options: Backend-specific settings.
+    :return: The backend instance.
+    """
+    if spec in backends:
+        cls = backends[spec]
+    elif ':' in spec:
+        module_name, class_name = spec.split(':', 1)
+        cls = getattr(importlib.import_module(module_name), class_name)
+    else:
+        raise ValueError(f"Unknown login backend: {spec}")
+    return cls(adapter, options)
@@ -0,0 +1,306 @@
+import bisect
+import math
+import threading
+import time
+
+from libs.tracing import NOOP_SPAN
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class _GaugeChild(_CounterChild):
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def observe_many(self, values):
+        """
+        Records several observations under one lock, e.g. the token gaps of a whole stream.
+        """
+        indexes = [bisect.bisect_left(self.buckets, value) for value in values]
+        with self._lock:
+            for index in indexes:
+                self.counts[index] += 1
+            self.sum += sum(values)
+            self.count += len(indexes)
+
+    def time(self):
+        return _Timer(self)
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+            cumulative += bucket_count
+            yield f'{name}_bucket', dict(labels, le=format_value(float(bound))), cumulative
+        yield f'{name}_sum', labels, total
+        yield f'{name}_count', labels, count
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started_at)
+
+
+class FkUSTChat_Metric:
+    def __init__(self, name, documentation, metric_type, labelnames=(), child_factory=None):
+        """
+        A metric family whose children are selected by label values, as in the Prometheus client libraries.
+
+        :param name: The metric name.
+        :param documentation: The ``# HELP`` text.
+        :param metric_type: ``counter``, ``gauge`` or ``histogram``.
+        :param labelnames: The label names; :meth:`labels` takes the values in the same order.
+        :param child_factory: Creates the child holding the value of one label combination.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.type = metric_type
+        self.labelnames = tuple(labelnames)
+        self.child_factory = child_factory
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values):
+        """
+        Returns the child for the given label values, creating it on first use. Callers on a hot
+        path can keep the child instead of looking it up every time.
+        """
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self.child_factory())
+        return child
+
+    def __getattr__(self, attr):
+        # 没有标签的指标可以直接调用 inc / observe 等方法
+        if attr.startswith('_') or '_default' not in self.__dict__:
+            raise AttributeError(attr)
+        return getattr(self._default, attr)
+
+    def collect(self):
+        for values, child in list(self._children.items()):
+            yield from child.samples(self.name, dict(zip(self.labelnames, values)))
+
+
+class FkUSTChat_Registry:
+    def __init__(self):
+        """
+        Holds the metrics of the process and renders them in the Prometheus text format.
+
+        Besides the metrics updated on the request path, collectors are called at scrape time to
+        report state that already lives elsewhere, e.g. the scheduler queues or the cache counters.
+        """
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(FkUSTChat_Metric(name, documentation, 'counter', labelnames, _CounterChild))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(FkUSTChat_Metric(name, documentation, 'gauge', labelnames, _GaugeChild))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        buckets = tuple(sorted(buckets))
+        return self._register(FkUSTChat_Metric(name, documentation, 'histogram', labelnames, lambda: _HistogramChild(buckets)))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """
+        :param collector: Callable returning ``(name, type, documentation, samples)`` tuples, where
+                          samples is a list of ``(labels dict, value)``.
+        """
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.collect():
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        for collector in self.collectors:
+            try:
+                families = list(collector())
+            except Exception as e:
+                print(f'[!] 收集指标失败: {e}')
+                continue
+            for name, metric_type, documentation, samples in families:
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for labels, value in samples:
+                    lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = FkUSTChat_Registry()
+
+REQUESTS = REGISTRY.counter('fkustchat_requests_total', 'HTTP requests by route, model and status.', ('route', 'model', 'status'))
+REQUEST_DURATION = REGISTRY.histogram('fkustchat_request_duration_seconds', 'Time until the response headers were sent.', ('route', 'model'))
+STREAM_DURATION = REGISTRY.histogram('fkustchat_stream_duration_seconds', 'Time from the request until the end of a streamed response.', ('model',))
+TIME_TO_FIRST_TOKEN = REGISTRY.histogram('fkustchat_time_to_first_token_seconds', 'Time from the request until the first streamed chunk.', ('model',))
+INTER_TOKEN_LATENCY = REGISTRY.histogram('fkustchat_inter_token_latency_seconds', 'Time between two streamed chunks.', ('model',), TOKEN_BUCKETS)
+ACTIVE_STREAMS = REGISTRY.gauge('fkustchat_active_streams', 'Streamed responses currently open.', ('model',))
+UPSTREAM_RETRIES = REGISTRY.counter('fkustchat_upstream_retries_total', 'Failed upstream attempts that were retried or gave up, by status code.', ('adapter', 'status'))
+LOGIN_DURATION = REGISTRY.histogram('fkustchat_login_duration_seconds', 'Duration of upstream logins.', ('adapter', 'result'), (1, 2.5, 5, 10, 20, 30, 60, 120))
+ENTER_QUEUE_DURATION = REGISTRY.histogram('fkustchat_enter_queue_duration_seconds', 'Latency of entering the upstream queue.', ('adapter',))
+
+
+class FkUSTChat_MeteredStream:
+    def __init__(self, iterator, model_name, started_at, span=NOOP_SPAN):
+        """
+        Wraps a streamed response to record time to first token, inter-token latency and stream duration.
+
+        The arrival times of the chunks are only collected in a list while streaming and are added to
+        the histograms in one go when the stream ends, so the per-chunk cost is a clock read and an append.
+
+        :param iterator: The stream.
+        :param model_name: The registered model name, used as label.
+        :param started_at: ``time.perf_counter()`` when the request arrived.
+        :param span: The tracing span of the streaming phase; it ends with the stream.
+        """
+        self.iterator = iter(iterator)
+        self.model_name = model_name
+        self.started_at = started_at
+        self.span = span
+        self.error = None
+        self.times = []
+        self.finished = False
+        ACTIVE_STREAMS.labels(model_name).inc()
+
+    def __iter__(self):
+        return self
+
+    def _finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        ACTIVE_STREAMS.labels(self.model_name).dec()
+        times = self.times
+        if times:
+            TIME_TO_FIRST_TOKEN.labels(self.model_name).observe(times[0] - self.started_at)
+        if len(times) > 1:
+            INTER_TOKEN_LATENCY.labels(self.model_name).observe_many([b - a for a, b in zip(times, times[1:])])
+        STREAM_DURATION.labels(self.model_name).observe(time.perf_counter() - self.started_at)
+        if self.span is not NOOP_SPAN:
+            self.span.set_attribute('chunks', len(times))
+            if times:
+                self.span.set_attribute('time_to_first_chunk_ms', (times[0] - self.started_at) * 1000)
+            self.span.end(self.error)
+
+    def __next__(self):
+        try:
+            chunk = next(self.iterator)
+        except BaseException as e:
+            if not isinstance(e, StopIteration):
+                self.error = e
+            self.close()
+            raise
+        self.times.append(time.perf_counter())
+        return chunk
+
+    def close(self):
+        try:
+            close = getattr(self.iterator, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._finish()
+
+
+class FkUSTChat_AsyncMeteredStream(FkUSTChat_MeteredStream):
+    def __init__(self, iterator, model_name, started_at, span=NOOP_SPAN):
+        """
+        Async version of :class:`FkUSTChat_MeteredStream`.
+        """
+        self.iterator = iterator.__aiter__()
+        self.model_name = model_name
+        self.started_at = started_at
+        self.span = span
+        self.error = None
+        self.times = []
+        self.finished = False
+        ACTIVE_STREAMS.labels(model_name).inc()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            chunk = await self.iterator.__anext__()
+        except BaseException as e:
+            if not isinstance(e, StopAsyncIteration):
+                self.error = e
+            await self.aclose()
+            raise
+        self.times.append(time.perf_counter())
+        return chunk
+
+    async def aclose(self):
+        try:
+            aclose = getattr(self.iterator, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+        finally:
+            self._finish()
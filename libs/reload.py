@@ -0,0 +1,129 @@
+import threading
+from os import path
+
+from libs.adapter_loader import ADAPTER_DIR, get_adapter_files, discover_adapters
+
+
+def get_mtime(file_path):
+    try:
+        return path.getmtime(file_path)
+    except OSError:
+        return None
+
+
+class FkUSTChat_Reloader:
+    def __init__(self, core, interval=2, lazy=True):
+        """
+        Watches the adapter directory and the config file and applies changes without a restart.
+
+        A new or modified adapter file is discovered again and its adapters replace the registered
+        ones through :meth:`FkUSTChat_Core.replace_adapter`; adapters of a deleted file, or no longer
+        defined by their file, are unregistered. A modified config file goes through
+        :meth:`FkUSTChat_Core.reload_config`. Requests that already started finish on the old
+        instances. A file that fails to load is reported and the registered adapters stay in place.
+
+        :param core: The core.
+        :param interval: Seconds between two checks.
+        :param lazy: Whether adapters with a manifest are imported on first use, as in :func:`load_adapters`.
+        """
+        self.core = core
+        self.interval = interval
+        self.lazy = lazy
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.file_adapters = {}
+        for adapter_name, adapter in core.adapters.items():
+            adapter_filename = getattr(adapter, 'adapter_filename', None)
+            if adapter_filename is not None:
+                self.file_adapters.setdefault(adapter_filename, set()).add(adapter_name)
+        self.mtimes = self.scan()
+        self.config_mtime = get_mtime(core.CONFIG_FILE)
+
+    @classmethod
+    def from_config(cls, core, config):
+        """
+        :param config: The ``hot_reload`` section of the core config.
+        :return: A reloader, or None if hot reload is disabled.
+        """
+        config = config or {}
+        if not config.get('enabled', False):
+            return None
+        return cls(core, interval=config.get('interval', 2), lazy=config.get('lazy', True))
+
+    def scan(self):
+        return {f: get_mtime(path.join(ADAPTER_DIR, f)) for f in get_adapter_files()}
+
+    def reload_file(self, adapter_filename):
+        """
+        Discovers one adapter file again and swaps its adapters in.
+
+        :return: The names of the adapters the file now provides.
+        """
+        adapters = discover_adapters(self.core, adapter_filename, self.lazy)
+        names = set()
+        for adapter in adapters:
+            self.core.replace_adapter(adapter)
+            names.add(adapter.name)
+            print(f'[+] Reloaded adapter {adapter.name}')
+        for adapter_name in self.file_adapters.get(adapter_filename, set()) - names:
+            self.core.unregister_adapter(adapter_name)
+            print(f'[-] Removed adapter {adapter_name}')
+        self.file_adapters[adapter_filename] = names
+        return names
+
+    def check(self):
+        """
+        Applies the changes since the last check.
+
+        :return: True if anything was reloaded.
+        """
+        with self._lock:
+            changed = False
+
+            config_mtime = get_mtime(self.core.CONFIG_FILE)
+            if config_mtime != self.config_mtime:
+                self.config_mtime = config_mtime
+                try:
+                    # 核心自己写回的配置（如新的 Credential）与内存一致，不会触发重载
+                    if self.core.reload_config():
+                        print('[+] Reloaded config')
+                        changed = True
+                except Exception as e:
+                    print(f'[!] 重新加载配置失败: {e}')
+
+            mtimes = self.scan()
+            for adapter_filename, mtime in mtimes.items():
+                if self.mtimes.get(adapter_filename) == mtime:
+                    continue
+                try:
+                    self.reload_file(adapter_filename)
+                    changed = True
+                except Exception as e:
+                    # 加载失败时保留原来的适配器
+                    print(f'[!] 重新加载适配器文件 {adapter_filename} 失败: {e}')
+            for adapter_filename in set(self.mtimes) - set(mtimes):
+                for adapter_name in self.file_adapters.pop(adapter_filename, set()):
+                    self.core.unregister_adapter(adapter_name)
+                    print(f'[-] Removed adapter {adapter_name}')
+                    changed = True
+            self.mtimes = mtimes
+            return changed
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                print(f'[!] 热重载检查失败: {e}')
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,150 @@
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+from libs.metrics import UPSTREAM_RETRIES
+
+
+class FkUSTChat_UpstreamError(Exception):
+    def __init__(self, message, status_code=502, error_type='upstream_error', upstream_status=None):
+        """
+        An upstream failure that should be reported to the client as an OpenAI-style error.
+
+        :param message: The error message.
+        :param status_code: The HTTP status returned to the client.
+        :param error_type: The OpenAI error type, e.g. ``rate_limit_error``.
+        :param upstream_status: The status code the upstream answered with, if any.
+        """
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.error_type = error_type
+        self.upstream_status = upstream_status
+
+    def to_dict(self):
+        return {
+            "error": {
+                "message": self.message,
+                "type": self.error_type,
+                "param": None,
+                "code": self.upstream_status
+            }
+        }
+
+
+def parse_retry_after(value):
+    """
+    Parses a ``Retry-After`` header.
+
+    :param value: The header value, either delay-seconds or an HTTP-date.
+    :return: The delay in seconds, or None if absent or unparsable.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class FkUSTChat_RetryPolicy:
+    RETRYABLE_STATUSES = (408, 425, 429, 500, 502, 503, 504)
+
+    def __init__(self, max_attempts=5, base_delay=0.5, max_delay=20, deadline=60, retryable_statuses=RETRYABLE_STATUSES, name=''):
+        """
+        Bounded exponential backoff with full jitter for upstream calls.
+
+        :param max_attempts: Maximum number of attempts, including the first one.
+        :param base_delay: Backoff base in seconds; attempt ``n`` waits up to ``base_delay * 2 ** n``.
+        :param max_delay: Upper bound for a single wait, also applied to ``Retry-After``.
+        :param deadline: Seconds after which no further attempt is started, or None for no deadline.
+        :param retryable_statuses: Status codes worth retrying. Any other status fails immediately.
+        :param name: The adapter the policy belongs to, used as the label of the retry metrics.
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retryable_statuses = retryable_statuses
+        self.name = name
+
+    @classmethod
+    def from_config(cls, config, name=''):
+        """
+        Builds a policy from the ``retry_*`` keys of an adapter config.
+
+        :param config: The adapter config dict.
+        :param name: The adapter name.
+        """
+        return cls(
+            max_attempts=config.get('retry_max_attempts', 5),
+            base_delay=config.get('retry_base_delay', 0.5),
+            max_delay=config.get('retry_max_delay', 20),
+            deadline=config.get('retry_deadline', 60),
+            name=name
+        )
+
+    def is_retryable(self, status_code):
+        return status_code is None or status_code in self.retryable_statuses
+
+    def get_delay(self, attempt, retry_after=None):
+        """
+        Returns how long to wait before the given retry.
+
+        :param attempt: The number of failed attempts so far (1 for the first retry).
+        :param retry_after: Seconds requested by the upstream ``Retry-After`` header, if any.
+        """
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def start(self):
+        """
+        Starts tracking the attempts of one upstream call.
+
+        :return: A :class:`FkUSTChat_RetryState`.
+        """
+        return FkUSTChat_RetryState(self)
+
+
+class FkUSTChat_RetryState:
+    def __init__(self, policy):
+        self.policy = policy
+        self.attempt = 0
+        self.started_at = time.monotonic()
+
+    def backoff(self, status_code=None, retry_after=None, message=''):
+        """
+        Records a failed attempt and decides whether to try again.
+
+        :param status_code: The upstream status code, or None for a connection error.
+        :param retry_after: The raw ``Retry-After`` header value, if any.
+        :param message: A short description of the failure.
+        :return: Seconds to wait before the next attempt.
+        :raises FkUSTChat_UpstreamError: If the failure is not retryable or the attempts or deadline are exhausted.
+        """
+        self.attempt += 1
+        policy = self.policy
+        UPSTREAM_RETRIES.labels(policy.name, str(status_code) if status_code is not None else 'connection_error').inc()
+        if not policy.is_retryable(status_code):
+            raise self.error(status_code, message)
+        if self.attempt >= policy.max_attempts:
+            raise self.error(status_code, f"{message} (gave up after {self.attempt} attempts)")
+
+        delay = policy.get_delay(self.attempt, parse_retry_after(retry_after))
+        if policy.deadline is not None and time.monotonic() - self.started_at + delay > policy.deadline:
+            raise self.error(status_code, f"{message} (retry deadline of {policy.deadline}s exceeded)")
+        return delay
+
+    def error(self, status_code, message):
+        if status_code == 429:
+            return FkUSTChat_UpstreamError(message, 429, 'rate_limit_error', status_code)
+        if status_code in (400, 404, 413, 422):
+            return FkUSTChat_UpstreamError(message, 400, 'invalid_request_error', status_code)
+        if status_code is None:
+            return FkUSTChat_UpstreamError(message, 502, 'upstream_error')
+        return FkUSTChat_UpstreamError(message, 503 if status_code >= 500 else 502, 'upstream_error', status_code)
@@ -0,0 +1,369 @@
+import asyncio
+import itertools
+import math
+import threading
+import time
+from collections import deque
+
+from libs.retry import FkUSTChat_UpstreamError
+
+
+class FkUSTChat_QueueTimeout(FkUSTChat_UpstreamError):
+    def __init__(self, message):
+        """
+        Raised when a request cannot get an upstream slot in time. Reported to the client as a 429.
+        """
+        super().__init__(message, 429, 'rate_limit_error')
+
+
+class FkUSTChat_Slot:
+    def __init__(self, scheduler, model_name, adapter_name):
+        self.scheduler = scheduler
+        self.model_name = model_name
+        self.adapter_name = adapter_name
+        self.released = False
+
+    def release(self):
+        """
+        Gives the slot back to the scheduler. Calling it more than once has no effect.
+        """
+        self.scheduler._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class FkUSTChat_SlotIterator:
+    def __init__(self, iterator, slot):
+        """
+        Wraps a streamed response so that its slot is released once the stream ends or is closed,
+        even if it was never started.
+        """
+        self.iterator = iter(iterator)
+        self.slot = slot
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.iterator)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        try:
+            close = getattr(self.iterator, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self.slot.release()
+
+
+class FkUSTChat_AsyncSlotIterator:
+    def __init__(self, iterator, slot):
+        """
+        Async version of :class:`FkUSTChat_SlotIterator`.
+        """
+        self.iterator = iterator.__aiter__()
+        self.slot = slot
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.iterator.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
+
+    async def aclose(self):
+        try:
+            aclose = getattr(self.iterator, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+        finally:
+            self.slot.release()
+
+
+class _Waiter:
+    def __init__(self, model_name, adapter_name, client, notify):
+        self.model_name = model_name
+        self.adapter_name = adapter_name
+        self.client = client
+        self.notify = notify
+        self.enqueued_at = time.monotonic()
+        self.slot = None
+
+
+class FkUSTChat_Scheduler:
+    def __init__(self, queue_timeout=30, max_queue_size=1000, client_weights=None, worker_count=1):
+        """
+        Caps concurrent upstream requests per model and per adapter, queueing the rest fairly.
+
+        Waiting requests are kept in one FIFO per client. Whenever capacity frees up, the client with
+        the lowest weighted service time that has an eligible request goes next, so one busy API key
+        cannot starve the others.
+
+        :param queue_timeout: Seconds a request may wait for a slot before it is rejected with a 429.
+        :param max_queue_size: Maximum number of waiting requests; further requests are rejected at once.
+        :param client_weights: Optional mapping of client id to weight. A client with weight 2 is served twice as often.
+        :param worker_count: Number of worker processes serving the same upstream. Each one enforces its share of the limits.
+        """
+        self.queue_timeout = queue_timeout
+        self.max_queue_size = max_queue_size
+        self.client_weights = client_weights or {}
+        self.worker_count = worker_count
+
+        self.model_limits = {}
+        self.adapter_limits = {}
+        self.model_active = {}
+        self.adapter_active = {}
+
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._vtime = {}
+        self._vtime_limit = 1024
+        self._clock = 0.0
+        self._waiting = 0
+
+        self.granted_total = 0
+        self.rejected_total = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def configure(self, config):
+        """
+        Applies the ``scheduler`` section of the core config.
+
+        :param config: A dict with ``queue_timeout``, ``max_queue_size`` and ``client_weights`` keys.
+        """
+        self.queue_timeout = config.get('queue_timeout', self.queue_timeout)
+        self.max_queue_size = config.get('max_queue_size', self.max_queue_size)
+        self.client_weights = config.get('client_weights', self.client_weights)
+
+    def _share(self, limit):
+        # 多个 worker 平分同一个上游的并发额度，每个至少 1
+        if limit is None or self.worker_count <= 1:
+            return limit
+        return max(1, math.ceil(limit / self.worker_count))
+
+    def set_model_limit(self, model_name, limit):
+        self.model_limits[model_name] = self._share(limit)
+        self._wake()
+
+    def set_adapter_limit(self, adapter_name, limit):
+        self.adapter_limits[adapter_name] = self._share(limit)
+        self._wake()
+
+    def _has_capacity(self, model_name, adapter_name):
+        limit = self.model_limits.get(model_name)
+        if limit is not None and self.model_active.get(model_name, 0) >= limit:
+            return False
+        limit = self.adapter_limits.get(adapter_name)
+        if limit is not None and self.adapter_active.get(adapter_name, 0) >= limit:
+            return False
+        return True
+
+    def _grant(self, model_name, adapter_name, client):
+        self.model_active[model_name] = self.model_active.get(model_name, 0) + 1
+        self.adapter_active[adapter_name] = self.adapter_active.get(adapter_name, 0) + 1
+        weight = self.client_weights.get(client, 1) or 1
+        # 虚拟时钟前进到本次请求的开始时间，不排队直接执行的请求也一样，这样空闲客户端的记录最终会落后于时钟
+        self._clock = max(self._vtime.get(client, 0.0), self._clock)
+        self._vtime[client] = self._clock + 1.0 / weight
+        if len(self._vtime) > self._vtime_limit:
+            self._forget_idle_clients()
+        self.granted_total += 1
+        return FkUSTChat_Slot(self, model_name, adapter_name)
+
+    def _forget_idle_clients(self):
+        # 在持有锁时调用：记录过多时，丢弃没有排队、最多领先时钟一个请求的客户端，它们再来时从时钟开始计算。
+        # 只有同时执行多个请求的客户端才会领先更多，这些记录保留
+        self._vtime = {
+            client: vtime for client, vtime in self._vtime.items()
+            if client in self._queues or vtime > self._clock + 1.0 / (self.client_weights.get(client, 1) or 1)
+        }
+        self._vtime_limit = max(1024, 2 * len(self._vtime))
+
+    def _drop_queue(self, client):
+        # 在持有锁时调用
+        del self._queues[client]
+        if self._vtime.get(client, 0.0) <= self._clock:
+            self._vtime.pop(client, None)
+
+    def _dispatch(self):
+        # 在持有锁时调用：按加权服务时间从小到大，把空出来的并发额度分给各客户端队首可执行的请求
+        woken = []
+        while self._waiting:
+            best = None
+            for client, queue in self._queues.items():
+                if best is not None and self._vtime.get(client, 0.0) >= self._vtime.get(best[0].client, 0.0):
+                    continue
+                for waiter in queue:
+                    if self._has_capacity(waiter.model_name, waiter.adapter_name):
+                        best = (waiter, queue)
+                        break
+            if best is None:
+                break
+            waiter, queue = best
+            queue.remove(waiter)
+            if not queue:
+                self._drop_queue(waiter.client)
+            self._waiting -= 1
+            waiter.slot = self._grant(waiter.model_name, waiter.adapter_name, waiter.client)
+            self._record_wait(waiter)
+            woken.append(waiter)
+        return woken
+
+    def _record_wait(self, waiter):
+        waited = time.monotonic() - waiter.enqueued_at
+        self.wait_time_total += waited
+        self.wait_time_max = max(self.wait_time_max, waited)
+
+    def _wake(self):
+        with self._lock:
+            woken = self._dispatch()
+        for waiter in woken:
+            waiter.notify()
+
+    def _release(self, slot):
+        with self._lock:
+            if slot.released:
+                return
+            slot.released = True
+            self.model_active[slot.model_name] -= 1
+            self.adapter_active[slot.adapter_name] -= 1
+            if not self._waiting and not any(self.adapter_active.values()):
+                # 完全空闲时之前的服务时间不再影响公平性
+                self._vtime.clear()
+                self._clock = 0.0
+            woken = self._dispatch()
+        for waiter in woken:
+            waiter.notify()
+
+    def _enqueue(self, model_name, adapter_name, client, notify):
+        # 在持有锁时调用：能直接执行就返回 slot，否则排队并返回 waiter
+        if not self._waiting and self._has_capacity(model_name, adapter_name):
+            return self._grant(model_name, adapter_name, client), None
+        if self._waiting >= self.max_queue_size:
+            self.rejected_total += 1
+            raise FkUSTChat_QueueTimeout(f"Too many queued requests for model '{model_name}', please retry later")
+        waiter = _Waiter(model_name, adapter_name, client, notify)
+        if client not in self._queues:
+            self._queues[client] = deque()
+            self._vtime[client] = max(self._vtime.get(client, 0.0), self._clock)
+        self._queues[client].append(waiter)
+        self._waiting += 1
+        for woken in self._dispatch():
+            if woken is not waiter:
+                woken.notify()
+        if waiter.slot is not None:
+            return waiter.slot, None
+        return None, waiter
+
+    def _remove(self, waiter):
+        # 在持有锁时调用：把还没拿到 slot 的请求移出队列
+        queue = self._queues.get(waiter.client)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                self._drop_queue(waiter.client)
+            self._waiting -= 1
+
+    def _cancel(self, waiter):
+        # 在持有锁时调用：等待结束时如果还没拿到 slot，就从队列中移除并拒绝
+        if waiter.slot is not None:
+            return waiter.slot
+        self._remove(waiter)
+        self.rejected_total += 1
+        self._record_wait(waiter)
+        raise FkUSTChat_QueueTimeout(f"Model '{waiter.model_name}' is busy, no upstream slot became free in time")
+
+    def acquire(self, model_name, adapter_name, client=None, timeout=None):
+        """
+        Waits for a free upstream slot.
+
+        :param model_name: The registered model name.
+        :param adapter_name: The name of the adapter serving the model.
+        :param client: The id used for fair queueing, e.g. the API key.
+        :param timeout: Seconds to wait, defaults to ``queue_timeout``.
+        :return: A :class:`FkUSTChat_Slot` that must be released when the request is done.
+        :raises FkUSTChat_QueueTimeout: If no slot became free in time.
+        """
+        event = threading.Event()
+        with self._lock:
+            slot, waiter = self._enqueue(model_name, adapter_name, client, event.set)
+        if slot is not None:
+            return slot
+        event.wait(self.queue_timeout if timeout is None else timeout)
+        with self._lock:
+            return self._cancel(waiter)
+
+    async def aacquire(self, model_name, adapter_name, client=None, timeout=None):
+        """
+        Async version of :meth:`acquire` that waits without blocking the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        with self._lock:
+            slot, waiter = self._enqueue(model_name, adapter_name, client, notify)
+        if slot is not None:
+            return slot
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            with self._lock:
+                self._remove(waiter)
+            if waiter.slot is not None:
+                waiter.slot.release()
+            raise
+        with self._lock:
+            return self._cancel(waiter)
+
+    def stats(self):
+        """
+        Returns queue depth, active slots and wait time counters.
+
+        :return: A JSON-serializable dict.
+        """
+        with self._lock:
+            waiting_by_model = {}
+            for queue in self._queues.values():
+                for waiter in queue:
+                    waiting_by_model[waiter.model_name] = waiting_by_model.get(waiter.model_name, 0) + 1
+            models = set(itertools.chain(self.model_limits, self.model_active, waiting_by_model))
+            return {
+                "queue_depth": self._waiting,
+                "queued_clients": len(self._queues),
+                "granted_total": self.granted_total,
+                "rejected_total": self.rejected_total,
+                "wait_time_seconds_total": self.wait_time_total,
+                "wait_time_seconds_max": self.wait_time_max,
+                "models": {
+                    name: {
+                        "active": self.model_active.get(name, 0),
+                        "waiting": waiting_by_model.get(name, 0),
+                        "limit": self.model_limits.get(name)
+                    }
+                    for name in sorted(models)
+                },
+                "adapters": {
+                    name: {
+                        "active": self.adapter_active.get(name, 0),
+                        "limit": self.adapter_limits.get(name)
+                    }
+                    for name in sorted(set(self.adapter_limits) | set(self.adapter_active))
+                }
+            }
@@ -0,0 +1,184 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+WORKERS_ENV = "FKUSTCHAT_WORKERS"
+
+
+def get_worker_count():
+    """
+    Returns the number of worker processes started by the launcher, 1 when running in a single process.
+    """
+    try:
+        return max(int(os.environ.get(WORKERS_ENV, 1)), 1)
+    except ValueError:
+        return 1
+
+
+class FkUSTChat_SharedState:
+    def __init__(self, path):
+        """
+        State shared by the worker processes of one gateway, kept in a SQLite file in WAL mode.
+
+        It holds keys with an optional TTL (e.g. the current token of an account), claims that
+        make only one process do something at a time (e.g. log in), and pools of single-use items
+        (e.g. queue codes). Every thread gets its own connection, so it can be used from anywhere.
+
+        :param path: The SQLite file; every worker must use the same one.
+        """
+        self.path = path
+        self.owner = f'{os.getpid()}:{id(self)}'
+        self._local = threading.local()
+        db = self._connect()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS shared_keys (key TEXT PRIMARY KEY, value TEXT, updated_at REAL, expires_at REAL)")
+        db.execute("CREATE TABLE IF NOT EXISTS shared_items (id INTEGER PRIMARY KEY AUTOINCREMENT, pool TEXT, key TEXT, value TEXT, created_at REAL)")
+        db.execute("CREATE INDEX IF NOT EXISTS shared_items_pool ON shared_items (pool, id)")
+        db.commit()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Builds the shared state from the ``shared_state`` section of the core config.
+
+        :return: The shared state, or None if no ``path`` is set.
+        """
+        if not config or not config.get('path'):
+            return None
+        return cls(config['path'])
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _transaction(self):
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        return db
+
+    def get(self, key, default=None):
+        value = self.get_entry(key)
+        return default if value is None else value[0]
+
+    def get_entry(self, key):
+        """
+        :return: ``(value, updated_at)``, or None if the key is missing or expired.
+        """
+        row = self._connect().execute(
+            "SELECT value, updated_at FROM shared_keys WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        self._connect().execute(
+            "INSERT OR REPLACE INTO shared_keys (key, value, updated_at, expires_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), now, now + ttl if ttl else None)
+        )
+
+    def delete(self, key):
+        self._connect().execute("DELETE FROM shared_keys WHERE key = ?", (key,))
+
+    def claim(self, key, ttl):
+        """
+        Takes a claim unless another process holds it. A claim expires after ``ttl`` seconds, so a crashed holder does not block the others.
+
+        :return: True if this process now holds the claim.
+        """
+        db = self._transaction()
+        try:
+            now = time.time()
+            row = db.execute("SELECT value, expires_at FROM shared_keys WHERE key = ?", (key,)).fetchone()
+            if row is not None and json.loads(row[0]) != self.owner and row[1] is not None and row[1] > now:
+                db.execute("ROLLBACK")
+                return False
+            db.execute(
+                "INSERT OR REPLACE INTO shared_keys (key, value, updated_at, expires_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(self.owner), now, now + ttl)
+            )
+            db.execute("COMMIT")
+            return True
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def unclaim(self, key):
+        self._connect().execute("DELETE FROM shared_keys WHERE key = ? AND value = ?", (key, json.dumps(self.owner)))
+
+    def run_once(self, key, produce, timeout, poll_interval=0.2):
+        """
+        Runs ``produce`` in one process at a time; the others wait for its result instead of running it too.
+
+        :param key: Names the job; the result is stored under it.
+        :param produce: Callable returning a JSON-serializable result, or a falsy value on failure.
+        :param timeout: Seconds to wait for another process's result.
+        :return: The result, or None if it failed or did not arrive in time.
+        """
+        started_at = time.time()
+        claim_key = f'{key}:claim'
+        while time.time() - started_at < timeout:
+            if self.claim(claim_key, timeout):
+                try:
+                    # 等待期间其他进程可能刚完成并释放了 claim，先看是否已有结果
+                    entry = self.get_entry(key)
+                    if entry is not None and entry[1] >= started_at:
+                        return entry[0]
+                    value = produce()
+                    if value:
+                        self.set(key, value)
+                    return value
+                finally:
+                    self.unclaim(claim_key)
+            entry = self.get_entry(key)
+            if entry is not None and entry[1] >= started_at:
+                return entry[0]
+            time.sleep(poll_interval)
+        return None
+
+    def push(self, pool, key, value):
+        """
+        Adds an item to a pool.
+
+        :param key: What the item belongs to, e.g. the token it was produced with.
+        """
+        self._connect().execute(
+            "INSERT INTO shared_items (pool, key, value, created_at) VALUES (?, ?, ?, ?)",
+            (pool, json.dumps(key), json.dumps(value, ensure_ascii=False), time.time())
+        )
+
+    def pop(self, pool, key, max_age):
+        """
+        Takes the oldest item of a pool that belongs to ``key`` and is younger than ``max_age``, dropping older or foreign ones.
+
+        :return: ``(value, dropped)``, where value is None if no item was usable.
+        """
+        db = self._transaction()
+        try:
+            dropped = db.execute(
+                "DELETE FROM shared_items WHERE pool = ? AND (key != ? OR created_at <= ?)",
+                (pool, json.dumps(key), time.time() - max_age)
+            ).rowcount
+            row = db.execute("SELECT id, value FROM shared_items WHERE pool = ? ORDER BY id LIMIT 1", (pool,)).fetchone()
+            if row is not None:
+                db.execute("DELETE FROM shared_items WHERE id = ?", (row[0],))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return (json.loads(row[1]) if row is not None else None), dropped
+
+    def count(self, pool):
+        return self._connect().execute("SELECT COUNT(*) FROM shared_items WHERE pool = ?", (pool,)).fetchone()[0]
+
+    def clear(self, pool):
+        self._connect().execute("DELETE FROM shared_items WHERE pool = ?", (pool,))
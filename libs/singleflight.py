@@ -0,0 +1,263 @@
+import asyncio
+import copy
+import threading
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _Flight:
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.cancelled = False
+        self.error = None
+        self.result = None
+        self.subscribers = 1
+        self.cond = threading.Condition()
+        self.waiters = []
+
+    def publish(self, chunk=None, done=False, error=None, result=None):
+        with self.cond:
+            if chunk is not None:
+                self.chunks.append(chunk)
+            if done:
+                self.done = True
+                self.error = error
+                self.result = result
+            waiters, self.waiters = self.waiters, []
+            self.cond.notify_all()
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+
+
+class FkUSTChat_FlightStream:
+    def __init__(self, group, key, flight):
+        """
+        One subscriber of a shared upstream stream. It first replays the chunks buffered so far, then follows the live stream.
+        """
+        self.group = group
+        self.key = key
+        self.flight = flight
+        self.position = 0
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        flight = self.flight
+        with flight.cond:
+            while self.position >= len(flight.chunks) and not flight.done:
+                flight.cond.wait()
+            if self.position < len(flight.chunks):
+                self.position += 1
+                return flight.chunks[self.position - 1]
+        self.close()
+        if flight.error is not None:
+            raise flight.error
+        raise StopIteration
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.group._detach(self.key, self.flight)
+
+
+class FkUSTChat_AsyncFlightStream(FkUSTChat_FlightStream):
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        flight = self.flight
+        while True:
+            with flight.cond:
+                if self.position < len(flight.chunks):
+                    self.position += 1
+                    return flight.chunks[self.position - 1]
+                if flight.done:
+                    break
+                loop = asyncio.get_running_loop()
+                future = loop.create_future()
+                flight.waiters.append((loop, future))
+            await future
+        self.close()
+        if flight.error is not None:
+            raise flight.error
+        raise StopAsyncIteration
+
+    async def aclose(self):
+        self.close()
+
+
+class FkUSTChat_SingleFlight:
+    def __init__(self):
+        """
+        Coalesces identical in-flight requests so that only the first one goes upstream.
+
+        The first request for a key (the leader) drives the upstream call. Identical requests of the same
+        kind, streaming or not, arriving while it runs attach to it: non-streaming callers receive a copy of the result, streaming callers
+        get the buffered prefix replayed and then follow the live chunks. A shared stream is read by a
+        pump, so it keeps going when the leader disconnects and stops once every subscriber is gone.
+        """
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def _join(self, key):
+        # 返回 (flight, 是否为 leader)
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and not flight.cancelled:
+                with flight.cond:
+                    flight.subscribers += 1
+                self.followers += 1
+                return flight, False
+            flight = _Flight()
+            self._flights[key] = flight
+            self.leaders += 1
+            return flight, True
+
+    def _finish(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def _detach(self, key, flight):
+        with flight.cond:
+            flight.subscribers -= 1
+            if flight.subscribers > 0 or flight.done:
+                return
+            flight.cancelled = True
+        self._finish(key, flight)
+
+    def do(self, key, fn):
+        """
+        Runs ``fn`` once for all concurrent callers with the same key.
+
+        :param key: The request key.
+        :param fn: Callable producing the response.
+        :return: The response; followers receive a deep copy.
+        """
+        # 流式与非流式的结果形式不同，不能互相合并
+        key = ('result', key)
+        flight, leader = self._join(key)
+        if not leader:
+            with flight.cond:
+                while not flight.done:
+                    flight.cond.wait()
+            if flight.error is not None:
+                raise flight.error
+            return copy.deepcopy(flight.result)
+        try:
+            result = fn()
+        except BaseException as e:
+            flight.publish(done=True, error=e)
+            raise
+        else:
+            flight.publish(done=True, result=result)
+            return result
+        finally:
+            self._finish(key, flight)
+
+    async def ado(self, key, fn):
+        """
+        Async version of :meth:`do`; ``fn`` is a coroutine function.
+        """
+        key = ('result', key)
+        flight, leader = self._join(key)
+        if not leader:
+            stream = FkUSTChat_AsyncFlightStream(self, key, flight)
+            async for _ in stream:
+                pass
+            return copy.deepcopy(flight.result)
+        try:
+            result = await fn()
+        except BaseException as e:
+            flight.publish(done=True, error=e)
+            raise
+        else:
+            flight.publish(done=True, result=result)
+            return result
+        finally:
+            self._finish(key, flight)
+
+    def _pump(self, key, flight, iterator):
+        error = None
+        try:
+            for chunk in iterator:
+                flight.publish(chunk)
+                if flight.cancelled:
+                    break
+        except Exception as e:
+            error = e
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+            flight.publish(done=True, error=error)
+            self._finish(key, flight)
+
+    async def _apump(self, key, flight, iterator):
+        error = None
+        try:
+            async for chunk in iterator:
+                flight.publish(chunk)
+                if flight.cancelled:
+                    break
+        except Exception as e:
+            error = e
+        finally:
+            aclose = getattr(iterator, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+            flight.publish(done=True, error=error)
+            self._finish(key, flight)
+
+    def stream(self, key, start):
+        """
+        Shares one upstream stream among all concurrent callers with the same key.
+
+        :param key: The request key.
+        :param start: Callable opening the upstream stream and returning an iterator of chunks.
+                      Only the leader calls it, so its errors reach the leader directly.
+        :return: An iterator of chunks for this caller.
+        """
+        key = ('stream', key)
+        flight, leader = self._join(key)
+        if leader:
+            try:
+                iterator = start()
+            except BaseException as e:
+                flight.publish(done=True, error=e)
+                self._finish(key, flight)
+                raise
+            threading.Thread(target=self._pump, args=(key, flight, iterator), daemon=True).start()
+        return FkUSTChat_FlightStream(self, key, flight)
+
+    async def astream(self, key, start):
+        """
+        Async version of :meth:`stream`; ``start`` is a coroutine function returning an async iterator.
+        """
+        key = ('stream', key)
+        flight, leader = self._join(key)
+        if leader:
+            try:
+                iterator = await start()
+            except BaseException as e:
+                flight.publish(done=True, error=e)
+                self._finish(key, flight)
+                raise
+            asyncio.ensure_future(self._apump(key, flight, iterator))
+        return FkUSTChat_AsyncFlightStream(self, key, flight)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._flights),
+                "leaders": self.leaders,
+                "followers": self.followers
+            }
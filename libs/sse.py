@@ -0,0 +1,174 @@
+class FkUSTChat_SSEFramer:
+    def __init__(self):
+        """
+        Cuts an upstream SSE byte stream at frame boundaries without decoding the payloads.
+
+        Every run of complete frames is forwarded as one slice of the upstream bytes, so the cost
+        per chunk does not depend on how many tiny deltas it carries. The stream ends after the
+        ``[DONE]`` frame.
+        """
+        self.buffer = b''
+        self.done = False
+
+    def feed(self, chunk):
+        """
+        Adds a chunk of upstream bytes.
+
+        :param chunk: The bytes read from upstream.
+        :return: A list with at most one byte string holding the newly completed frames.
+        """
+        if self.done:
+            return []
+        buffer = self.buffer + chunk if self.buffer else chunk
+        if b'\r' in buffer:
+            buffer = buffer.replace(b'\r\n', b'\n')
+        end = buffer.rfind(b'\n\n')
+        if end < 0:
+            self.buffer = buffer
+            return []
+
+        # [DONE] 只会出现在帧首；JSON 载荷中不会有裸换行，因此不会误判
+        done_at = 0 if buffer.startswith(b'data: [DONE]') else buffer.find(b'\ndata: [DONE]', 0, end + 2)
+        if done_at >= 0:
+            self.done = True
+            self.buffer = b''
+            return [buffer[:buffer.find(b'\n\n', done_at) + 2]]
+        self.buffer = buffer[end + 2:]
+        return [buffer[:end + 2]]
+
+    def flush(self):
+        """
+        Returns what is left in the buffer when upstream closed without a trailing blank line.
+        """
+        rest = self.buffer.rstrip(b'\n')
+        self.buffer = b''
+        if self.done or not rest:
+            return []
+        return [rest + b'\n\n']
+
+
+def iter_sse_payloads(chunks):
+    """
+    Extracts the payloads of the ``data:`` lines of a stream of SSE chunks, stopping at ``[DONE]``.
+
+    Bytes chunks yield bytes payloads and str chunks yield str payloads, so byte streams can be
+    handed to a JSON parser without decoding them first.
+
+    :param chunks: An iterator of bytes or str, each holding one or more complete frames.
+    :return: A generator of payloads, without the ``data: `` prefix.
+    """
+    for chunk in chunks:
+        if isinstance(chunk, bytes):
+            lines, prefix, done = chunk.split(b'\n'), b'data: ', b'[DONE]'
+        else:
+            lines, prefix, done = chunk.split('\n'), 'data: ', '[DONE]'
+        for line in lines:
+            if line.startswith(prefix):
+                payload = line[6:].strip()
+                if payload == done:
+                    return
+                yield payload
+
+
+async def aiter_sse_payloads(chunks):
+    """
+    Async version of :func:`iter_sse_payloads`.
+    """
+    async for chunk in chunks:
+        if isinstance(chunk, bytes):
+            lines, prefix, done = chunk.split(b'\n'), b'data: ', b'[DONE]'
+        else:
+            lines, prefix, done = chunk.split('\n'), 'data: ', '[DONE]'
+        for line in lines:
+            if line.startswith(prefix):
+                payload = line[6:].strip()
+                if payload == done:
+                    return
+                yield payload
+
+
+def iter_sse_frames(chunks):
+    """
+    Turns an iterator of upstream byte chunks into runs of raw SSE frames, stopping after ``[DONE]``.
+
+    :param chunks: An iterator of bytes, e.g. ``response.iter_content(chunk_size)``.
+    :return: A generator of bytes, each holding one or more complete frames.
+    """
+    framer = FkUSTChat_SSEFramer()
+    for chunk in chunks:
+        yield from framer.feed(chunk)
+        if framer.done:
+            return
+    yield from framer.flush()
+
+
+async def aiter_sse_frames(chunks):
+    """
+    Async version of :func:`iter_sse_frames`.
+    """
+    framer = FkUSTChat_SSEFramer()
+    async for chunk in chunks:
+        for frame in framer.feed(chunk):
+            yield frame
+        if framer.done:
+            return
+    for frame in framer.flush():
+        yield frame
+
+
+class FkUSTChat_ClosingStream:
+    def __init__(self, generator, sources):
+        """
+        Wraps a generator that reads other streams, so that closing it closes those streams even if
+        it was never started. Closing an unstarted generator skips its ``finally`` blocks, which
+        would otherwise leave the upstream slots and connections of the sources open.
+
+        :param generator: The wrapping generator.
+        :param sources: The streams it reads.
+        """
+        self.generator = generator
+        self.sources = sources
+        self.started = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.started = True
+        return next(self.generator)
+
+    def close(self):
+        started, self.started = self.started, True
+        self.generator.close()
+        if not started:
+            # 已开始的生成器会在自己的 finally 中关闭上游
+            for source in self.sources:
+                close = getattr(source, 'close', None)
+                if close is not None:
+                    close()
+
+
+class FkUSTChat_AsyncClosingStream:
+    def __init__(self, generator, sources):
+        """
+        Async version of :class:`FkUSTChat_ClosingStream`.
+        """
+        self.generator = generator
+        self.sources = sources
+        self.started = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        self.started = True
+        return await self.generator.__anext__()
+
+    async def aclose(self):
+        started, self.started = self.started, True
+        await self.generator.aclose()
+        if not started:
+            for source in self.sources:
+                aclose = getattr(source, 'aclose', None)
+                if aclose is not None:
+                    await aclose()
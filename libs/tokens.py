@@ -0,0 +1,349 @@
+import json
+import re
+import time
+from functools import lru_cache
+
+from libs.json_codec import dumps, loads
+from libs.sse import iter_sse_payloads, FkUSTChat_ClosingStream, FkUSTChat_AsyncClosingStream
+
+try:
+    from tokenizers import Tokenizer
+except ImportError:
+    Tokenizer = None
+
+# 各模型家族的 BPE 近似参数：每个 token 平均覆盖的汉字数、字母数，以及数字的切分长度
+TOKENIZER_PROFILES = {
+    "deepseek": {"cjk_chars_per_token": 1.5, "letters_per_token": 6, "digits_per_token": 3},
+    "qwen": {"cjk_chars_per_token": 1.4, "letters_per_token": 6, "digits_per_token": 1},
+    "default": {"cjk_chars_per_token": 1.0, "letters_per_token": 5, "digits_per_token": 3},
+}
+
+# ChatML 每条消息的额外开销：<|im_start|>、角色、换行与 <|im_end|>
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+
+_PRETOKENIZE = re.compile(
+    r'([\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+)'  # 汉字
+    r'|( ?[A-Za-z\u00c0-\u024f\u0400-\u04ff]+)'     # 拉丁/西里尔字母，前导空格并入单词
+    r'|([0-9]+)'                                   # 数字
+    r'|(\s+)'                                      # 空白
+    r'|([!-/:-@\[-`{-~]+)'                         # ASCII 标点
+    r'|(.)',                                       # 其他字符（全角标点、emoji 等）
+    re.S
+)
+
+
+class FkUSTChat_HeuristicTokenizer:
+    def __init__(self, family="default"):
+        """
+        An offline approximation of the byte-level BPE tokenizers of the DeepSeek and Qwen families.
+
+        Text is pre-tokenized the way those tokenizers split it (CJK runs, words with their leading
+        space, digit groups, whitespace and punctuation runs), and every piece is charged the number
+        of merges it typically ends up as. It needs no vocabulary file; configure a real
+        ``tokenizer.json`` (see :class:`FkUSTChat_Tokenizers`) where exact counts matter.
+
+        :param family: A key of ``TOKENIZER_PROFILES``.
+        """
+        self.family = family
+        profile = TOKENIZER_PROFILES.get(family, TOKENIZER_PROFILES["default"])
+        self.cjk_chars_per_token = profile["cjk_chars_per_token"]
+        self.letters_per_token = profile["letters_per_token"]
+        self.digits_per_token = profile["digits_per_token"]
+
+    def count(self, text):
+        """
+        Returns the number of tokens in ``text``.
+        """
+        tokens = 0
+        for cjk, word, digits, space, punct, other in _PRETOKENIZE.findall(text):
+            if cjk:
+                tokens += -(-len(cjk) // self.cjk_chars_per_token)
+            elif word:
+                tokens += -(-len(word.lstrip(' ')) // self.letters_per_token)
+            elif digits:
+                tokens += -(-len(digits) // self.digits_per_token)
+            elif punct:
+                tokens += -(-len(punct) // 2)
+            else:
+                tokens += 1
+        return int(tokens)
+
+
+class FkUSTChat_HFTokenizer:
+    def __init__(self, path):
+        """
+        An exact tokenizer loaded from the ``tokenizer.json`` of a model, using the optional ``tokenizers`` package.
+
+        :param path: The path of the ``tokenizer.json`` file.
+        """
+        self.tokenizer = Tokenizer.from_file(path)
+
+    def count(self, text):
+        """
+        Returns the number of tokens in ``text``.
+        """
+        return len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+class FkUSTChat_Tokenizers:
+    def __init__(self, paths=None, cache_size=1024):
+        """
+        Holds one tokenizer per model family.
+
+        A family with a ``tokenizer.json`` configured uses it when the ``tokenizers`` package is installed,
+        otherwise it falls back to :class:`FkUSTChat_HeuristicTokenizer`. Counts of whole messages are
+        memoized, so a system prompt repeated across requests is only tokenized once.
+
+        :param paths: A dict mapping family names to ``tokenizer.json`` paths.
+        :param cache_size: How many message counts are memoized per family.
+        """
+        self.paths = paths or {}
+        self.cache_size = cache_size
+        self._tokenizers = {}
+        self._counters = {}
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Builds the registry from the ``tokenizers`` section of the core config.
+
+        :param config: The section dict, or None.
+        """
+        config = config or {}
+        return cls(paths=config.get('paths'), cache_size=config.get('cache_size', 1024))
+
+    def get(self, family=None):
+        """
+        Returns the tokenizer of a model family.
+
+        :param family: The family name, e.g. ``deepseek`` or ``qwen``; None for the default profile.
+        """
+        family = family or "default"
+        tokenizer = self._tokenizers.get(family)
+        if tokenizer is None:
+            path = self.paths.get(family)
+            if path and Tokenizer is not None:
+                try:
+                    tokenizer = FkUSTChat_HFTokenizer(path)
+                except Exception as e:
+                    print(f'[!] 无法加载 {family} 的分词器 {path}: {e}，改用近似计数')
+            if tokenizer is None:
+                tokenizer = FkUSTChat_HeuristicTokenizer(family)
+            self._tokenizers[family] = tokenizer
+            self._counters[family] = lru_cache(maxsize=self.cache_size)(tokenizer.count)
+        return tokenizer
+
+    def count_text(self, family, text):
+        """
+        Returns the memoized token count of ``text``.
+        """
+        self.get(family)
+        return self._counters[family or "default"](text)
+
+    def count_messages(self, family, messages, tools=None):
+        """
+        Counts the prompt tokens of a chat request.
+
+        :param family: The model family.
+        :param messages: The chat messages.
+        :param tools: The tool definitions.
+        :return: The number of prompt tokens, including the chat template overhead.
+        """
+        tokens = REPLY_OVERHEAD
+        for message in messages:
+            tokens += MESSAGE_OVERHEAD
+            content = message.get("content")
+            if isinstance(content, list):
+                content = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+            if content:
+                tokens += self.count_text(family, content)
+            for tool_call in message.get("tool_calls") or ():
+                fn = tool_call.get("function", {})
+                tokens += self.count_text(family, fn.get("name", "")) + self.count_text(family, fn.get("arguments", ""))
+        if tools:
+            tokens += self.count_text(family, json.dumps(tools, ensure_ascii=False, sort_keys=True))
+        return tokens
+
+    def count_completion(self, family, result):
+        """
+        Counts the completion tokens of a chat.completion result.
+        """
+        tokens = 0
+        for choice in result.get("choices", []):
+            message = choice.get("message", {})
+            tokens += self.get(family).count(message.get("reasoning_content") or "")
+            tokens += self.get(family).count(message.get("content") or "")
+            for tool_call in message.get("tool_calls") or ():
+                fn = tool_call.get("function", {})
+                tokens += self.get(family).count(fn.get("name", "") + fn.get("arguments", ""))
+        return tokens
+
+
+class FkUSTChat_TokenCounter:
+    def __init__(self, tokenizer, batch_size=256):
+        """
+        Counts the tokens of a text that arrives in pieces, e.g. the deltas of a stream.
+
+        Pieces are collected and tokenized in batches, cut before the last whitespace, so a word
+        split across two deltas is not counted as two words and the per-call overhead of the
+        tokenizer is paid once per batch rather than once per delta.
+
+        :param tokenizer: An object with a ``count(text)`` method.
+        :param batch_size: How many characters are collected before they are tokenized.
+        """
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.counted = 0
+        self.pending = []
+        self.pending_size = 0
+
+    def feed(self, text):
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.pending_size < self.batch_size:
+            return
+        text = "".join(self.pending)
+        # 在最后一段空白之前切开，空白留给下一个词（BPE 会把前导空格并入单词）
+        cut = max(text.rfind(' '), text.rfind('\n'), 0)
+        while cut > 0 and text[cut - 1] in ' \n':
+            cut -= 1
+        if cut == 0:
+            cut = len(text)
+        self.counted += self.tokenizer.count(text[:cut])
+        rest = text[cut:]
+        self.pending = [rest] if rest else []
+        self.pending_size = len(rest)
+
+    @property
+    def total(self):
+        return self.counted + (self.tokenizer.count("".join(self.pending)) if self.pending else 0)
+
+
+def make_usage(prompt_tokens, completion_tokens):
+    """
+    Returns an OpenAI-style ``usage`` dict.
+    """
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
+
+
+class FkUSTChat_UsageInjector:
+    def __init__(self, counter, prompt_tokens):
+        """
+        Passes an OpenAI SSE stream through unchanged and adds the final usage chunk before ``[DONE]``,
+        as OpenAI does for ``stream_options: {"include_usage": true}``.
+
+        :param counter: A :class:`FkUSTChat_TokenCounter` for the completion.
+        :param prompt_tokens: The prompt token count.
+        """
+        self.counter = counter
+        self.prompt_tokens = prompt_tokens
+        self.meta = {}
+        self.done = False
+
+    def usage_frame(self):
+        chunk = {
+            "id": self.meta.get("id", ""),
+            "object": "chat.completion.chunk",
+            "created": self.meta.get("created", int(time.time())),
+            "model": self.meta.get("model", ""),
+            "choices": [],
+            "usage": make_usage(self.prompt_tokens, self.counter.total)
+        }
+        return b'data: ' + dumps(chunk) + b'\n\n'
+
+    def feed(self, chunk):
+        """
+        Adds a chunk of frames.
+
+        :param chunk: Bytes or str holding one or more complete frames.
+        :return: A list of byte strings to forward.
+        """
+        if self.done:
+            return []
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        # [DONE] 只会出现在帧首
+        done_at = 0 if chunk.startswith(b'data: [DONE]') else chunk.find(b'\ndata: [DONE]')
+        if done_at > 0:
+            done_at += 1
+        head = chunk if done_at < 0 else chunk[:done_at]
+        for payload in iter_sse_payloads((head,)):
+            try:
+                data = loads(payload)
+            except ValueError:
+                continue
+            if not self.meta:
+                self.meta.update((key, data[key]) for key in ("id", "created", "model") if key in data)
+            for choice in data.get("choices") or ():
+                delta = choice.get("delta") or {}
+                if delta.get("reasoning_content"):
+                    self.counter.feed(delta["reasoning_content"])
+                if delta.get("content"):
+                    self.counter.feed(delta["content"])
+                for tool_call in delta.get("tool_calls") or ():
+                    fn = tool_call.get("function") or {}
+                    self.counter.feed(fn.get("name") or "")
+                    self.counter.feed(fn.get("arguments") or "")
+        if done_at < 0:
+            return [chunk]
+        self.done = True
+        return [frame for frame in (head, self.usage_frame(), chunk[done_at:]) if frame]
+
+    def flush(self):
+        """
+        Returns the usage chunk if the stream ended without ``[DONE]``.
+        """
+        if self.done:
+            return []
+        self.done = True
+        return [self.usage_frame()]
+
+
+def iter_with_usage(chunks, counter, prompt_tokens):
+    """
+    Adds the usage chunk to an OpenAI SSE stream, see :class:`FkUSTChat_UsageInjector`.
+
+    :param chunks: An iterator of SSE chunks (bytes or str).
+    :param counter: A :class:`FkUSTChat_TokenCounter` for the completion.
+    :param prompt_tokens: The prompt token count.
+    :return: An iterator of bytes; closing it closes ``chunks``.
+    """
+    return FkUSTChat_ClosingStream(_iter_with_usage(chunks, counter, prompt_tokens), (chunks,))
+
+
+def _iter_with_usage(chunks, counter, prompt_tokens):
+    injector = FkUSTChat_UsageInjector(counter, prompt_tokens)
+    try:
+        for chunk in chunks:
+            yield from injector.feed(chunk)
+        yield from injector.flush()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def aiter_with_usage(chunks, counter, prompt_tokens):
+    """
+    Async version of :func:`iter_with_usage`.
+    """
+    return FkUSTChat_AsyncClosingStream(_aiter_with_usage(chunks, counter, prompt_tokens), (chunks,))
+
+
+async def _aiter_with_usage(chunks, counter, prompt_tokens):
+    injector = FkUSTChat_UsageInjector(counter, prompt_tokens)
+    try:
+        async for chunk in chunks:
+            for frame in injector.feed(chunk):
+                yield frame
+        for frame in injector.flush():
+            yield frame
+    finally:
+        aclose = getattr(chunks, 'aclose', None)
+        if aclose is not None:
+            await aclose()
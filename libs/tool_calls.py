@@ -0,0 +1,170 @@
+import re
+
+from libs.json_codec import loads
+
+# 参数 JSON 中影响结构的字符；其余字符无需逐个检查
+_STRUCTURAL = re.compile(r'["\\{}\[\]]')
+_CLOSING = {'}': '{', ']': '['}
+
+
+class FkUSTChat_JSONScanner:
+    def __init__(self):
+        """
+        Incrementally tracks the nesting of a JSON document fed in fragments, to tell when its top-level
+        object or array has closed without parsing it again on every fragment.
+
+        Only brackets, quotes and backslashes are inspected, so the cost is proportional to the
+        structure of the document rather than its length.
+        """
+        self.stack = []
+        self.in_string = False
+        self.escaped = False
+        self.complete = False
+        self.error = None
+
+    def feed(self, fragment):
+        """
+        :param fragment: The next piece of the document.
+        :return: True once the top-level value has closed.
+        """
+        if self.complete or self.error:
+            if self.complete and fragment.strip():
+                self.error = 'trailing data after the JSON value'
+            return self.complete
+        start = 0
+        if self.escaped:
+            # 上一段以反斜杠结尾，本段第一个字符是被转义的字符
+            self.escaped = False
+            start = 1
+        for match in _STRUCTURAL.finditer(fragment, start):
+            char = match.group()
+            position = match.start()
+            if position < start:
+                continue
+            if self.in_string:
+                if char == '\\':
+                    if position + 1 >= len(fragment):
+                        self.escaped = True
+                    start = position + 2
+                elif char == '"':
+                    self.in_string = False
+                continue
+            if char == '"':
+                self.in_string = True
+            elif char in '{[':
+                self.stack.append(char)
+            elif not self.stack or self.stack.pop() != _CLOSING[char]:
+                self.error = f'unbalanced {char!r}'
+                return False
+            elif not self.stack:
+                self.complete = True
+                if fragment[position + 1:].strip():
+                    self.error = 'trailing data after the JSON value'
+                return True
+        return False
+
+
+class FkUSTChat_ToolCallAccumulator:
+    def __init__(self, validate=False):
+        """
+        Reassembles OpenAI ``tool_calls`` deltas of a streamed answer into complete tool calls.
+
+        Argument fragments are kept in a list per call and joined once when the call completes. A call
+        completes when a delta for a later call arrives, when the stream finishes, or, with
+        ``validate``, as soon as its arguments form a closed JSON object. Completed calls are
+        returned by :meth:`feed` right away, so a caller can start running a tool while the model is
+        still writing the next one.
+
+        :param validate: Whether to scan the arguments incrementally, to complete calls early and to
+                         report arguments that are not valid JSON in the ``error`` field.
+        """
+        self.validate = validate
+        self.calls = {}
+        self.emitted = set()
+
+    def feed(self, deltas):
+        """
+        Consumes the ``tool_calls`` list of one chunk's delta.
+
+        :param deltas: The tool call deltas, each with ``index`` and optionally ``id``, ``type`` and ``function``.
+        :return: The calls completed by these deltas, in index order (possibly empty).
+        """
+        completed = []
+        for tc in deltas or ():
+            index = tc.get("index", 0)
+            call = self.calls.get(index)
+            if call is None:
+                # 按 OpenAI 的流式格式，新的调用开始时之前的调用都已结束
+                for previous in sorted(self.calls):
+                    if previous < index and previous not in self.emitted:
+                        completed.append(self._complete(previous))
+                call = self.calls[index] = {
+                    "id": tc.get("id"),
+                    "type": tc.get("type") or "function",
+                    "name": [],
+                    "arguments": [],
+                    "scanner": FkUSTChat_JSONScanner() if self.validate else None
+                }
+            if tc.get("id") and not call["id"]:
+                call["id"] = tc["id"]
+            function = tc.get("function") or {}
+            if function.get("name"):
+                call["name"].append(function["name"])
+            arguments = function.get("arguments")
+            if arguments:
+                if index in self.emitted:
+                    # 已经交出的调用只应再收到空白
+                    if arguments.strip():
+                        print(f'[!] 工具调用 {index} 完成后仍收到参数片段，已忽略')
+                    continue
+                call["arguments"].append(arguments)
+                scanner = call["scanner"]
+                if scanner is not None and scanner.feed(arguments):
+                    completed.append(self._complete(index))
+        return completed
+
+    def finish(self):
+        """
+        Completes the calls still open at the end of the stream.
+
+        :return: Those calls, in index order.
+        """
+        return [self._complete(index) for index in sorted(self.calls) if index not in self.emitted]
+
+    def _complete(self, index):
+        self.emitted.add(index)
+        call = self.calls[index]
+        arguments = ''.join(call["arguments"])
+        call["arguments"] = [arguments]
+        result = {
+            "index": index,
+            "id": call["id"],
+            "type": call["type"],
+            "function": {"name": ''.join(call["name"]), "arguments": arguments}
+        }
+        scanner = call["scanner"]
+        if scanner is not None and arguments.strip():
+            error = scanner.error or (None if scanner.complete else 'incomplete JSON arguments')
+            if error is None:
+                # 括号配平不代表内容合法，完成时完整解析一次
+                try:
+                    loads(arguments)
+                except ValueError as e:
+                    error = str(e)
+            if error:
+                result["error"] = error
+        return result
+
+    def get_tool_calls(self):
+        """
+        Returns every call seen so far, in index order, as OpenAI ``tool_calls`` message entries.
+        """
+        calls = []
+        for index in sorted(self.calls):
+            call = self.calls[index]
+            calls.append({
+                "id": call["id"],
+                "type": call["type"],
+                "function": {"name": ''.join(call["name"]), "arguments": ''.join(call["arguments"])}
+            })
+        return calls
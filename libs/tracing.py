@@ -0,0 +1,285 @@
+import atexit
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from collections import deque
+
+
+_current_span = contextvars.ContextVar('fkustchat_span', default=None)
+
+
+def new_request_id():
+    return uuid.uuid4().hex
+
+
+def parse_traceparent(value):
+    """
+    Parses a W3C ``traceparent`` header.
+
+    :return: ``(trace_id, parent_span_id, sampled)``, or None if the header is absent or malformed.
+    """
+    parts = (value or '').strip().split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+        return parts[1], parts[2], bool(int(parts[3], 16) & 1)
+    except ValueError:
+        return None
+
+
+class FkUSTChat_Span:
+    def __init__(self, tracer, name, trace_id, parent_id=None, attributes=None, kind='internal'):
+        """
+        One timed phase of a request. Use it as a context manager to make it the parent of the spans started inside.
+        """
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.start_time = time.time_ns()
+        self.end_time = None
+        self.error = None
+        self._token = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self, error=None):
+        """
+        Ends the span and hands it to the exporter. Calling it more than once has no effect.
+        """
+        if self.end_time is not None:
+            return
+        self.end_time = time.time_ns()
+        if error is not None:
+            self.error = f'{type(error).__name__}: {error}'
+        self.tracer.export(self)
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_span.reset(self._token)
+        self.end(exc)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "duration_ms": (self.end_time - self.start_time) / 1e6,
+            "attributes": self.attributes,
+            "error": self.error
+        }
+
+
+class _NoopSpan:
+    # 未采样的请求使用同一个空对象，几乎没有开销
+    trace_id = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    def end(self, error=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class FkUSTChat_JSONLExporter:
+    def __init__(self, path):
+        """
+        Appends finished spans to a file, one JSON object per line.
+        """
+        self.path = path
+
+    def export(self, spans):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), ensure_ascii=False) + '\n')
+
+
+class FkUSTChat_OTLPExporter:
+    KINDS = {'internal': 1, 'server': 2, 'client': 3}
+
+    def __init__(self, endpoint, service_name='fkustchat', headers=None):
+        """
+        Sends finished spans to an OpenTelemetry collector over OTLP/HTTP with JSON encoding.
+
+        :param endpoint: The collector base URL, e.g. ``http://127.0.0.1:4318``.
+        :param service_name: The ``service.name`` resource attribute.
+        :param headers: Extra request headers, e.g. for authentication.
+        """
+        self.url = endpoint.rstrip('/') + '/v1/traces'
+        self.service_name = service_name
+        self.headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+
+    @staticmethod
+    def encode_value(value):
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        return {"stringValue": str(value)}
+
+    def encode_span(self, span):
+        encoded = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": self.KINDS.get(span.kind, 1),
+            "startTimeUnixNano": str(span.start_time),
+            "endTimeUnixNano": str(span.end_time),
+            "attributes": [{"key": key, "value": self.encode_value(value)} for key, value in span.attributes.items()],
+            "status": {"code": 2, "message": span.error} if span.error else {"code": 1}
+        }
+        if span.parent_id:
+            encoded["parentSpanId"] = span.parent_id
+        return encoded
+
+    def export(self, spans):
+        import requests
+
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+                "scopeSpans": [{"scope": {"name": "fkustchat"}, "spans": [self.encode_span(span) for span in spans]}]
+            }]
+        }
+        requests.post(self.url, data=json.dumps(payload), headers=self.headers, timeout=10).raise_for_status()
+
+
+class FkUSTChat_Tracer:
+    def __init__(self, exporter=None, sample_rate=0.0, batch_size=512, flush_interval=1.0):
+        """
+        Records request spans and exports them in batches from a background thread.
+
+        A request is traced if the client sent a sampled ``traceparent`` header or it is picked
+        with probability ``sample_rate``. Spans of requests that are not traced are a shared no-op
+        object, so untraced requests only pay for a context variable lookup per phase.
+
+        :param exporter: An object with an ``export(spans)`` method, or None to disable tracing.
+        :param sample_rate: Share of requests traced, between 0 and 1.
+        :param batch_size: Spans exported per call.
+        :param flush_interval: Seconds between two exports.
+        """
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._queue = deque(maxlen=100000)
+        self._thread = None
+        self._wakeup = threading.Event()
+        atexit.register(self.flush)
+
+    def configure(self, config):
+        """
+        Applies the ``tracing`` section of the core config.
+
+        :param config: A dict with ``enabled``, ``sample_rate``, ``exporter`` (``jsonl`` or ``otlp``),
+                       ``path``, ``endpoint``, ``service_name`` and ``headers`` keys.
+        """
+        config = config or {}
+        if not config.get('enabled', False):
+            self.exporter = None
+            return
+        if config.get('exporter', 'jsonl') == 'otlp':
+            self.exporter = FkUSTChat_OTLPExporter(config.get('endpoint', 'http://127.0.0.1:4318'), config.get('service_name', 'fkustchat'), config.get('headers'))
+        else:
+            self.exporter = FkUSTChat_JSONLExporter(config.get('path', './traces.jsonl'))
+        self.sample_rate = config.get('sample_rate', 1.0)
+
+    def start_trace(self, name, request_id, traceparent=None, attributes=None):
+        """
+        Starts the root span of a request, or returns the no-op span if the request is not sampled.
+
+        :param name: The span name, e.g. the route.
+        :param request_id: The request id; it becomes the trace id unless the client sent a ``traceparent``.
+        :param traceparent: The client's ``traceparent`` header, if any.
+        """
+        if self.exporter is None:
+            return NOOP_SPAN
+        parent = parse_traceparent(traceparent)
+        if parent is not None:
+            trace_id, parent_id, sampled = parent
+        else:
+            # 请求 ID 本身是 32 位十六进制时直接作为 trace id，便于按请求 ID 查找
+            trace_id = request_id if len(request_id) == 32 and all(c in '0123456789abcdef' for c in request_id) else new_request_id()
+            parent_id, sampled = None, False
+        if not sampled and random.random() >= self.sample_rate:
+            return NOOP_SPAN
+        attributes = dict(attributes or {}, request_id=request_id)
+        return FkUSTChat_Span(self, name, trace_id, parent_id, attributes, kind='server')
+
+    def export(self, span):
+        self._queue.append(span)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        if len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        while self._queue and self.exporter is not None:
+            batch = []
+            while self._queue and len(batch) < self.batch_size:
+                batch.append(self._queue.popleft())
+            try:
+                self.exporter.export(batch)
+            except Exception as e:
+                print(f'[!] 导出追踪数据失败: {e}')
+                return
+
+
+TRACER = FkUSTChat_Tracer()
+
+
+def get_current_span():
+    return _current_span.get()
+
+
+def set_current_span(span):
+    """
+    Makes ``span`` the parent of the spans started afterwards in this thread or task.
+    """
+    _current_span.set(span if span is not NOOP_SPAN else None)
+
+
+def start_span(name, **attributes):
+    """
+    Starts a child of the current span; without a traced request it returns the no-op span.
+    Use it as a context manager, or call :meth:`FkUSTChat_Span.end` for spans that outlive the current call, e.g. a stream.
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return NOOP_SPAN
+    return FkUSTChat_Span(parent.tracer, name, parent.trace_id, parent.span_id, attributes)
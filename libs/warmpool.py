@@ -0,0 +1,133 @@
+import threading
+import time
+
+
+class FkUSTChat_WarmPool:
+    def __init__(self, produce, size=2, max_age=60, retry_delay=5, shared=None, name=None):
+        """
+        Keeps a few single-use items, e.g. upstream queue codes, produced ahead of demand.
+
+        Every :meth:`take` hands out a ready item if there is one and wakes a background thread
+        that produces replacements until ``size`` items are ready again. Refilling only happens
+        after demand, so an idle pool lets its items expire instead of producing new ones. Items
+        are tied to a key (e.g. the token they were produced with) and are thrown away once they
+        are older than ``max_age`` or the key changes.
+
+        :param produce: Callable taking the key and returning a new item.
+        :param size: How many items are kept ready; 0 disables the pool.
+        :param max_age: Seconds an item stays usable.
+        :param retry_delay: Seconds the refill thread waits after ``produce`` failed.
+        :param shared: Optional :class:`FkUSTChat_SharedState`; the items are then kept there under ``name``,
+                       so the worker processes draw from one pool of ``size`` items instead of one each.
+        :param name: The pool name in the shared state.
+        """
+        self.produce = produce
+        self.size = size
+        self.max_age = max_age
+        self.retry_delay = retry_delay
+        self.shared = shared
+        self.name = name
+
+        self._cond = threading.Condition()
+        self._items = []
+        self._key = None
+        self._demand = False
+        self._closed = False
+        self._thread = None
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def take(self, key):
+        """
+        Returns an item for ``key``, producing it on the spot if none is ready.
+
+        :param key: The key the item must belong to.
+        """
+        with self._cond:
+            item = self._pop(key)
+            if item is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if self.size > 0 and not self._closed:
+                self._key = key
+                self._demand = True
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._refill, daemon=True)
+                    self._thread.start()
+                self._cond.notify()
+        if item is not None:
+            return item
+        return self.produce(key)
+
+    def _pop(self, key):
+        # 在持有锁时调用
+        if self.shared is not None:
+            item, dropped = self.shared.pop(self.name, key, self.max_age)
+            self.expired += dropped
+            return item
+        now = time.time()
+        while self._items:
+            item_key, value, created_at = self._items.pop(0)
+            if item_key == key and now - created_at < self.max_age:
+                return value
+            self.expired += 1
+        return None
+
+    def _ready(self):
+        # 在持有锁时调用
+        if self.shared is not None:
+            return self.shared.count(self.name)
+        return len(self._items)
+
+    def _refill(self):
+        while True:
+            with self._cond:
+                while not self._closed and not (self._demand and self._ready() < self.size):
+                    self._cond.wait()
+                if self._closed:
+                    return
+                key = self._key
+            try:
+                value = self.produce(key)
+            except Exception as e:
+                print(f'[!] 预取失败: {e}')
+                time.sleep(self.retry_delay)
+                continue
+            with self._cond:
+                if key == self._key:
+                    if self.shared is not None:
+                        self.shared.push(self.name, key, value)
+                    else:
+                        self._items.append((key, value, time.time()))
+                if self._ready() >= self.size:
+                    self._demand = False
+
+    def clear(self):
+        """
+        Throws away the ready items, e.g. after their key was rejected.
+        """
+        with self._cond:
+            self._items.clear()
+            if self.shared is not None:
+                self.shared.clear(self.name)
+
+    def close(self):
+        """
+        Stops the refill thread.
+        """
+        with self._cond:
+            self._closed = True
+            self._items.clear()
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "ready": self._ready(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired
+            }
@@ -0,0 +1,30 @@
+import os
+import sys
+from os import path
+
+import uvicorn # pip install uvicorn httpx
+
+from libs.config_store import FkUSTChat_ConfigStore, CONFIG_ENV
+from libs.shared_state import WORKERS_ENV
+
+# 多进程启动器：python serve.py [端口] [worker 数量]
+# 每个 worker 都是一个完整的 asgi.py 实例，共享同一个监听端口、config 文件和 shared_state 数据库
+
+if __name__ == '__main__':
+    core_config = FkUSTChat_ConfigStore(os.environ.get(CONFIG_ENV) or path.join(path.dirname(__file__), "config")).load().get('FkUSTChat_Core', {})
+
+    try:
+        port = int(sys.argv[1])
+    except Exception as e:
+        port = 5000
+    try:
+        workers = int(sys.argv[2])
+    except Exception as e:
+        workers = core_config.get('workers', os.cpu_count() or 1)
+
+    if workers > 1 and not core_config.get('shared_state', {}).get('path'):
+        print('[!] 未配置 FkUSTChat_Core.shared_state，各 worker 将分别登录和维护排队码')
+
+    os.environ[WORKERS_ENV] = str(workers)
+    os.chdir(path.dirname(path.abspath(__file__)))
+    uvicorn.run('asgi:application', host='0.0.0.0', port=port, workers=workers)
@@ -0,0 +1,80 @@
+import json
+import sys
+import time
+from os import path
+
+import pytest
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+
+from adapters.base import FkUSTChat_BaseAdapter, FkUSTChat_BaseModel
+
+ANSWER = ["Hello", " world", "!"]
+
+
+def completion_chunk(delta, finish_reason=None):
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "fake",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    }
+
+
+class FakeModel(FkUSTChat_BaseModel):
+    def __init__(self, adapter):
+        super().__init__(adapter, {"name": "m"})
+
+    def get_response(self, prompt, stream=False, **kwargs):
+        adapter = self.adapter
+        adapter.calls += 1
+        adapter.prompts.append(prompt)
+        if adapter.calls in adapter.fail_calls:
+            raise ValueError("upstream failed")
+        if adapter.delay:
+            time.sleep(adapter.delay)
+        if not stream:
+            return {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": 0,
+                "model": "fake",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(ANSWER)}, "finish_reason": "stop"}]
+            }
+
+        def generate():
+            for piece in ANSWER:
+                yield b'data: ' + json.dumps(completion_chunk({"content": piece})).encode() + b'\n\n'
+            yield b'data: ' + json.dumps(completion_chunk({}, "stop")).encode() + b'\n\n'
+            yield b'data: [DONE]\n\n'
+        return generate()
+
+
+class FakeAdapter(FkUSTChat_BaseAdapter):
+    def __init__(self, context=None):
+        super().__init__(context, {"name": "Fake"})
+        self.models = {"m": FakeModel(self)}
+        self.calls = 0
+        self.prompts = []
+        self.fail_calls = ()
+        self.delay = 0
+
+
+@pytest.fixture
+def make_core(tmp_path):
+    """
+    Builds a core with the fake adapter registered as ``__Fake__m``, from the given config sections.
+    """
+    from libs.core import FkUSTChat_Core
+
+    def make(**sections):
+        config = {"FkUSTChat_Core": {"config_store": {"watch_interval": 0}}}
+        for name, section in sections.items():
+            config.setdefault(name, {}).update(section)
+        config_file = tmp_path / "config"
+        config_file.write_text(json.dumps(config))
+        core = FkUSTChat_Core(str(config_file))
+        core.register_adapter(FakeAdapter())
+        return core
+    return make
@@ -0,0 +1,77 @@
+import pytest
+
+from libs.accounts import FkUSTChat_Account, FkUSTChat_AccountPool
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("libs.accounts.time.time", lambda: now[0])
+    return now
+
+
+def make_pool(*names, **options):
+    pool = FkUSTChat_AccountPool(**options)
+    pool.set_accounts([FkUSTChat_Account(name, None) for name in names])
+    return pool
+
+
+def test_least_outstanding_account_is_picked():
+    pool = make_pool("a", "b")
+    first, second = pool.acquire(), pool.acquire()
+    assert {first.name, second.name} == {"a", "b"}
+    pool.release(first, 200)
+    assert pool.acquire() is first
+    assert pool.acquire(exclude=(first,)) is second
+
+
+def test_lease_is_released_once():
+    pool = make_pool("a")
+    lease = pool.lease()
+    lease.status = 200
+    lease.release()
+    lease.release()
+    assert pool.accounts[0].outstanding == 0
+
+
+def test_failing_account_is_ejected_with_backoff(clock):
+    pool = make_pool("a", "b", base_ejection=30, max_ejection=100)
+    a = pool.accounts[0]
+    for expected in (30, 60, 100):
+        pool.release(pool.acquire(exclude=(pool.accounts[1],)), 429)
+        assert a.ejected_until - clock[0] == expected
+        assert all(pool.acquire().name == "b" for _ in range(3))
+        clock[0] = a.ejected_until
+    pool.release(pool.acquire(exclude=(pool.accounts[1],)), 200)
+    assert a.failures == 0
+
+
+def test_concurrent_failures_eject_once(clock):
+    pool = make_pool("a", "b")
+    a = pool.accounts[0]
+    leases = [pool.acquire(exclude=(pool.accounts[1],)) for _ in range(3)]
+    for account in leases:
+        pool.release(account, 401)
+    assert a.ejections == 1 and a.outstanding == 0
+
+
+def test_readmitted_account_ramps_up(clock):
+    pool = make_pool("a", "b", base_ejection=10, ramp_up=60)
+    a, b = pool.accounts
+    pool.release(pool.acquire(exclude=(b,)), 429)
+    clock[0] = a.ejected_until
+    assert pool.stats()[0]["weight"] == pytest.approx(0.1)
+    # 刚恢复的账号只分到一小部分请求
+    picked = [pool.acquire().name for _ in range(11)]
+    assert picked.count("a") == 1
+    clock[0] += 60
+    assert pool.stats()[0]["weight"] == 1.0
+
+
+def test_all_ejected_uses_first_to_return(clock):
+    pool = make_pool("a", "b", base_ejection=10)
+    a, b = pool.accounts
+    pool.release(pool.acquire(exclude=(b,)), 429)
+    clock[0] += 5
+    pool.release(pool.acquire(exclude=(a,)), 429)
+    assert pool.acquire() is a
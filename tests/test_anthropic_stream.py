@@ -0,0 +1,65 @@
+import json
+
+from libs.anthropic_stream import FkUSTChat_AnthropicTranscoder
+
+
+def chunk(delta, finish_reason=None):
+    return {"id": "c", "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+
+def tool_delta(fragment, **fields):
+    return chunk({"tool_calls": [dict({"index": 0, "function": {"arguments": fragment}}, **fields)]})
+
+
+def events(data):
+    result = []
+    for frame in data.decode('utf-8').split('\n\n'):
+        if frame:
+            event, payload = frame.split('\n')
+            assert payload.startswith('data: ')
+            result.append((event[len('event: '):], json.loads(payload[6:])))
+    return result
+
+
+def run(chunks):
+    stream = [b'data: ' + json.dumps(c).encode() + b'\n\n' for c in chunks] + [b'data: [DONE]\n\n']
+    return events(b''.join(FkUSTChat_AnthropicTranscoder("m", input_tokens=7).transcode(iter(stream))))
+
+
+def test_text_answer():
+    result = run([chunk({"role": "assistant", "content": 'say "hi"\n'}), chunk({"content": "bye"}), chunk({}, "stop")])
+    assert [event for event, _ in result] == [
+        "message_start", "content_block_start", "content_block_delta", "content_block_delta",
+        "content_block_stop", "message_delta", "message_stop"
+    ]
+    assert result[0][1]["message"]["usage"]["input_tokens"] == 7
+    assert "".join(data["delta"]["text"] for event, data in result if event == "content_block_delta") == 'say "hi"\nbye'
+    assert result[-2][1]["delta"]["stop_reason"] == "end_turn"
+    assert result[-2][1]["usage"]["output_tokens"] > 0
+
+
+def test_tool_use_blocks():
+    result = run([
+        chunk({"content": "Let me check."}),
+        tool_delta('{"city": ', id="call_1", function={"name": "weather", "arguments": '{"city": '}),
+        tool_delta('"Hefei"}'),
+        chunk({"tool_calls": [{"index": 1, "id": "call_2", "function": {"name": "time", "arguments": "{}"}}]}),
+        chunk({}, "tool_calls"),
+    ])
+    starts = [data for event, data in result if event == "content_block_start"]
+    assert [block["index"] for block in starts] == [0, 1, 2]
+    assert starts[1]["content_block"] == {"type": "tool_use", "id": "call_1", "name": "weather", "input": {}}
+    partial = "".join(data["delta"]["partial_json"] for event, data in result if event == "content_block_delta" and data["index"] == 1)
+    assert json.loads(partial) == {"city": "Hefei"}
+    # 参数完整的工具块立即关闭，先于下一个块开始
+    names = [(event, data.get("index")) for event, data in result]
+    assert names.index(("content_block_stop", 1)) < names.index(("content_block_start", 2))
+    assert [index for event, index in names if event == "content_block_stop"] == [0, 1, 2]
+    assert result[-2][1]["delta"]["stop_reason"] == "tool_use"
+
+
+def test_length_stop_reason_and_bad_payload():
+    transcoder = FkUSTChat_AnthropicTranscoder("m")
+    assert transcoder.feed(b'not json') == b''
+    transcoder.feed(json.dumps(chunk({"content": "x"}, "length")))
+    assert events(transcoder.finish())[-2][1]["delta"]["stop_reason"] == "max_tokens"
@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+from libs.batch import FkUSTChat_BatchRunner
+
+MODEL = "__Fake__m"
+
+
+def batch(*custom_ids):
+    return "\n".join(json.dumps({"custom_id": custom_id, "body": {"model": MODEL, "messages": [{"role": "user", "content": custom_id}]}}) for custom_id in custom_ids)
+
+
+def run(runner, batch_id, body):
+    return {result["custom_id"]: result for result in map(json.loads, runner.run(batch_id, runner.parse(body)))}
+
+
+def checkpoint_lines(runner, batch_id):
+    with open(runner.checkpoint_path(batch_id), 'rb') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_resume_replays_finished_requests(make_core, tmp_path):
+    core = make_core()
+    runner = FkUSTChat_BatchRunner(core, directory=str(tmp_path / "batches"))
+    first = run(runner, "b1", batch("a", "b"))
+    assert core.adapters["Fake"].calls == 2
+    second = run(runner, "b1", batch("a", "b", "c"))
+    assert core.adapters["Fake"].calls == 3
+    assert second["a"] == first["a"] and second["c"]["response"]["status_code"] == 200
+
+
+def test_failed_requests_run_again(make_core, tmp_path):
+    core = make_core()
+    core.adapters["Fake"].fail_calls = (1,)
+    runner = FkUSTChat_BatchRunner(core, directory=str(tmp_path / "batches"))
+    assert run(runner, "b1", batch("a"))["a"]["response"]["status_code"] == 500
+    assert run(runner, "b1", batch("a"))["a"]["response"]["status_code"] == 200
+    assert [line["custom_id"] for line in checkpoint_lines(runner, "b1")] == ["a"]
+
+
+def test_torn_checkpoint_line_is_cut_off(make_core, tmp_path):
+    core = make_core()
+    runner = FkUSTChat_BatchRunner(core, directory=str(tmp_path / "batches"))
+    run(runner, "b1", batch("a"))
+    with open(runner.checkpoint_path("b1"), 'ab') as f:
+        f.write(b'{"id": "batch_req_x", "custom_id": "b", "resp')
+    results = run(runner, "b1", batch("a", "b"))
+    assert results["b"]["response"]["status_code"] == 200
+    assert [line["custom_id"] for line in checkpoint_lines(runner, "b1")] == ["a", "b"]
+
+
+def test_duplicate_custom_id_does_not_shadow_the_request(make_core, tmp_path):
+    core = make_core()
+    runner = FkUSTChat_BatchRunner(core, directory=str(tmp_path / "batches"))
+    items = runner.parse(batch("a", "a"))
+    assert items[1][2] is not None
+    results = runner.run("b1", items)
+    # 读到重复行的错误后中断，原请求尚未完成
+    assert json.loads(next(results))["response"]["status_code"] == 400
+    results.close()
+    assert all(line["response"]["status_code"] == 200 for line in checkpoint_lines(runner, "b1"))
+    assert run(runner, "b1", batch("a"))["a"]["response"]["status_code"] == 200
+
+
+def test_running_batch_is_rejected(make_core, tmp_path):
+    runner = FkUSTChat_BatchRunner(make_core(), directory=str(tmp_path / "batches"))
+    results = runner.run("b1", runner.parse(batch("a")))
+    with pytest.raises(ValueError):
+        runner.run("b1", runner.parse(batch("a")))
+    results.close()
+    runner.run("b1", runner.parse(batch("a"))).close()
+
+
+def test_requests_are_validated_like_chat_completions(make_core, tmp_path):
+    runner = FkUSTChat_BatchRunner(make_core(), directory=str(tmp_path / "batches"))
+    body = "\n".join(json.dumps({"custom_id": custom_id, "body": body}) for custom_id, body in [
+        ("model", {"model": "missing", "messages": []}),
+        ("n", {"model": MODEL, "messages": [], "n": 99}),
+        ("stream", {"model": MODEL, "messages": [{"role": "user", "content": "hi"}], "stream": True}),
+    ])
+    results = run(runner, "b1", body)
+    assert results["model"]["response"]["status_code"] == 400
+    assert results["n"]["response"]["body"]["error"]["param"] == "n"
+    assert results["stream"]["response"]["body"]["choices"][0]["message"]["content"] == "Hello world!"
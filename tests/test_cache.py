@@ -0,0 +1,71 @@
+import json
+
+from libs.cache import FkUSTChat_ResponseCache, make_request_key, get_cache_mode, completion_to_sse
+from libs.chat import FkUSTChat_ChatRequest
+
+MODEL = "__Fake__m"
+MESSAGES = [{"role": "user", "content": "hi"}]
+COMPLETION = {"id": "a", "object": "chat.completion", "created": 0, "model": "m",
+              "choices": [{"index": 0, "message": {"role": "assistant", "content": "x"}, "finish_reason": "stop"}]}
+
+
+def test_request_key_covers_what_changes_the_answer():
+    key = make_request_key(MODEL, MESSAGES)
+    assert key == make_request_key(MODEL, [{"content": "hi", "role": "user"}], tools=[], with_search=0)
+    assert key != make_request_key(MODEL, MESSAGES, with_search=True)
+    assert key != make_request_key(MODEL, MESSAGES, max_tokens=10)
+    assert key != make_request_key(MODEL, MESSAGES, stop=["x"])
+    assert key != make_request_key(MODEL, MESSAGES, sampling={"top_p": 0.5})
+    assert key != make_request_key("other", MESSAGES)
+
+
+def test_cache_mode():
+    cache = FkUSTChat_ResponseCache()
+    assert get_cache_mode(None, {}, {}) is None
+    assert get_cache_mode(cache, {}, {}) == 'USE'
+    assert get_cache_mode(cache, {"temperature": 0}, {}) == 'USE'
+    assert get_cache_mode(cache, {"temperature": 0.7}, {}) == 'BYPASS'
+    assert get_cache_mode(cache, {"n": 2}, {}) == 'BYPASS'
+    assert get_cache_mode(cache, {}, {"cache-control": "no-cache"}) == 'BYPASS'
+    assert get_cache_mode(cache, {}, {"x-fkustchat-cache": "Bypass"}) == 'BYPASS'
+
+
+def test_cache_expires_and_evicts(monkeypatch):
+    cache = FkUSTChat_ResponseCache(max_entries=2, ttl=10)
+    now = [1000.0]
+    monkeypatch.setattr("libs.cache.time.time", lambda: now[0])
+    for key in ("a", "b", "c"):
+        cache.set(key, COMPLETION)
+    assert cache.get("a") is None and cache.get("c") == COMPLETION
+    assert cache.evictions == 1
+    now[0] += 11
+    assert cache.get("c") is None
+
+
+def test_sqlite_cache_survives_restart(tmp_path):
+    db = str(tmp_path / "cache.db")
+    FkUSTChat_ResponseCache(path=db).set("k", COMPLETION)
+    assert FkUSTChat_ResponseCache(path=db).get("k") == COMPLETION
+
+
+def test_replay_as_stream():
+    payloads = [frame[6:] for frame in completion_to_sse(COMPLETION)]
+    assert payloads[-1] == "[DONE]\n\n"
+    chunks = [json.loads(payload) for payload in payloads[:-1]]
+    assert chunks[0]["choices"][0]["delta"]["content"] == "x"
+    assert chunks[-1]["choices"][0]["finish_reason"] == "stop"
+
+
+def test_repeated_request_is_served_from_cache(make_core):
+    core = make_core(FkUSTChat_Core={"response_cache": {"enabled": True}})
+
+    def call(headers):
+        chat = FkUSTChat_ChatRequest(core, {"model": MODEL, "messages": MESSAGES}, headers)
+        cached = chat.start("client")
+        response = chat.finish(cached if cached is not None else chat.get_responses("client"))
+        return response, dict(chat.response_headers())["X-FkUSTChat-Cache"]
+    first, status = call({})
+    assert status == 'MISS'
+    assert call({}) == (first, 'HIT')
+    assert call({"x-fkustchat-cache": "bypass"})[1] == 'BYPASS'
+    assert core.adapters["Fake"].calls == 2
@@ -0,0 +1,70 @@
+import json
+
+from libs.completion import FkUSTChat_CompletionCollector, FkUSTChat_StopMatcher, normalize_stop
+from libs.tokens import FkUSTChat_TokenCounter
+
+
+class CharTokenizer:
+    def count(self, text):
+        return len(text)
+
+
+def line(delta, finish_reason=None):
+    chunk = {"id": "a", "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+    return b'data: ' + json.dumps(chunk).encode()
+
+
+def collect(pieces, **options):
+    """
+    Feeds the pieces to a collector and returns it with the number of lines it consumed before asking to stop.
+    """
+    collector = FkUSTChat_CompletionCollector("m", **options)
+    lines = [line({"content": piece}) for piece in pieces] + [line({}, "stop"), b'data: [DONE]']
+    for consumed, data in enumerate(lines, 1):
+        if collector.feed_line(data):
+            return collector, consumed
+    return collector, len(lines)
+
+
+def test_stop_sequence_ends_collection_early():
+    collector, consumed = collect(["Hello ", "wor", "ld. More", " text"] * 10, stop=["world", "xyz"])
+    assert consumed == 3
+    result = collector.result()["choices"][0]
+    assert result["message"]["content"] == "Hello "
+    assert result["finish_reason"] == "stop"
+
+
+def test_stop_sequence_inside_one_piece():
+    collector, _ = collect(["abcSTOPdef"], stop="STOP")
+    assert collector.result()["choices"][0]["message"]["content"] == "abc"
+
+
+def test_max_tokens_ends_collection_early():
+    counter = FkUSTChat_TokenCounter(CharTokenizer(), batch_size=1)
+    collector, consumed = collect(["abcd"] * 100, max_tokens=10, counter=counter)
+    assert consumed == 3
+    assert collector.result()["choices"][0]["finish_reason"] == "length"
+
+
+def test_runs_to_the_end_without_limits():
+    collector, consumed = collect(["a", "b"])
+    assert consumed == 3 and collector.done
+    assert collector.result()["choices"][0] == {"index": 0, "message": {"role": "assistant", "content": "ab"}, "finish_reason": "stop"}
+    assert collector.feed_line(line({"content": "late"}))
+    assert collector.result()["choices"][0]["message"]["content"] == "ab"
+
+
+def test_tool_calls_are_collected():
+    collector = FkUSTChat_CompletionCollector("m")
+    collector.feed_line(line({"tool_calls": [{"index": 0, "id": "c", "function": {"name": "f", "arguments": '{"a"'}}]}))
+    collector.feed_line(line({"tool_calls": [{"index": 0, "function": {"arguments": ': 1}'}}]}, "stop"))
+    result = collector.result()["choices"][0]
+    assert result["finish_reason"] == "tool_calls"
+    assert json.loads(result["message"]["tool_calls"][0]["function"]["arguments"]) == {"a": 1}
+
+
+def test_stop_matcher():
+    assert normalize_stop("x") == ["x"] and normalize_stop(["", "y", 1]) == ["y"] and normalize_stop(None) == []
+    matcher = FkUSTChat_StopMatcher(["END", "NO"])
+    assert matcher.feed("some E") is None and matcher.pending()
+    assert matcher.feed("NDNO") == (5, "END")
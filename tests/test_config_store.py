@@ -0,0 +1,62 @@
+import json
+import os
+import subprocess
+import sys
+from os import path
+
+from libs.config_store import FkUSTChat_ConfigStore
+
+ROOT = path.join(path.dirname(path.abspath(__file__)), '..')
+
+WRITER = """
+import sys
+sys.path.insert(0, sys.argv[1])
+from libs.config_store import FkUSTChat_ConfigStore
+store = FkUSTChat_ConfigStore(sys.argv[2], flush_delay=60)
+for i in range(20):
+    store.set("tokens", f"{sys.argv[3]}-{i}", i)
+    store.flush()
+"""
+
+
+def read(config_path):
+    with open(config_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_writes_are_batched_and_visible_before_flush(tmp_path):
+    config_path = str(tmp_path / "config")
+    store = FkUSTChat_ConfigStore(config_path, flush_delay=60)
+    store.set("a", "x", 1)
+    store.set("a", "y", 2)
+    assert not path.exists(config_path)
+    assert store.load() == {"a": {"x": 1, "y": 2}}
+    store.flush()
+    assert read(config_path) == {"a": {"x": 1, "y": 2}}
+    # 临时文件已经改名替换，没有残留
+    assert sorted(os.listdir(tmp_path)) == ["config", "config.lock"]
+    store.close()
+
+
+def test_writers_do_not_undo_each_other(tmp_path):
+    config_path = str(tmp_path / "config")
+    first = FkUSTChat_ConfigStore(config_path, flush_delay=60)
+    second = FkUSTChat_ConfigStore(config_path, flush_delay=60)
+    first.load()
+    second.load()
+    first.set("a", "x", 1)
+    first.flush()
+    assert second.changed() and not first.changed()
+    # second 没有重新读取，写入时仍然保留 first 的修改
+    second.set("a", "y", 2)
+    second.flush()
+    assert read(config_path) == {"a": {"x": 1, "y": 2}}
+    first.close()
+    second.close()
+
+
+def test_concurrent_processes_keep_every_write(tmp_path):
+    config_path = str(tmp_path / "config")
+    writers = [subprocess.Popen([sys.executable, "-c", WRITER, ROOT, config_path, str(n)]) for n in range(4)]
+    assert all(writer.wait(60) == 0 for writer in writers)
+    assert len(read(config_path)["tokens"]) == 80
@@ -0,0 +1,62 @@
+import pytest
+
+from libs.chat import FkUSTChat_ChatRequest, FkUSTChat_RequestError
+from libs.conversations import FkUSTChat_ConversationStore
+
+MODEL = "__Fake__m"
+
+
+def turn(core, client, content, **options):
+    chat = FkUSTChat_ChatRequest(core, dict({"model": MODEL, "messages": [{"role": "user", "content": content}]}, **options), {})
+    assert chat.start(client) is None
+    return chat.finish(chat.get_responses(client))
+
+
+def test_conversation_keeps_history(make_core):
+    core = make_core()
+    conversation_id = turn(core, "alice", "one", conversation={"create": True})["conversation_id"]
+    turn(core, "alice", "two", conversation_id=conversation_id)
+    assert [message["content"] for message in core.adapters["Fake"].prompts[-1]] == ["one", "Hello world!", "two"]
+
+
+def test_store_does_not_start_a_conversation(make_core):
+    core = make_core()
+    assert "conversation_id" not in turn(core, "alice", "one", store=True)
+    assert core.conversations.stats()["conversations"] == 0
+
+
+def test_conversations_are_scoped_by_client(make_core):
+    core = make_core()
+    turn(core, "alice", "one", conversation_id="shared", conversation={"create": True})
+    with pytest.raises(FkUSTChat_RequestError) as e:
+        turn(core, "mallory", "two", conversation_id="shared")
+    assert e.value.status_code == 404
+    # 其他客户端使用同一个 ID 时得到自己的对话
+    turn(core, "mallory", "two", conversation_id="shared", conversation={"create": True})
+    assert core.adapters["Fake"].prompts[-1] == [{"role": "user", "content": "two"}]
+    assert len(core.conversations.get(core.conversations.scoped_id("alice", "shared"))) == 2
+
+
+def test_store_keeps_recent_messages():
+    store = FkUSTChat_ConversationStore(max_messages=2)
+    store.append(store.scoped_id("alice", "c"), [{"role": "system", "content": "s"}, {"role": "user", "content": "a"}, {"role": "assistant", "content": "b"}])
+    _, _, messages = store.start_turn("c", [{"role": "user", "content": "c"}], owner="alice")
+    assert [message["content"] for message in messages] == ["s", "b", "c"]
+
+
+def test_store_evicts_least_recently_used():
+    store = FkUSTChat_ConversationStore(max_conversations=2)
+    for conversation_id in ("a", "b"):
+        store.append(conversation_id, [{"role": "user", "content": conversation_id}])
+    store.get("a")
+    store.append("c", [{"role": "user", "content": "c"}])
+    assert store.get("b") is None and store.get("a") is not None
+    assert store.stats()["evictions"] == 1
+
+
+def test_sqlite_store_survives_restart(tmp_path):
+    db = str(tmp_path / "conversations.db")
+    FkUSTChat_ConversationStore(path=db).append("c", [{"role": "user", "content": "a"}])
+    store = FkUSTChat_ConversationStore(path=db)
+    assert store.get("c") == [{"role": "user", "content": "a"}]
+    assert store.delete("c") and store.get("c") is None
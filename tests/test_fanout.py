@@ -0,0 +1,106 @@
+import asyncio
+import json
+
+import pytest
+
+from libs.completion import iter_with_limits
+from libs.fanout import merge_completions
+from libs.tokens import FkUSTChat_TokenCounter
+
+MODEL = "__Fake__m"
+PROMPT = [{"role": "user", "content": "hi"}]
+
+
+def active(core):
+    return core.scheduler.stats()["adapters"]["Fake"]["active"]
+
+
+def parse(chunks):
+    frames = []
+    for chunk in chunks:
+        for frame in chunk.split(b'\n\n'):
+            if frame:
+                frames.append(frame[6:])
+    return frames
+
+
+def frames(pieces):
+    chunks = [b'data: ' + json.dumps({"id": "a", "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}).encode() + b'\n\n' for piece in pieces]
+    return chunks + [b'data: [DONE]\n\n']
+
+
+class CharTokenizer:
+    def count(self, text):
+        return len(text)
+
+
+def limited_text(pieces, max_tokens=None, stop=None):
+    counter = FkUSTChat_TokenCounter(CharTokenizer(), batch_size=1)
+    text, finish_reason = "", None
+    for payload in parse(iter_with_limits(iter(frames(pieces)), counter, max_tokens, stop)):
+        if payload == b'[DONE]':
+            continue
+        choice = json.loads(payload)["choices"][0]
+        text += choice["delta"].get("content") or ""
+        finish_reason = choice["finish_reason"] or finish_reason
+    return text, finish_reason
+
+
+def test_stop_sequence_split_across_frames():
+    assert limited_text(["hello E", "N", "D more"], stop="END") == ("hello ", "stop")
+    assert limited_text(["ab", "x", "ab", "c"], stop="abc") == ("abx", "stop")
+
+
+def test_max_tokens_ends_stream():
+    # 超过上限的那一帧仍然发出，之后以 length 结束
+    text, finish_reason = limited_text(["word "] * 50, max_tokens=12)
+    assert finish_reason == "length"
+    assert text == "word " * 3
+
+
+def test_failed_fanout_releases_slots(make_core):
+    core = make_core(Fake={"max_concurrency": 4})
+    core.adapters["Fake"].fail_calls = (2,)
+    with pytest.raises(ValueError):
+        core.get_responses(MODEL, PROMPT, 3, stream=True, max_tokens=10)
+    assert active(core) == 0
+
+
+def test_failed_async_fanout_releases_slots(make_core):
+    core = make_core(Fake={"max_concurrency": 4})
+    core.adapters["Fake"].fail_calls = (2,)
+    with pytest.raises(ValueError):
+        asyncio.run(core.aget_responses(MODEL, PROMPT, 3, stream=True, stop="x"))
+    assert active(core) == 0
+
+
+def test_closing_unstarted_stream_releases_slot(make_core):
+    core = make_core()
+    core.get_response(MODEL, PROMPT, stream=True, max_tokens=10).close()
+    core.get_responses(MODEL, PROMPT, 2, stream=True).close()
+    assert active(core) == 0
+
+    async def run():
+        stream = await core.aget_responses(MODEL, PROMPT, 2, stream=True, max_tokens=10)
+        await stream.aclose()
+    asyncio.run(run())
+    assert active(core) == 0
+
+
+def test_merged_stream_numbers_choices(make_core):
+    core = make_core()
+    payloads = parse(core.get_responses(MODEL, PROMPT, 3, stream=True))
+    assert payloads[-1] == b'[DONE]' and payloads.count(b'[DONE]') == 1
+    texts = {}
+    for payload in payloads[:-1]:
+        choice = json.loads(payload)["choices"][0]
+        texts[choice["index"]] = texts.get(choice["index"], "") + (choice["delta"].get("content") or "")
+    assert texts == {0: "Hello world!", 1: "Hello world!", 2: "Hello world!"}
+    assert active(core) == 0
+
+
+def test_merge_completions():
+    result = {"id": "a", "choices": [{"index": 0, "message": {"content": "x"}}], "usage": {"prompt_tokens": 5, "completion_tokens": 2, "total_tokens": 7}}
+    merged = merge_completions([result, result])
+    assert [choice["index"] for choice in merged["choices"]] == [0, 1]
+    assert merged["usage"] == {"prompt_tokens": 5, "completion_tokens": 4, "total_tokens": 9}
@@ -0,0 +1,91 @@
+from libs.anthropic_stream import FkUSTChat_AnthropicTranscoder
+from libs.completion import FkUSTChat_CompletionCollector, FkUSTChat_StreamLimiter
+from libs.conversations import FkUSTChat_ConversationStore
+from libs.json_codec import dumps, loads
+from libs.tokens import FkUSTChat_TokenCounter, FkUSTChat_UsageInjector
+
+
+class CharTokenizer:
+    def count(self, text):
+        return len(text)
+
+
+def counter():
+    return FkUSTChat_TokenCounter(CharTokenizer(), batch_size=1)
+
+
+def chunk(delta, finish_reason=None):
+    return {
+        "id": "chatcmpl-1",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "deepseek-r1",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    }
+
+
+# DeepSeek-R1 先流式输出思考过程，再输出回答
+R1_CHUNKS = [
+    chunk({"role": "assistant", "reasoning_content": "abcde"}),
+    chunk({"reasoning_content": "fghij"}),
+    chunk({"content": "12345"}),
+    chunk({}, "stop"),
+]
+R1_FRAMES = [b'data: ' + dumps(c) + b'\n\n' for c in R1_CHUNKS] + [b'data: [DONE]\n\n']
+
+
+def test_usage_injector_counts_reasoning():
+    injector = FkUSTChat_UsageInjector(counter(), prompt_tokens=3)
+    out = []
+    for frame in R1_FRAMES:
+        out.extend(injector.feed(frame))
+    usage = [loads(frame[6:]) for frame in out if b'"usage"' in frame][0]["usage"]
+    assert usage["completion_tokens"] == 15
+
+
+def test_anthropic_transcoder_counts_reasoning():
+    tokens = counter()
+    transcoder = FkUSTChat_AnthropicTranscoder("deepseek-r1", counter=tokens)
+    transcoder.start()
+    for c in R1_CHUNKS:
+        transcoder.feed(dumps(c))
+    transcoder.finish()
+    assert tokens.total == 15
+
+
+def test_collector_keeps_reasoning_and_limits_it():
+    collector = FkUSTChat_CompletionCollector("deepseek-r1")
+    for c in R1_CHUNKS:
+        collector.feed(c)
+    message = collector.result()["choices"][0]["message"]
+    assert message["reasoning_content"] == "abcdefghij"
+    assert message["content"] == "12345"
+
+    collector = FkUSTChat_CompletionCollector("deepseek-r1", max_tokens=8, counter=counter())
+    assert not collector.feed(R1_CHUNKS[0])
+    assert collector.feed(R1_CHUNKS[1])
+    result = collector.result()
+    assert result["choices"][0]["finish_reason"] == "length"
+    assert result["choices"][0]["message"]["content"] == ""
+
+
+def test_stream_limiter_limits_reasoning():
+    limiter = FkUSTChat_StreamLimiter(counter(), max_tokens=8)
+    out = []
+    for frame in R1_FRAMES:
+        out.extend(limiter.feed(frame))
+        if limiter.done:
+            break
+    text = b''.join(out)
+    assert b'"finish_reason":"length"' in text
+    assert b'12345' not in text
+    assert text.endswith(b'data: [DONE]\n\n')
+
+
+def test_conversation_does_not_keep_reasoning():
+    store = FkUSTChat_ConversationStore()
+    collector = FkUSTChat_CompletionCollector("deepseek-r1")
+    for c in R1_CHUNKS:
+        collector.feed(c)
+    store.record("conv", [{"role": "user", "content": "hi"}], collector.result())
+    assert store.get("conv")[-1] == {"role": "assistant", "content": "12345"}
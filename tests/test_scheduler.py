@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from libs.scheduler import FkUSTChat_Scheduler, FkUSTChat_QueueTimeout
+
+
+def serve_order(scheduler, clients):
+    """
+    Queues one request per entry of ``clients`` behind a busy slot of the only model, then frees
+    the slots one at a time and returns the clients in the order they were served.
+    """
+    scheduler.set_model_limit("m", 1)
+
+    async def run():
+        held = scheduler.acquire("m", "a", client="busy")
+        granted = []
+
+        async def request(client):
+            granted.append((client, await scheduler.aacquire("m", "a", client=client)))
+        tasks = [asyncio.create_task(request(client)) for client in clients]
+        await asyncio.sleep(0)
+        slot = held
+        for i in range(len(clients)):
+            slot.release()
+            while len(granted) == i:
+                await asyncio.sleep(0)
+            slot = granted[i][1]
+        slot.release()
+        await asyncio.gather(*tasks)
+        return [client for client, _ in granted]
+    return asyncio.run(run())
+
+
+def test_busy_client_does_not_starve_others():
+    order = serve_order(FkUSTChat_Scheduler(), ["a"] * 4 + ["b"] * 2)
+    assert order == ["a", "b", "a", "b", "a", "a"]
+
+
+def test_weighted_client_is_served_more_often():
+    order = serve_order(FkUSTChat_Scheduler(client_weights={"a": 2}), ["a"] * 6 + ["b"] * 6)
+    assert order[:6].count("a") == 4
+
+
+def test_slots_are_released_once():
+    scheduler = FkUSTChat_Scheduler()
+    scheduler.set_adapter_limit("a", 1)
+    with scheduler.acquire("m", "a") as slot:
+        with pytest.raises(FkUSTChat_QueueTimeout):
+            scheduler.acquire("m", "a", timeout=0.01)
+        slot.release()
+    assert scheduler.stats()["adapters"]["a"]["active"] == 0
+    assert scheduler.stats()["rejected_total"] == 1
+    scheduler.acquire("m", "a", timeout=0.01).release()
+
+
+def test_full_queue_rejects_at_once():
+    scheduler = FkUSTChat_Scheduler(max_queue_size=0)
+    scheduler.set_model_limit("m", 1)
+    slot = scheduler.acquire("m", "a")
+    with pytest.raises(FkUSTChat_QueueTimeout):
+        scheduler.acquire("m", "a", timeout=10)
+    slot.release()
+
+
+def test_idle_clients_are_forgotten():
+    scheduler = FkUSTChat_Scheduler()
+    # 另一个上游一直有请求在执行，调度器不会进入完全空闲
+    busy = scheduler.acquire("other", "b")
+    for i in range(5000):
+        scheduler.acquire("m", "a", client=f"client-{i}").release()
+    for _ in range(5000):
+        scheduler.acquire("m", "a", client="heavy").release()
+    assert len(scheduler._vtime) <= 1024
+    serve_order(scheduler, [f"queued-{i}" for i in range(50)])
+    assert not any(client.startswith("queued-") and vtime <= scheduler._clock for client, vtime in scheduler._vtime.items())
+    busy.release()
+    assert scheduler._vtime == {}
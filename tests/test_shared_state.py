@@ -0,0 +1,72 @@
+import threading
+import time
+
+import pytest
+
+from libs.shared_state import FkUSTChat_SharedState, get_worker_count
+
+
+@pytest.fixture
+def db(tmp_path):
+    return str(tmp_path / "state.db")
+
+
+def test_keys_expire(db, monkeypatch):
+    state = FkUSTChat_SharedState(db)
+    state.set("token", {"value": "t"}, ttl=10)
+    state.set("forever", 1)
+    assert FkUSTChat_SharedState(db).get("token") == {"value": "t"}
+    later = time.time() + 11
+    monkeypatch.setattr("libs.shared_state.time.time", lambda: later)
+    assert state.get("token", "gone") == "gone" and state.get("forever") == 1
+
+
+def test_claim_is_exclusive_until_it_expires(db, monkeypatch):
+    first, second = FkUSTChat_SharedState(db), FkUSTChat_SharedState(db)
+    assert first.claim("login", ttl=30)
+    assert first.claim("login", ttl=30)
+    assert not second.claim("login", ttl=30)
+    first.unclaim("login")
+    assert second.claim("login", ttl=30)
+    later = time.time() + 31
+    monkeypatch.setattr("libs.shared_state.time.time", lambda: later)
+    assert first.claim("login", ttl=30)
+
+
+def test_run_once_shares_the_result(db):
+    calls = []
+    results = []
+
+    def produce():
+        calls.append(1)
+        time.sleep(0.3)
+        return {"token": "t"}
+
+    def worker():
+        results.append(FkUSTChat_SharedState(db).run_once("token", produce, timeout=5, poll_interval=0.02))
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == [{"token": "t"}] * 4
+
+
+def test_pool_pops_fresh_items_of_the_key(db, monkeypatch):
+    state = FkUSTChat_SharedState(db)
+    state.push("codes", "old-token", "a")
+    state.push("codes", "token", "b")
+    state.push("codes", "token", "c")
+    assert state.pop("codes", "token", max_age=60) == ("b", 1)
+    later = time.time() + 61
+    monkeypatch.setattr("libs.shared_state.time.time", lambda: later)
+    assert state.pop("codes", "token", max_age=60) == (None, 1)
+    assert state.count("codes") == 0
+
+
+def test_worker_count(monkeypatch):
+    monkeypatch.setenv("FKUSTCHAT_WORKERS", "4")
+    assert get_worker_count() == 4
+    monkeypatch.setenv("FKUSTCHAT_WORKERS", "x")
+    assert get_worker_count() == 1
@@ -0,0 +1,86 @@
+import asyncio
+import threading
+import time
+
+from libs.singleflight import FkUSTChat_SingleFlight
+
+KEY = 'same-request'
+CHUNKS = [b'data: {"choices":[{"index":0,"delta":{"content":"hi"}}]}\n\n', b'data: [DONE]\n\n']
+RESULT = {"object": "chat.completion", "choices": [{"index": 0, "message": {"role": "assistant", "content": "hi"}}]}
+
+
+def slow_stream(started):
+    started.set()
+    time.sleep(0.2)
+    yield from CHUNKS
+
+
+def test_stream_leader_does_not_serve_result_follower():
+    group = FkUSTChat_SingleFlight()
+    started = threading.Event()
+    stream = group.stream(KEY, lambda: slow_stream(started))
+    started.wait()
+    calls = []
+
+    def call():
+        calls.append(1)
+        return RESULT
+
+    assert group.do(KEY, call) == RESULT
+    assert calls == [1]
+    assert list(stream) == CHUNKS
+
+
+def test_result_leader_does_not_serve_stream_follower():
+    group = FkUSTChat_SingleFlight()
+    started = threading.Event()
+    results = []
+
+    def call():
+        started.set()
+        time.sleep(0.2)
+        return RESULT
+
+    leader = threading.Thread(target=lambda: results.append(group.do(KEY, call)))
+    leader.start()
+    started.wait()
+    assert list(group.stream(KEY, lambda: iter(CHUNKS))) == CHUNKS
+    leader.join()
+    assert results == [RESULT]
+
+
+def test_async_modes_do_not_mix():
+    group = FkUSTChat_SingleFlight()
+
+    async def start():
+        async def chunks():
+            await asyncio.sleep(0.1)
+            for chunk in CHUNKS:
+                yield chunk
+        return chunks()
+
+    async def call():
+        await asyncio.sleep(0.1)
+        return RESULT
+
+    async def read(stream):
+        return [chunk async for chunk in stream]
+
+    async def main():
+        stream = await group.astream(KEY, start)
+        result = await group.ado(KEY, call)
+        return result, await read(stream), await read(await group.astream(KEY, start))
+
+    result, first, second = asyncio.run(main())
+    assert result == RESULT
+    assert first == CHUNKS and second == CHUNKS
+
+
+def test_same_mode_is_still_shared():
+    group = FkUSTChat_SingleFlight()
+    started = threading.Event()
+    first = group.stream(KEY, lambda: slow_stream(started))
+    started.wait()
+    second = group.stream(KEY, lambda: iter([]))
+    assert list(first) == CHUNKS and list(second) == CHUNKS
+    assert group.stats()["followers"] == 1
@@ -0,0 +1,66 @@
+import asyncio
+
+from libs.sse import FkUSTChat_SSEFramer, FkUSTChat_ClosingStream, iter_sse_frames, aiter_sse_frames, iter_sse_payloads
+
+STREAM = b'data: {"a": 1}\n\n: keep-alive\n\ndata: {"b": 2}\n\ndata: [DONE]\n\ndata: {"late": 3}\n\n'
+PAYLOADS = [b'{"a": 1}', b'{"b": 2}']
+
+
+def split(data, *positions):
+    bounds = [0, *positions, len(data)]
+    return [data[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+def test_frames_survive_any_split():
+    for stream in (STREAM, STREAM.replace(b'\n', b'\r\n')):
+        for i in range(1, len(stream)):
+            for j in range(i, len(stream), 7):
+                frames = list(iter_sse_frames(iter(split(stream, i, j))))
+                assert all(frame.endswith(b'\n\n') for frame in frames)
+                assert list(iter_sse_payloads(frames)) == PAYLOADS
+
+
+def test_frames_are_forwarded_in_runs():
+    framer = FkUSTChat_SSEFramer()
+    assert framer.feed(b'data: 1\n\ndata: 2\n\ndata: ') == [b'data: 1\n\ndata: 2\n\n']
+    assert framer.feed(b'3') == []
+    assert framer.feed(b'\n\ndata: [DONE]\n\n') == [b'data: 3\n\ndata: [DONE]\n\n']
+    assert framer.done and framer.feed(b'data: 4\n\n') == []
+
+
+def test_flush_completes_unterminated_frame():
+    assert list(iter_sse_frames(iter([b'data: 1\n\ndata: 2']))) == [b'data: 1\n\n', b'data: 2\n\n']
+    assert list(iter_sse_frames(iter([b'data: 1\n\n']))) == [b'data: 1\n\n']
+
+
+def test_async_frames():
+    async def chunks():
+        for chunk in split(STREAM, 5, 30):
+            yield chunk
+
+    async def collect():
+        return [frame async for frame in aiter_sse_frames(chunks())]
+    assert list(iter_sse_payloads(asyncio.run(collect()))) == PAYLOADS
+
+
+def test_payloads_keep_chunk_type():
+    assert list(iter_sse_payloads(['data: x\n\ndata: [DONE]\n\n'])) == ['x']
+    assert list(iter_sse_payloads([b'data: x\n\n'])) == [b'x']
+
+
+def test_closing_unstarted_stream_closes_sources():
+    closed = []
+
+    class Source:
+        def __iter__(self):
+            return iter(())
+
+        def close(self):
+            closed.append(True)
+
+    source = Source()
+
+    def generate():
+        yield from source
+    FkUSTChat_ClosingStream(generate(), (source,)).close()
+    assert closed == [True]